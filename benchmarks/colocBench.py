@@ -0,0 +1,567 @@
+### Benchmarks of the colocalization pipeline on synthetic images
+###
+### Makes multichannel Z-stacks with cells of known colocalization and runs
+### the per-cell stages of MandersPlugin.getManders on them: crop, index,
+### threshold, binarize, manders, coefficients and save, plus opening the
+### image and the whole per-image pipeline. The core engine takes the same
+### colocCore.py calls as mColoc3D.py (ImageJ histograms of 8 and 16-bit
+### planes, the voxel index of 32-bit ones, then one addSums sweep with the
+### thresholds); the numpy engine is colocNumpy.py. Plain CPython with NumPy -
+### the ImageJ parts are replaced by stand-ins (pixel lists for ImageProcessor
+### pixels, NumPy for ImageProcessor.getHistogram, raw files for TIFFs), so
+### the numbers track the engines rather than Fiji itself. With --imagej
+### <ij.jar> (and JPype), the core engine takes its thresholds from ImageJ's
+### AutoThresholder, as MandersPlugin.runThresholder does, so the numpy
+### engine is checked against ImageJ; otherwise both use the colocNumpy.py
+### ports, which tests/test_colocNumpy.py checks against ImageJ.
+###
+### Usage: python benchmarks/colocBench.py [--scales small,medium] [--engines core,numpy]
+###            [--imagej ij.jar] [--coefficients Pearson,ICQ] [--repeat 3]
+###            [--output report.json] [--compare old-report.json]
+###
+### Every run writes a JSON report (stage times, throughput, accuracy against
+### the known colocalization and the environment); --compare prints the
+### speedup of each stage over an earlier report.
+###
+### @license Licensed under GPLv3 and CC BY 4.0
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import zlib
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from array import array
+from collections import OrderedDict
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+try:
+	import jpype
+except ImportError:
+	jpype = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from colocCore import CellMask, ColocIndex, coefficients, getAutoThreshold
+import colocBatch
+import colocNumpy
+
+
+reportVersion = 2
+
+scales = OrderedDict([
+	("small", OrderedDict([("width", 128), ("height", 128), ("slices", 8), ("channels", 2),
+		("bitDepth", 8), ("cells", 4), ("shape", "rect")])),
+	("medium", OrderedDict([("width", 256), ("height", 256), ("slices", 16), ("channels", 3),
+		("bitDepth", 16), ("cells", 8), ("shape", "ellipse")])),
+	("large", OrderedDict([("width", 512), ("height", 512), ("slices", 32), ("channels", 3),
+		("bitDepth", 16), ("cells", 16), ("shape", "polygon")])),
+])
+shapes = ["rect", "ellipse", "polygon"]
+
+
+def getMemory():
+	### Peak resident memory in bytes, the stand-in for the used Java heap
+	try:
+		import resource
+	except ImportError:
+		return 0
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak if sys.platform == "darwin" else peak * 1024
+
+
+class SyntheticCell(object):
+
+	### Cell in slices z0..z1 - 1 (0-based), with the same ROI in every slice:
+	### a rectangle (pixels is None) or a pixel mask over (x, y, width, height)
+
+	def __init__(self, x, y, width, height, z0, z1, pixels):
+		self.x = x
+		self.y = y
+		self.width = width
+		self.height = height
+		self.z0 = z0
+		self.z1 = z1
+		self.pixels = pixels
+		self.truth = {}
+
+	def getMask(self):
+		### CellMask as built by Cell.getMask; all slices share their runs
+		mask = CellMask(self.x, self.y, self.width, self.height)
+		pixels = None if self.pixels is None else self.pixels.ravel().tolist()
+		runs = mask.getRoiRuns(pixels, self.x, self.y, self.width, self.height)
+		for z in range(self.z0, self.z1):
+			mask.addSlice(z + 1, runs)
+		return mask
+
+	def getVolumeMask(self):
+		### Boolean (Z, Y, X) mask over the crop of the cell
+		plane = np.ones((self.height, self.width), dtype = bool) if self.pixels is None else self.pixels
+		return np.repeat(plane[np.newaxis], self.z1 - self.z0, axis = 0)
+
+
+def makeShape(shape, width, height, rng):
+	if shape == "rect":
+		return None
+	yy, xx = np.mgrid[0:height, 0:width]
+	cy, cx = (height - 1) / 2.0, (width - 1) / 2.0
+	if shape == "ellipse":
+		return ((yy - cy) / (height / 2.0)) ** 2 + ((xx - cx) / (width / 2.0)) ** 2 <= 1.0
+	### Star shaped polygon: radius varies with the angle
+	angle = np.arctan2(yy - cy, xx - cx)
+	radius = np.hypot((yy - cy) / (height / 2.0), (xx - cx) / (width / 2.0))
+	lobes = rng.randint(3, 8)
+	phase = rng.uniform(0, 2 * np.pi)
+	return radius <= 0.7 + 0.3 * np.cos(lobes * angle + phase)
+
+def makeImage(width, height, slices, channels, bitDepth, cells, shape,
+		coloc = 0.5, density = 0.3, noise = 0.05, seed = 0):
+	### (C, Z, Y, X) stack and its cells. Inside a cell, channel 1 has signal
+	### in a random density fraction of the voxels; every other channel has
+	### signal in a coloc fraction of those and in as many voxels elsewhere.
+	### Noise (a noise fraction of the signal level) is everywhere; in 32-bit
+	### images it is centred on 0 and not clipped, as after a background
+	### subtraction, so some voxels are negative. The known coefficients of
+	### each cell are those of the signal alone.
+	rng = np.random.RandomState(seed)
+	top = 4095.0 if bitDepth == 32 else float((1 << min(bitDepth, 12)) - 1)
+	dtype = {8: np.uint8, 16: np.uint16, 32: np.float32}[bitDepth]
+	low = -noise * top if bitDepth == 32 else 0
+	data = rng.uniform(low, noise * top, (channels, slices, height, width))
+	signal = np.zeros(data.shape)
+	grid = int(np.ceil(np.sqrt(cells)))
+	cellWidth, cellHeight = width // grid, height // grid
+	result = []
+	for n in range(cells):
+		gx, gy = n % grid, n // grid
+		w = max(4, int(cellWidth * rng.uniform(0.6, 0.9)))
+		h = max(4, int(cellHeight * rng.uniform(0.6, 0.9)))
+		x = gx * cellWidth + rng.randint(0, cellWidth - w + 1)
+		y = gy * cellHeight + rng.randint(0, cellHeight - h + 1)
+		depth = max(1, int(slices * rng.uniform(0.5, 1.0)))
+		z0 = rng.randint(0, slices - depth + 1)
+		cell = SyntheticCell(x, y, w, h, z0, z0 + depth, makeShape(shape, w, h, rng))
+		inside = cell.getVolumeMask()
+		first = inside & (rng.uniform(size = inside.shape) < density)
+		box = (slice(z0, z0 + depth), slice(y, y + h), slice(x, x + w))
+		for c in range(channels):
+			if c == 0:
+				positive = first
+			else:
+				shared = first & (rng.uniform(size = inside.shape) < coloc)
+				other = inside & ~first & (rng.uniform(size = inside.shape) < density * (1 - coloc))
+				positive = shared | other
+			signal[c][box] = np.where(positive, rng.uniform(0.5, 1.0, inside.shape) * top, 0)
+		for a in range(1, channels + 1):
+			for b in range(a + 1, channels + 1):
+				truth = colocNumpy.getManders(signal[a - 1][box], signal[b - 1][box], inside)
+				cell.truth[(a, b)] = (truth.m1, truth.m2)
+		result.append(cell)
+	data = data + signal
+	if bitDepth != 32:
+		data = np.round(np.clip(data, 0, top))
+	return data.astype(dtype), result
+
+
+class ImageJThresholder(object):
+
+	### AutoThresholder of an ImageJ jar, through JPype, called as
+	### MandersPlugin.runThresholder does. Older ImageJ versions only take
+	### 256-bin histograms; use the ij.jar of a current Fiji.
+
+	def __init__(self, jar):
+		if not jpype.isJVMStarted():
+			jpype.startJVM("-Djava.awt.headless=true", classpath = [jar])
+		self.autoThresholder = jpype.JClass("ij.process.AutoThresholder")
+
+	def __call__(self, method, data):
+		method = self.autoThresholder.Method.valueOf(method.replace("(I)", ""))
+		return int(self.autoThresholder().getThreshold(method, jpype.JArray(jpype.JInt)(data)))
+
+
+class CoreEngine(object):
+
+	### MandersPlugin.getManders with the colocCore.py engines; image planes
+	### are pixel lists, as ImageProcessor.getPixels in Jython
+
+	name = "core"
+	indexed = True
+
+	def __init__(self, thresholder, names):
+		self.thresholder = thresholder
+		self.names = names
+
+	def load(self, data):
+		return [[data[c, z].ravel().tolist() for z in range(data.shape[1])] for c in range(data.shape[0])]
+
+	def crop(self, image, width, cell, mask):
+		### Stand-in for getCroppedChannels: crop the bounding box and zero
+		### the voxels outside the ROI
+		channels = []
+		for planes in image:
+			slices = []
+			for z, runs in mask.slices:
+				plane = planes[z - 1]
+				crop = [0] * (mask.width * mask.height)
+				for row in range(mask.height):
+					start = (mask.y + row) * width + mask.x
+					crop[row * mask.width:(row + 1) * mask.width] = plane[start:start + mask.width]
+				masked = [0] * len(crop)
+				for start, end in runs:
+					masked[start:end] = crop[start:end]
+				slices.append(masked)
+			channels.append(slices)
+		return channels
+
+	def getPlanesValues(self, channels, methods, k):
+		return [channel[k] if method != "None" else None for channel, method in zip(channels, methods)]
+
+	def getPlaneHistograms(self, channels, methods, k):
+		### Stand-in for ImageProcessor.getHistogram, up to the brightest voxel
+		return [np.bincount(channel[k]).tolist() if method != "None" else None
+			for channel, method in zip(channels, methods)]
+
+	def index(self, channels, mask, pairs, methods, native):
+		### Histograms of the cell, as in MandersPlugin.getManders; the pair
+		### sums come from sweep
+		selected = [c + 1 for c, method in enumerate(methods) if method != "None"]
+		index = ColocIndex.forCoefficients(pairs, selected, self.names)
+		for k, (z, runs) in enumerate(mask.slices):
+			if native:
+				index.addHistograms(self.getPlaneHistograms(channels, methods, k), mask.width * mask.height,
+					sum([end - start for start, end in runs]))
+			else:
+				index.addValues(self.getPlanesValues(channels, methods, k), runs)
+		return index
+
+	def threshold(self, index, channels, c, method):
+		return getAutoThreshold(index.getHistogram(c), method, self.thresholder)
+
+	def binarize(self, channel, thr):
+		return [[255 if v > thr else 0 for v in plane] for plane in channel]
+
+	def sweep(self, index, channels, mask, methods, thrs):
+		### The one addSums sweep over the planes, once the thresholds are known
+		for k, (z, runs) in enumerate(mask.slices):
+			index.addSums(self.getPlanesValues(channels, methods, k), runs, thrs)
+
+	def manders(self, index, channels, pair, thrA, thrB):
+		return index.getManders(pair[0], pair[1], thrA, thrB)
+
+	def coefficients(self, index, pair):
+		return index.getCoefficients(pair[0], pair[1], self.names)
+
+	def save(self, path, channels, typecode, compress):
+		### Stand-in for FileSaver: raw planes, zlib compressed for saveAsZip
+		data = array(typecode)
+		for channel in channels:
+			for plane in channel:
+				data.extend(plane)
+		return writeRaw(path, data.tostring() if hasattr(data, "tostring") else data.tobytes(), compress)
+
+
+class NumpyEngine(object):
+
+	### The same stages with colocNumpy.py on (C, Z, Y, X) arrays
+
+	name = "numpy"
+	indexed = False
+
+	def __init__(self, thresholder, names):
+		pass
+
+	def load(self, data):
+		return data
+
+	def crop(self, image, width, cell, mask):
+		box = image[:, cell.z0:cell.z1, cell.y:cell.y + cell.height, cell.x:cell.x + cell.width]
+		return box * cell.getVolumeMask()
+
+	def threshold(self, index, channels, c, method):
+		return colocNumpy.getCellThreshold(channels[c - 1], method)
+
+	def binarize(self, channel, thr):
+		return np.where(channel > thr, 255, 0).astype(np.uint8)
+
+	def sweep(self, index, channels, mask, methods, thrs):
+		pass
+
+	def manders(self, index, channels, pair, thrA, thrB):
+		return colocNumpy.getManders(channels[pair[0] - 1], channels[pair[1] - 1], None, thrA, thrB)
+
+	def save(self, path, channels, typecode, compress):
+		return writeRaw(path, np.ascontiguousarray(channels).tobytes(), compress)
+
+
+engines = OrderedDict([("core", CoreEngine), ("numpy", NumpyEngine)])
+
+
+def writeRaw(path, data, compress):
+	if compress:
+		data = zlib.compress(data, 6)
+	output = open(path, "wb")
+	try:
+		output.write(data)
+	finally:
+		output.close()
+	return len(data)
+
+def analyseImage(engine, timer, imageFile, cells, methods, pairs, bitDepth, outputDir, compress):
+	### One pass of the per-image pipeline; returns the results of the cells
+	### as [thrs, raws, thrds] with Manders as (m1, m2) tuples
+	name = os.path.basename(imageFile)
+	typecode = {8: "B", 16: "H", 32: "f"}[bitDepth]
+	selected = [c + 1 for c, method in enumerate(methods) if method != "None"]
+	native = bitDepth in (8, 16)
+	results = []
+	with timer.stage("image", name) as total:
+		with timer.stage("open", name) as stage:
+			data = np.load(imageFile)
+			image = engine.load(data)
+			stage.voxels = total.voxels = data.size
+		width = data.shape[3]
+		for n, cell in enumerate(cells):
+			mask = cell.getMask()
+			voxels = mask.width * mask.height * len(mask.slices)
+			with timer.stage("crop", name, n + 1, voxels * len(methods)):
+				channels = engine.crop(image, width, cell, mask)
+			index = None
+			if engine.indexed:
+				with timer.stage("index", name, n + 1, voxels * len(selected)):
+					index = engine.index(channels, mask, pairs, methods, native)
+			thrs = []
+			binaries = []
+			for c, method in enumerate(methods):
+				thr = None
+				if method != "None":
+					with timer.stage("threshold", name, n + 1, voxels):
+						thr = engine.threshold(index, channels, c + 1, method)
+					with timer.stage("binarize", name, n + 1, voxels):
+						binaries.append(engine.binarize(channels[c], thr))
+				thrs.append(thr)
+			raws = []
+			thrds = []
+			with timer.stage("manders", name, n + 1, voxels * 2 * len(pairs)):
+				engine.sweep(index, channels, mask, methods, thrs)
+				for chA, chB in pairs:
+					raw = engine.manders(index, channels, (chA, chB), 0, 0)
+					thrd = engine.manders(index, channels, (chA, chB), thrs[chA - 1], thrs[chB - 1])
+					raws.append((raw.m1, raw.m2))
+					thrds.append((thrd.m1, thrd.m2))
+			if engine.indexed and engine.names:
+				with timer.stage("coefficients", name, n + 1, voxels * len(pairs)):
+					for pair in pairs:
+						engine.coefficients(index, pair)
+			title = os.path.join(outputDir, "Cell_%i-%s" % (n + 1, name))
+			with timer.stage("save", name, n + 1, voxels * (len(methods) + len(binaries))):
+				engine.save(title + ".raw", channels, typecode, compress)
+				engine.save(title + "_thrd.raw", binaries, "B", compress)
+			results.append([thrs, raws, thrds])
+	return results
+
+def getStageTotals(records):
+	totals = OrderedDict()
+	for record in records:
+		total = totals.setdefault(record["stage"], OrderedDict([("runs", 0), ("seconds", 0.0),
+			("voxels", 0), ("memory", 0)]))
+		total["runs"] += 1
+		total["seconds"] += record["seconds"]
+		total["voxels"] += record["voxels"]
+		total["memory"] = max(total["memory"], record["heap"])
+	return totals
+
+def getAccuracy(cells, pairs, results):
+	### Largest difference between the thresholded coefficients and the
+	### known colocalization of the signal
+	worst = 0.0
+	for cell, (thrs, raws, thrds) in zip(cells, results):
+		for i, pair in enumerate(pairs):
+			for value, expected in zip(thrds[i], cell.truth[pair]):
+				if value == value and expected == expected:
+					worst = max(worst, abs(value - expected))
+	return worst
+
+def countMismatches(results, reference, tolerance = 1e-9):
+	### Cells whose results differ from those of the reference engine
+	mismatches = 0
+	for (thrs, raws, thrds), (refThrs, refRaws, refThrds) in zip(results, reference):
+		same = thrs == refThrs
+		for values, expected in zip(raws + thrds, refRaws + refThrds):
+			for value, ref in zip(values, expected):
+				same = same and colocNumpy.isClose(value, ref, tolerance)
+		if not same:
+			mismatches += 1
+	return mismatches
+
+def runScale(name, params, engineNames, methods, repeat, workDir, compress, seed, thresholder, names):
+	data, cells = makeImage(params["width"], params["height"], params["slices"], params["channels"],
+		params["bitDepth"], params["cells"], params["shape"], seed = seed)
+	if methods is None:
+		methods = ["Otsu"] * params["channels"]
+	if len(methods) != params["channels"]:
+		raise ValueError("%i threshold methods for %i channels" % (len(methods), params["channels"]))
+	pairs = colocNumpy.getPairs(methods)
+	imageFile = os.path.join(workDir, "%s.npy" % name)
+	np.save(imageFile, data)
+	reports = []
+	reference = None
+	for engineName in engineNames:
+		engine = engines[engineName](thresholder, names)
+		best = None
+		for run in range(repeat):
+			timer = colocBatch.StageTimer(memory = getMemory)
+			results = analyseImage(engine, timer, imageFile, cells, methods, pairs,
+				params["bitDepth"], workDir, compress)
+			totals = getStageTotals(timer.records)
+			if best is None:
+				best = totals
+			else:
+				### Fastest of the repeats, stage by stage
+				for stage, total in totals.items():
+					if total["seconds"] < best[stage]["seconds"]:
+						best[stage] = total
+		for total in best.values():
+			total["mvoxelsPerSecond"] = total["voxels"] / total["seconds"] / 1e6 if total["seconds"] > 0 else None
+		report = OrderedDict([("scale", name), ("engine", engineName), ("params", params),
+			("methods", methods), ("voxels", int(data.size)), ("stages", best),
+			("maxError", getAccuracy(cells, pairs, results))])
+		if reference is None:
+			reference = results
+		else:
+			report["mismatches"] = countMismatches(results, reference)
+		reports.append(report)
+	return reports
+
+def getCommit():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+			cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.STDOUT).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def printReport(report):
+	for result in report["results"]:
+		print("%s / %s: %i voxels, %i cells, max error %.3f%s" % (result["scale"], result["engine"],
+			result["voxels"], result["params"]["cells"], result["maxError"],
+			", %i cells differ from %s" % (result["mismatches"], report["results"][0]["engine"])
+				if result.get("mismatches") else ""))
+		print("  %-12s %6s %10s %12s %10s" % ("Stage", "Runs", "Total s", "Mvoxel/s", "Memory MB"))
+		for stage, total in result["stages"].items():
+			rate = total["mvoxelsPerSecond"]
+			print("  %-12s %6i %10.3f %12s %10.0f" % (stage, total["runs"], total["seconds"],
+				"%.2f" % rate if rate is not None else "-", total["memory"] / float(1 << 20)))
+
+def compareReports(report, old):
+	### Speedup of each stage over the old report, for the scales and
+	### engines both have
+	previous = dict([((r["scale"], r["engine"]), r) for r in old["results"]])
+	print("Compared to %s (%s):" % (old.get("commit") or "previous report", old.get("date")))
+	print("  %-8s %-6s %-12s %10s %10s %8s" % ("Scale", "Engine", "Stage", "Before s", "Now s", "Speedup"))
+	for result in report["results"]:
+		before = previous.get((result["scale"], result["engine"]))
+		if before is None:
+			continue
+		if before["params"] != result["params"]:
+			print("  %-8s %-6s parameters differ, not compared" % (result["scale"], result["engine"]))
+			continue
+		for stage, total in result["stages"].items():
+			if stage not in before["stages"]:
+				continue
+			then = before["stages"][stage]["seconds"]
+			now = total["seconds"]
+			print("  %-8s %-6s %-12s %10.3f %10.3f %8s" % (result["scale"], result["engine"], stage,
+				then, now, "%.2fx" % (then / now) if now > 0 else "-"))
+
+def main(args):
+	parser = argparse.ArgumentParser(prog = "colocBench.py",
+		description = "Benchmark the colocalization pipeline on synthetic images.")
+	parser.add_argument("--scales", default = "small,medium",
+		help = "comma separated scales: %s" % ", ".join(scales))
+	parser.add_argument("--engines", default = ",".join(engines),
+		help = "comma separated engines: %s (the first is the reference)" % ", ".join(engines))
+	parser.add_argument("--methods", default = None,
+		help = "threshold method of every channel, comma separated (default: Otsu)")
+	parser.add_argument("--coefficients", default = "none",
+		help = "other coefficients of the core engine, comma separated: %s or none" % ", ".join(coefficients))
+	parser.add_argument("--imagej", default = None, metavar = "JAR",
+		help = "ImageJ jar whose AutoThresholder gives the thresholds of the core engine (needs JPype)")
+	parser.add_argument("--repeat", type = int, default = 3, help = "runs of each benchmark; the fastest counts")
+	parser.add_argument("--width", type = int, help = "override the image width of the scales")
+	parser.add_argument("--height", type = int, help = "override the image height")
+	parser.add_argument("--slices", type = int, help = "override the number of slices")
+	parser.add_argument("--channels", type = int, help = "override the number of channels")
+	parser.add_argument("--bit-depth", type = int, choices = [8, 16, 32], help = "override the bit depth")
+	parser.add_argument("--cells", type = int, help = "override the number of cells")
+	parser.add_argument("--shape", choices = shapes, help = "override the ROI shape")
+	parser.add_argument("--compress", action = "store_true", help = "compress the saved cells")
+	parser.add_argument("--seed", type = int, default = 0, help = "seed of the synthetic images")
+	parser.add_argument("--output", default = None, help = "report file (default: bench-<date>.json)")
+	parser.add_argument("--compare", default = None, help = "earlier report to compare with")
+	options = parser.parse_args(args)
+	if np is None:
+		print("NumPy is not available")
+		return 2
+	overrides = [("width", options.width), ("height", options.height), ("slices", options.slices),
+		("channels", options.channels), ("bitDepth", options.bit_depth), ("cells", options.cells),
+		("shape", options.shape)]
+	methods = options.methods.split(",") if options.methods else None
+	names = [name for name in coefficients if name.lower() in options.coefficients.lower().split(",")]
+	thresholder = colocNumpy.getThreshold
+	if options.imagej is not None:
+		if jpype is None:
+			print("JPype is not available")
+			return 2
+		thresholder = ImageJThresholder(options.imagej)
+	engineNames = options.engines.split(",")
+	for name in engineNames:
+		if name not in engines:
+			parser.error("unknown engine %s" % name)
+	report = OrderedDict([("version", reportVersion), ("date", time.strftime("%Y-%m-%d %H:%M:%S")),
+		("commit", getCommit()), ("python", platform.python_version()),
+		("implementation", platform.python_implementation()), ("numpy", np.__version__),
+		("platform", platform.platform()), ("processor", platform.processor()),
+		("repeat", options.repeat), ("compress", options.compress), ("seed", options.seed),
+		("thresholds", options.imagej or "colocNumpy"), ("coefficients", names), ("results", [])])
+	workDir = tempfile.mkdtemp(prefix = "colocBench")
+	try:
+		for name in options.scales.split(","):
+			if name not in scales:
+				parser.error("unknown scale %s" % name)
+			params = OrderedDict(scales[name])
+			for key, value in overrides:
+				if value is not None:
+					params[key] = value
+			print("Running %s..." % name)
+			report["results"].extend(runScale(name, params, engineNames, methods,
+				max(1, options.repeat), workDir, options.compress, options.seed, thresholder, names))
+	finally:
+		shutil.rmtree(workDir, True)
+	printReport(report)
+	output = options.output or "bench-%s.json" % time.strftime("%Y%m%d-%H%M%S")
+	reportFile = open(output, "w")
+	try:
+		json.dump(report, reportFile, indent = 1)
+	finally:
+		reportFile.close()
+	print("Report saved to %s" % output)
+	if options.compare is not None:
+		oldFile = open(options.compare)
+		try:
+			compareReports(report, json.load(oldFile))
+		finally:
+			oldFile.close()
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,605 @@
+### Sharded batch runs of mColoc3D.py
+###
+### The images of an input directory are listed once, in a manifest saved to
+### the output directory, and split into shards. Each shard is analysed by its
+### own Fiji process - on one machine, or on several nodes that share the
+### output directory - and writes its own results table. Merging the tables
+### gives the one a single process would have written: rows follow the
+### manifest, and cells keep the numbers of their Cell_<n>-<image> files.
+###
+### Pure Python, so it runs both inside Fiji (Jython 2.7) and in plain CPython.
+### Copy this file to the jars/Lib folder of your Fiji distribution.
+###
+### Usage: python colocBatch.py run <input dir> <output dir> --imagej <ImageJ launcher>
+###            --processes <N> -- --methods None,Mean,Otsu [other mColoc3D.py options]
+###        python colocBatch.py merge <output dir>
+###        python colocBatch.py timings <output dir>
+###
+### @license Licensed under GPLv3 and CC BY 4.0
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import csv
+import json
+import errno
+import shutil
+import hashlib
+import argparse
+import subprocess
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+manifestName = "manifest.txt"
+manifestEnd = "# end"  # Last line of a complete manifest
+resultsName = "Results.csv"
+timingsName = "Timings.jsonl"
+shardPattern = re.compile(r"^Results-(\d+)-of-(\d+)\.csv$")
+timingsPattern = re.compile(r"^Timings(-\d+-of-\d+)?\.jsonl$")
+cellsSuffix = ".cells.zip"
+hashSamples = 16  # Blocks of an image file hashed besides its header (see ResultCache.getFileHash)
+hashBlock = 1 << 16
+resultsVersion = 2  # Change when the results of the same cells change, to drop cached results
+
+
+def parseShard(text):
+	### "i/N" (1-based, as given on the command line) to a 0-based (shard, shards)
+	try:
+		shard, shards = [int(part) for part in text.split("/")]
+	except ValueError:
+		raise ValueError("shard must be given as i/N, not %s" % text)
+	if shards < 1 or not 1 <= shard <= shards:
+		raise ValueError("shard %s is out of range" % text)
+	return (shard - 1, shards)
+
+def getShard(files, shard, shards):
+	### Round robin, so that every shard gets images from the whole plate
+	return files[shard::shards]
+
+def getShardFile(outputDir, shard, shards):
+	if shards == 1:
+		return os.path.join(outputDir, resultsName)
+	return os.path.join(outputDir, "Results-%i-of-%i.csv" % (shard + 1, shards))
+
+def getTimingsFile(outputDir, shard, shards):
+	if shards == 1:
+		return os.path.join(outputDir, timingsName)
+	return os.path.join(outputDir, "Timings-%i-of-%i.jsonl" % (shard + 1, shards))
+
+def getCellsFile(imageFile, series = 0):
+	### ROIs of the cells drawn on an image, saved next to it. Series after
+	### the first (0-based series > 0) have their own cells.
+	if series > 0:
+		return "%s.s%i%s" % (imageFile, series + 1, cellsSuffix)
+	return imageFile + cellsSuffix
+
+def moveFile(source, path):
+	### Rename source to path, replacing it in one step where the system
+	### can: on Windows (Jython or Python 2) path is removed first
+	replace = getattr(os, "replace", None)
+	if replace is not None:
+		replace(source, path)
+		return
+	try:
+		os.rename(source, path)
+	except OSError:
+		if not os.path.exists(path):
+			raise
+		os.remove(path)
+		os.rename(source, path)
+
+def replaceFile(path, write):
+	### Write a file next to its final name and move it in place, so that
+	### other processes never see it half written
+	tmp = "%s.%i.tmp" % (path, os.getpid())
+	write(tmp)
+	moveFile(tmp, path)
+
+def backupFile(path):
+	### Move path aside to <name>.<n>.bak, never over an earlier backup, so
+	### that a new file can be written in its place; returns the backup
+	n = 1
+	while os.path.exists("%s.%i.bak" % (path, n)):
+		n += 1
+	backup = "%s.%i.bak" % (path, n)
+	os.rename(path, backup)
+	return backup
+
+def settleSession(outputDir, sessionPath, resume):
+	### The choice made for the checkpoint of an interrupted session, saved
+	### in sessionPath: resume (True) keeps it; a new session (False) removes
+	### it and moves the results table of the old one aside (see backupFile);
+	### cancel (None) leaves both as they are. Returns whether to go on.
+	if resume is None:
+		return False
+	if not resume:
+		resultsFile = os.path.join(outputDir, resultsName)
+		if os.path.exists(resultsFile):
+			print("Results of the previous session moved to %s" % backupFile(resultsFile))
+		shutil.rmtree(sessionPath, True)
+	return True
+
+def loadManifest(outputDir, inputDir, files):
+	### The image files of this run, as listed in the manifest. The first
+	### process creates the manifest from files - only one can, as it is
+	### opened with O_EXCL - and removes the results of the shards of an
+	### earlier run; all others read it, so a shard means the same images
+	### even if the input directory changes meanwhile.
+	path = os.path.join(outputDir, manifestName)
+	try:
+		manifest = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+	except OSError as e:
+		if e.errno != errno.EEXIST:
+			raise
+		manifest = None
+	if manifest is not None:
+		try:
+			removeShardFiles(outputDir)
+			names = [os.path.basename(imageFile) for imageFile in files] + [manifestEnd]
+			os.write(manifest, "".join([name + "\n" for name in names]).encode("utf-8"))
+		finally:
+			os.close(manifest)
+	return [os.path.join(inputDir, name) for name in readManifest(outputDir)]
+
+def readManifest(outputDir, timeout = 60):
+	### Image names of the manifest. A manifest without its end line is
+	### still being written by another process, unless it was last modified
+	### more than timeout seconds ago (manifests of earlier versions).
+	path = os.path.join(outputDir, manifestName)
+	while True:
+		manifest = open(path)
+		try:
+			lines = [line.rstrip("\r\n") for line in manifest if line.strip()]
+		finally:
+			manifest.close()
+		if manifestEnd in lines or time.time() - os.path.getmtime(path) > timeout:
+			return [line for line in lines if not line.startswith("#")]
+		time.sleep(0.5)
+
+def openCsv(path, mode):
+	if sys.version_info[0] < 3:
+		return open(path, mode + "b")
+	return open(path, mode, newline = "")
+
+def formatValue(value):
+	if isinstance(value, float):
+		return repr(value)
+	return str(value)
+
+def parseValue(text):
+	### Number in a table cell, as written by writeTable
+	for parse in (int, float):
+		try:
+			return parse(text)
+		except ValueError:
+			pass
+	return text
+
+def writeTable(path, rows):
+	### rows are dicts of column -> value; columns keep the order of first use
+	columns = []
+	for row in rows:
+		for column in row:
+			if column not in columns:
+				columns.append(column)
+	def write(tmp):
+		table = openCsv(tmp, "w")
+		try:
+			writer = csv.writer(table)
+			writer.writerow(columns)
+			for row in rows:
+				writer.writerow([formatValue(row[c]) if c in row else "" for c in columns])
+		finally:
+			table.close()
+	replaceFile(path, write)
+
+def readTable(path):
+	table = openCsv(path, "r")
+	try:
+		reader = csv.reader(table)
+		columns = next(reader, None)
+		if columns is None:
+			return []
+		return [OrderedDict([(c, v) for c, v in zip(columns, values) if v != ""]) for values in reader]
+	finally:
+		table.close()
+
+class ResultsWriter(object):
+
+	### Results table written as the rows come, so that a running batch can
+	### be followed and rows are not kept in memory. The file is flushed at
+	### most every flushInterval seconds. With partial, rows go to <path>.part,
+	### which becomes <path> only when the writer is closed. Rows can also be
+	### shown in a ResultsTable (table).
+
+	def __init__(self, path, append = False, partial = False, table = None, flushInterval = 5.0):
+		self.path = path
+		self.partial = partial
+		self.table = table
+		self.flushInterval = flushInterval
+		self.lock = Lock()
+		self.columns = None
+		target = path + ".part" if partial else path
+		if append and os.path.exists(target):
+			header = openCsv(target, "r")
+			try:
+				self.columns = next(csv.reader(header), None)
+			finally:
+				header.close()
+			self.file = openCsv(target, "a")
+		else:
+			self.file = openCsv(target, "w")
+		self.writer = csv.writer(self.file)
+		self.flushed = time.time()
+
+	def write(self, row):
+		### row is a dict of column -> value; the first row sets the columns
+		with self.lock:
+			if not self.columns:
+				self.columns = list(row.keys())
+				self.writer.writerow(self.columns)
+			for column in row:
+				if column not in self.columns:
+					raise ValueError("column %s is not in the results table" % column)
+			self.writer.writerow([formatValue(row[c]) if c in row else "" for c in self.columns])
+			if time.time() - self.flushed >= self.flushInterval:
+				self.file.flush()
+				self.flushed = time.time()
+		if self.table is not None:
+			self.table.incrementCounter()
+			n = self.table.getCounter() - 1
+			for column, value in row.items():
+				self.table.setValue(column, n, value)
+
+	def flush(self):
+		with self.lock:
+			if self.file is not None:
+				self.file.flush()
+				self.flushed = time.time()
+
+	def close(self):
+		with self.lock:
+			if self.file is None:
+				return
+			self.file.close()
+			self.file = None
+			if self.partial:
+				moveFile(self.path + ".part", self.path)
+
+
+def listShardFiles(outputDir):
+	shards = {}
+	for name in os.listdir(outputDir):
+		match = shardPattern.match(name)
+		if match:
+			shards.setdefault(int(match.group(2)), {})[int(match.group(1)) - 1] = \
+				os.path.join(outputDir, name)
+	return shards
+
+def removeShardFiles(outputDir):
+	### Results of the shards of an earlier run, finished or not
+	for name in os.listdir(outputDir):
+		if shardPattern.match(name[:-len(".part")] if name.endswith(".part") else name):
+			os.remove(os.path.join(outputDir, name))
+
+def isComplete(outputDir, shards):
+	return len(listShardFiles(outputDir).get(shards, {})) == shards
+
+def mergeTables(outputDir, shards = None):
+	### Merge the shard tables into Results.csv, in manifest, series, cell and
+	### frame order. Returns the number of rows.
+	found = listShardFiles(outputDir)
+	if shards is None:
+		if len(found) != 1:
+			raise ValueError("results of %i different shardings in %s" % (len(found), outputDir))
+		shards = list(found.keys())[0]
+	files = found.get(shards, {})
+	missing = [str(i + 1) for i in range(shards) if i not in files]
+	if missing:
+		raise ValueError("missing results of shards %s of %i" % (", ".join(missing), shards))
+	order = dict([(name, i) for i, name in enumerate(readManifest(outputDir))])
+	rows = []
+	for i in range(shards):
+		rows.extend(readTable(files[i]))
+	rows.sort(key = lambda row: (order.get(row["Image"], len(order)), int(row.get("Series", 1)),
+		int(row["Cell"]), int(row.get("Frame", 1))))
+	writeTable(os.path.join(outputDir, resultsName), rows)
+	return len(rows)
+
+
+class ResultCache(object):
+
+	### Content addressed cache of cell results, in .cache in the output
+	### directory. A cell is looked up by the fingerprint of the image file
+	### (see getFileHash), its ROIs, the analysis settings and the script
+	### version, so a re-run only recomputes the cells of changed images, ROIs
+	### or settings. Each entry keeps the results row and the output files
+	### written for the cell; it is used only while these files still exist.
+
+	def __init__(self, outputDir, contentHash = False):
+		self.cacheDir = os.path.join(outputDir, ".cache")
+		self.contentHash = contentHash
+		self.hashesFile = os.path.join(self.cacheDir, "files.json")
+		self.lock = Lock()
+		self.hashes = {}
+		if os.path.exists(self.hashesFile):
+			try:
+				hashes = open(self.hashesFile)
+				try:
+					self.hashes = json.load(hashes)
+				finally:
+					hashes.close()
+			except ValueError:
+				self.hashes = {}
+
+	def getFileHash(self, path):
+		### Fingerprint of the file: its size, modification time and the
+		### SHA-1 of its header and of hashSamples blocks spread over the rest,
+		### so that large images are not read whole. With contentHash, the
+		### SHA-1 of the whole content instead, which also recognizes copied or
+		### touched files; it is remembered along with the file size and
+		### modification time, so unchanged files are not read again.
+		path = os.path.abspath(path)
+		stat = os.stat(path)
+		stamp = [stat.st_size, stat.st_mtime]
+		if not self.contentHash:
+			return "%i:%r:%s" % (stat.st_size, stat.st_mtime, self.getSampledHash(path, stat.st_size))
+		with self.lock:
+			known = self.hashes.get(path)
+			if known is not None and known[:2] == stamp:
+				return known[2]
+		sha = hashlib.sha1()
+		data = open(path, "rb")
+		try:
+			block = data.read(1 << 20)
+			while block:
+				sha.update(block)
+				block = data.read(1 << 20)
+		finally:
+			data.close()
+		digest = sha.hexdigest()
+		with self.lock:
+			self.hashes[path] = stamp + [digest]
+			self.saveHashes()
+		return digest
+
+	def getSampledHash(self, path, size):
+		### SHA-1 of the first block of the file and of hashSamples blocks
+		### evenly spaced after it, the last one ending the file
+		sha = hashlib.sha1()
+		data = open(path, "rb")
+		try:
+			sha.update(data.read(hashBlock))
+			if size > hashBlock:
+				for k in range(1, hashSamples + 1):
+					data.seek((size - hashBlock) * k // hashSamples)
+					sha.update(data.read(hashBlock))
+		finally:
+			data.close()
+		return sha.hexdigest()
+
+	def saveHashes(self):
+		if not os.path.isdir(self.cacheDir):
+			os.makedirs(self.cacheDir)
+		def write(tmp):
+			hashes = open(tmp, "w")
+			try:
+				json.dump(self.hashes, hashes)
+			finally:
+				hashes.close()
+		replaceFile(self.hashesFile, write)
+
+	def getKey(self, settings, imageHash, name, cell, rois, series = 0, frame = 1):
+		### rois is the serialized ROI data of the cell (bytes); series is the
+		### 0-based series of the image file and frame the 1-based time point
+		sha = hashlib.sha1()
+		sha.update(json.dumps([settings, imageHash, name, series, cell, frame],
+			sort_keys = True).encode("utf-8"))
+		sha.update(rois)
+		return sha.hexdigest()
+
+	def getPath(self, key):
+		return os.path.join(self.cacheDir, key[:2], key + ".json")
+
+	def get(self, key):
+		### Cached results row, or None
+		path = self.getPath(key)
+		if not os.path.exists(path):
+			return None
+		data = open(path)
+		try:
+			try:
+				entry = json.load(data, object_pairs_hook = OrderedDict)
+			except ValueError:
+				return None
+		finally:
+			data.close()
+		for output in entry["files"]:
+			if not os.path.exists(output):
+				return None
+		return entry["row"]
+
+	def put(self, key, row, files):
+		path = self.getPath(key)
+		if not os.path.isdir(os.path.dirname(path)):
+			try:
+				os.makedirs(os.path.dirname(path))
+			except OSError:
+				if not os.path.isdir(os.path.dirname(path)):
+					raise
+		def write(tmp):
+			entry = open(tmp, "w")
+			try:
+				json.dump({"row": row, "files": files}, entry)
+			finally:
+				entry.close()
+		replaceFile(path, write)
+
+
+class Stage(object):
+
+	### One timed run of a pipeline stage, used as a with block. Voxels can
+	### be set inside the block, once they are known.
+
+	def __init__(self, timer, name, image, cell, voxels):
+		self.timer = timer
+		self.name = name
+		self.image = image
+		self.cell = cell
+		self.voxels = voxels
+		self.start = None
+		self.heap = 0
+
+	def __enter__(self):
+		self.heap = self.timer.getHeap()
+		self.start = time.time()
+		return self
+
+	def __exit__(self, kind, value, traceback):
+		seconds = time.time() - self.start
+		heap = self.timer.getHeap()
+		self.timer.record(self.name, seconds, self.image, self.cell, self.voxels,
+			heap, heap - self.heap, kind is None)
+		return False
+
+
+class StageTimer(object):
+
+	### Wall time, voxels and heap use of each pipeline stage, per image and
+	### per cell (cell is None for whole image stages). Every stage is written
+	### as one JSON line to path (appended, so resumed runs keep the earlier
+	### lines) and added to the summary of this run. memory returns the used
+	### heap in bytes; without it, heap use is not recorded.
+
+	def __init__(self, path = None, memory = None):
+		self.path = path
+		self.memory = memory
+		self.lock = Lock()
+		self.records = []
+		self.file = open(path, "a") if path is not None else None
+
+	def getHeap(self):
+		if self.memory is None:
+			return 0
+		return self.memory()
+
+	def stage(self, name, image = None, cell = None, voxels = 0):
+		return Stage(self, name, image, cell, voxels)
+
+	def record(self, name, seconds, image = None, cell = None, voxels = 0, heap = 0, delta = 0, ok = True):
+		record = OrderedDict([("stage", name), ("image", image), ("cell", cell),
+			("seconds", seconds), ("voxels", voxels), ("heap", heap), ("heapDelta", delta),
+			("ok", ok), ("time", time.time())])
+		with self.lock:
+			self.records.append(record)
+			if self.file is not None:
+				self.file.write(json.dumps(record) + "\n")
+				self.file.flush()
+
+	def getSummary(self):
+		with self.lock:
+			return summarizeTimings(self.records)
+
+	def close(self):
+		with self.lock:
+			if self.file is not None:
+				self.file.close()
+				self.file = None
+
+
+def readTimings(outputDir):
+	### Stage records of all timing logs of an output directory (shards too)
+	records = []
+	for name in sorted(os.listdir(outputDir)):
+		if timingsPattern.match(name):
+			log = open(os.path.join(outputDir, name))
+			try:
+				for line in log:
+					if line.strip():
+						try:
+							records.append(json.loads(line))
+						except ValueError:
+							### Last line of a process that was killed
+							pass
+			finally:
+				log.close()
+	return records
+
+def summarizeTimings(records):
+	### Table of the stages in order of first use: runs, total and mean wall
+	### time, throughput and the largest used heap, as lines of text
+	stages = OrderedDict()
+	images = set()
+	cells = set()
+	for record in records:
+		stage = stages.setdefault(record["stage"], [0, 0.0, 0, 0])
+		stage[0] += 1
+		stage[1] += record["seconds"]
+		stage[2] += record["voxels"]
+		stage[3] = max(stage[3], record["heap"])
+		if record["image"] is not None:
+			images.add(record["image"])
+			if record["cell"] is not None:
+				cells.add((record["image"], record["cell"]))
+	lines = ["%-12s %6s %10s %10s %12s %10s" % ("Stage", "Runs", "Total s", "Mean ms", "Mvoxel/s", "Heap MB")]
+	for name, (runs, seconds, voxels, heap) in stages.items():
+		rate = "%.1f" % (voxels / seconds / 1e6) if voxels and seconds > 0 else "-"
+		lines.append("%-12s %6i %10.2f %10.1f %12s %10.0f" % (name, runs, seconds,
+			1000.0 * seconds / runs, rate, heap / float(1 << 20)))
+	lines.append("%i images, %i cells" % (len(images), len(cells)))
+	return lines
+
+
+def runShards(imagej, script, inputDir, outputDir, processes, options):
+	### Run the shards as local Fiji processes and merge their results
+	workers = []
+	for shard in range(processes):
+		command = [imagej, "--headless", "--jython", script, inputDir, outputDir,
+			"--shard", "%i/%i" % (shard + 1, processes)] + list(options)
+		workers.append(subprocess.Popen(command))
+	failed = [i + 1 for i, worker in enumerate(workers) if worker.wait() != 0]
+	if failed:
+		print("Shards %s failed" % ", ".join([str(i) for i in failed]))
+		return 1
+	print("Merged %i cells" % mergeTables(outputDir, processes))
+	return 0
+
+def main(args):
+	parser = argparse.ArgumentParser(prog = "colocBatch.py",
+		description = "Run mColoc3D.py on shards of an input directory and merge the results.")
+	commands = parser.add_subparsers(dest = "command")
+	run = commands.add_parser("run", help = "analyse the shards in local Fiji processes")
+	run.add_argument("inputDir", help = "directory with images and their cells files")
+	run.add_argument("outputDir", help = "directory to save the results to")
+	run.add_argument("--imagej", required = True, help = "ImageJ launcher, e.g. ImageJ-linux64")
+	run.add_argument("--processes", type = int, default = 2, help = "number of Fiji processes")
+	run.add_argument("--script", default = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+		"mColoc3D.py"), help = "path to mColoc3D.py")
+	run.add_argument("options", nargs = argparse.REMAINDER,
+		help = "mColoc3D.py options, after --")
+	merge = commands.add_parser("merge", help = "merge the shard results of an output directory")
+	merge.add_argument("outputDir", help = "output directory of the shards")
+	timings = commands.add_parser("timings", help = "summarize the stage timings of an output directory")
+	timings.add_argument("outputDir", help = "output directory of a run")
+	options = parser.parse_args(args)
+	if options.command == "run":
+		extra = [option for option in options.options if option != "--"]
+		return runShards(options.imagej, options.script, options.inputDir,
+			os.path.join(options.outputDir, ""), max(1, options.processes), extra)
+	if options.command == "merge":
+		print("Merged %i cells" % mergeTables(options.outputDir))
+		return 0
+	if options.command == "timings":
+		for line in summarizeTimings(readTimings(options.outputDir)):
+			print(line)
+		return 0
+	parser.print_help()
+	return 2
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,535 @@
+### Colocalization engines shared by mColoc3D.py and mcoloc.py
+###
+### Pure Python, so it runs both inside Fiji (Jython 2.7) and in plain CPython.
+### Copy this file to the jars/Lib folder of your Fiji distribution.
+###
+### @license Licensed under GPLv3 and CC BY 4.0
+
+import math
+import random
+from collections import OrderedDict
+from operator import mul
+
+try:
+	from itertools import izip as zip
+except ImportError:
+	pass
+
+
+thresholdMethods = ["Default", "Huang", "Intermodes", "IsoData", "Li", "MaxEntropy", "Mean",
+	"MinError(I)", "Minimum", "Moments", "Otsu", "Percentile", "RenyiEntropy", "Shanbhag",
+	"Triangle", "Yen"]
+coefficients = ["Pearson", "Spearman", "ICQ", "Overlap"]
+
+
+def getAutoThreshold(histogram, method, thresholder):
+	### Same as Auto_Threshold.exec: the method only sees the histogram
+	### between its lowest and highest non-empty bins. thresholder(method,
+	### data) runs the method itself on such a bracketed histogram.
+	bins = [i for i in range(len(histogram)) if histogram[i]]
+	if not bins:
+		return 0
+	minbin = bins[0]
+	data = list(histogram[minbin:bins[-1] + 1])
+	if len(data) < 2:
+		return minbin
+	return thresholder(method, data) + minbin
+
+
+def getSaturationLimits(histogram, saturated):
+	### Display range of ContrastEnhancer.stretchHistogram: the lowest and
+	### highest bins with saturated percent of the counts beyond them (half
+	### at each end)
+	threshold = int(sum(histogram) * saturated / 200.0)
+	low, high = 0, len(histogram) - 1
+	count = 0
+	for i in range(len(histogram)):
+		count += histogram[i]
+		if count > threshold:
+			low = i
+			break
+	count = 0
+	for i in range(len(histogram) - 1, -1, -1):
+		count += histogram[i]
+		if count > threshold:
+			high = i
+			break
+	if high <= low:
+		return (0, len(histogram) - 1)
+	return (low, high)
+
+
+def grow(data, size):
+	### Extends the list data with zeros up to size items, returns it
+	if len(data) < size:
+		data.extend([0] * (size - len(data)))
+	return data
+
+def pearson(entries):
+	### Pearson's r of (a, b, count) entries; NaN without variance
+	return getPearson(sum([c for a, b, c in entries]),
+		sum([a * c for a, b, c in entries]), sum([b * c for a, b, c in entries]),
+		sum([a * a * c for a, b, c in entries]), sum([b * b * c for a, b, c in entries]),
+		sum([a * b * c for a, b, c in entries]))
+
+def getPearson(n, sumA, sumB, sumAA, sumBB, sumAB):
+	### Pearson's r from the sums of n pairs of values; NaN without variance
+	n = float(n)
+	if not n:
+		return float('nan')
+	covariance = sumAB - sumA * sumB / n
+	varianceA = sumAA - sumA * sumA / n
+	varianceB = sumBB - sumB * sumB / n
+	if varianceA <= 0 or varianceB <= 0:
+		return float('nan')
+	return covariance / math.sqrt(varianceA * varianceB)
+
+def getOverlap(sumAB, sumAA, sumBB):
+	### Manders' overlap coefficient R
+	return ratio(sumAB, math.sqrt(sumAA * sumBB))
+
+def getRanks(entries, axis):
+	### Average rank (1-based) of every intensity of one axis of a joint
+	### histogram, as ((a, b), count) entries
+	counts = {}
+	for key, n in entries:
+		counts[key[axis]] = counts.get(key[axis], 0) + n
+	ranks = {}
+	below = 0
+	for v in sorted(counts):
+		ranks[v] = below + (counts[v] + 1) / 2.0
+		below += counts[v]
+	return ranks
+
+
+class MandersResult(object):
+
+	def __init__(self, m1, m2):
+		self.m1 = m1
+		self.m2 = m2
+
+
+def ratio(numerator, denominator):
+	### Same as the double division in MandersColocalization (0/0 is NaN)
+	if denominator == 0:
+		return float('nan')
+	return numerator / denominator
+
+
+class ColocIndex(object):
+
+	### Intensity index of one cell, built in a walk over its voxels. For
+	### every channel it keeps the intensity histogram and the total
+	### intensity; for every channel pair (A, B) it keeps the sum of A per
+	### intensity of B and the sum of B per intensity of A, which is the
+	### joint histogram collapsed along each axis. Manders coefficients for
+	### any pair of thresholds are then read from cumulative sums, without
+	### going back to the voxels:
+	###
+	### M1 = sum(A | B > thrB) / sum(A),   M2 = sum(B | A > thrA) / sum(B)
+	###
+	### Raw coefficients are the same with both thresholds at 0. Channels
+	### use 1-based numbers, as in MandersPlugin.pairs; channels that are in
+	### no pair can be added to get their histograms too.
+	###
+	### Histograms and sums are dense lists. Histogram bin int(v) counts the
+	### voxels of intensity v > 0; the sums are binned by ceil(v) - 1, so that
+	### v is above the integer threshold t when its bin is >= t, also for
+	### fractional (32-bit) intensities.
+	###
+	### The other colocalization coefficients (see getCoefficients) need
+	### more. With moments, the index also sums the squares of every channel
+	### and the products of every pair, for Pearson's r and the overlap
+	### coefficient; once the thresholds are known, addSums also sums the
+	### voxels above both thresholds of each pair. With icq, it counts the
+	### voxels of each pair on the same side of both channel means. With
+	### joint, it keeps the joint histogram of every pair over the voxels of
+	### the mask, for Spearman's rho. It can grow as large as the cell.
+	###
+	### Negative intensities count as zeros in all sums.
+
+	def __init__(self, pairs, channels = (), joint = False, moments = False, icq = False):
+		self.pairs = [tuple(pair) for pair in pairs]
+		self.channels = sorted(set([c for pair in self.pairs for c in pair] + list(channels)))
+		self.size = 0
+		self.volume = 0
+		self.histograms = dict([(c, []) for c in self.channels])
+		self.totals = dict([(c, 0.0) for c in self.channels])
+		self.conditional = dict([(pair, ([], [])) for pair in self.pairs])
+		self.joint = dict([(pair, {}) for pair in self.pairs]) if joint else None
+		self.squares = dict([(c, 0.0) for c in self.channels]) if moments else None
+		self.products = dict([(pair, 0.0) for pair in self.pairs]) if moments else None
+		### Per pair: count, sum(A), sum(B), sum(A^2), sum(B^2), sum(AB)
+		self.above = dict([(pair, [0.0] * 6) for pair in self.pairs]) if moments else None
+		self.positive = dict([(pair, 0) for pair in self.pairs]) if icq else None
+		self.tails = {}
+
+	@classmethod
+	def forCoefficients(cls, pairs, channels = (), names = ()):
+		### Index that collects what the coefficients of names need
+		return cls(pairs, channels, joint = "Spearman" in names,
+			moments = "Pearson" in names or "Overlap" in names, icq = "ICQ" in names)
+
+	def add(self, planes, runs = None, size = None):
+		### planes[c - 1] holds the pixel values of channel c for one slice;
+		### with runs, only voxels inside the mask are visited and the rest
+		### of the plane (or of size voxels) counts as zeros, as it does in
+		### the zero-filled crops. Same as addValues and addSums of the slice;
+		### the ICQ needs the histograms of all slices first, so an index with
+		### icq is made with these instead.
+		self.addValues(planes, runs, size)
+		self.addSums(planes, runs)
+
+	def addValues(self, planes, runs = None, size = None):
+		### Only the histograms and totals of one slice (as in add), for the
+		### thresholds; the sums of the pairs come from addSums
+		channels = self.channels
+		if size is None:
+			size = len(planes[channels[0] - 1])
+		if runs is None:
+			runs = [(0, len(planes[channels[0] - 1]))]
+		for start, end in runs:
+			self.volume += end - start
+			for c in channels:
+				values = planes[c - 1][start:end]
+				floors = [int(v) if v > 0 else 0 for v in values]
+				histogram = grow(self.histograms[c], max(floors) + 1)
+				for f in floors:
+					histogram[f] += 1
+				positive = [v for v in values if v > 0]
+				histogram[0] -= len(floors) - len(positive)
+				self.totals[c] += float(sum(positive))
+				if self.squares is not None:
+					self.squares[c] += float(sum([v * v for v in positive]))
+		self.size += size
+
+	def addSums(self, planes, runs = None, thresholds = None):
+		### Only the sums of every pair over one slice (as in add), for an
+		### index whose histograms are made by addValues or addHistograms.
+		### One walk over the voxels serves all pairs and sums all they need:
+		### the Manders sums, the products, the joint histograms and, with
+		### thresholds[c - 1] for channel c, the voxels above both thresholds.
+		### The ICQ counts compare the voxels with the channel means of the
+		### histograms, so these must all be added first.
+		channels = self.channels
+		if runs is None:
+			runs = [(0, len(planes[channels[0] - 1]))]
+		columns = dict([(c, k) for k, c in enumerate(channels)])
+		pairs = []
+		for pair in self.pairs:
+			a, b = pair
+			above = None
+			if self.above is not None and thresholds is not None:
+				above = (self.above[pair], thresholds[a - 1], thresholds[b - 1])
+			means = None
+			if self.positive is not None:
+				means = (ratio(self.totals[a], self.volume), ratio(self.totals[b], self.volume))
+			pairs.append((columns[a], columns[b], self.conditional[pair][0], self.conditional[pair][1],
+				above, means, self.joint[pair] if self.joint is not None else None))
+		products = [0.0] * len(pairs)
+		positive = [0] * len(pairs)
+		for start, end in runs:
+			values = [[v if v > 0 else 0.0 for v in planes[c - 1][start:end]] for c in channels]
+			### Sum bins, -1 for the voxels that are not above 0
+			bins = [[int(v) - (int(v) == v) if v > 0 else -1 for v in column] for column in values]
+			for a, b, sumsA, sumsB, above, means, joint in pairs:
+				grow(sumsA, max(bins[b]) + 1)
+				grow(sumsB, max(bins[a]) + 1)
+			for voxel, keys in zip(zip(*values), zip(*bins)):
+				for i, (a, b, sumsA, sumsB, above, means, joint) in enumerate(pairs):
+					va, vb = voxel[a], voxel[b]
+					ka, kb = keys[a], keys[b]
+					if ka >= 0 and kb >= 0:
+						sumsA[kb] += va
+						sumsB[ka] += vb
+						products[i] += va * vb
+					if above is not None and va > above[1] and vb > above[2]:
+						sums = above[0]
+						sums[0] += 1
+						sums[1] += va
+						sums[2] += vb
+						sums[3] += va * va
+						sums[4] += vb * vb
+						sums[5] += va * vb
+					if means is not None and (va - means[0]) * (vb - means[1]) > 0:
+						positive[i] += 1
+					if joint is not None:
+						joint[(va, vb)] = joint.get((va, vb), 0) + 1
+		for i, pair in enumerate(self.pairs):
+			if self.products is not None:
+				self.products[pair] += float(products[i])
+			if self.positive is not None:
+				self.positive[pair] += positive[i]
+		self.tails = {}
+
+	def addJoint(self, planes, runs = None):
+		### Only the joint histograms, of the voxels of planes in runs (as
+		### in add), for an index whose other sums are made elsewhere
+		if runs is None:
+			runs = [(0, len(planes[self.channels[0] - 1]))]
+		for a, b in self.pairs:
+			joint = self.joint[(a, b)]
+			for start, end in runs:
+				for key in zip(planes[a - 1][start:end], planes[b - 1][start:end]):
+					joint[key] = joint.get(key, 0) + 1
+
+	def addHistograms(self, histograms, size, volume = None):
+		### Integer histograms of size voxels of one slice, made elsewhere
+		### (e.g. by ImageJ), with histograms[c - 1] for channel c; bin 0 is
+		### left to the zeros. Keep them short: every bin is visited. volume
+		### is the number of these voxels inside the mask, size by default.
+		for c in self.channels:
+			histogram = histograms[c - 1]
+			data = grow(self.histograms[c], len(histogram))
+			for v in range(1, len(histogram)):
+				n = histogram[v]
+				if n:
+					data[v] += n
+					self.totals[c] += float(v * n)
+					if self.squares is not None:
+						self.squares[c] += float(v * v * n)
+		self.size += size
+		self.volume += size if volume is None else volume
+
+	def getHistogram(self, c, bins = None):
+		### Dense histogram of channel c; index is the (integer) intensity
+		histogram = self.histograms[c]
+		top = len(histogram) - 1
+		while top > 0 and not histogram[top]:
+			top -= 1
+		if bins is None:
+			bins = max(top, 0) + 1
+		data = list(histogram[:bins]) + [0] * (bins - len(histogram))
+		data[bins - 1] += sum(histogram[bins:])
+		data[0] += self.size - sum(histogram)
+		return data
+
+	def getTail(self, sums):
+		### tail[t] is the sum of all voxels with a bin >= t
+		key = id(sums)
+		if key not in self.tails:
+			tail = list(sums) + [0.0]
+			for t in range(len(sums) - 1, -1, -1):
+				tail[t] += tail[t + 1]
+			self.tails[key] = tail
+		return self.tails[key]
+
+	def getManders(self, chA, chB, thrA = 0, thrB = 0):
+		sumsA, sumsB = self.conditional[(chA, chB)]
+		tailA = self.getTail(sumsA)
+		tailB = self.getTail(sumsB)
+		a = max(int(thrB), 0)
+		b = max(int(thrA), 0)
+		m1 = tailA[a] if a < len(tailA) else 0.0
+		m2 = tailB[b] if b < len(tailB) else 0.0
+		return MandersResult(ratio(m1, self.totals[chA]), ratio(m2, self.totals[chB]))
+
+	def getCoefficients(self, chA, chB, names = coefficients):
+		### The coefficients of names (see coefficients) over the voxels of
+		### the mask, from an index made by forCoefficients. Pearson's r is
+		### also given over the voxels above both thresholds, as in Coloc 2,
+		### from the sums of addSums with thresholds; Spearman's rho uses average ranks for
+		### ties; ICQ is Li's intensity correlation quotient and Overlap
+		### Manders' overlap coefficient R. Without joint histograms,
+		### Spearman's rho is NaN.
+		pair = (chA, chB)
+		entries = list(self.joint[pair].items()) if self.joint is not None else []
+		values = OrderedDict()
+		if "Pearson" in names:
+			values["Pearson r"] = getPearson(self.volume, self.totals[chA], self.totals[chB],
+				self.squares[chA], self.squares[chB], self.products[pair])
+			values["Pearson r thrd"] = getPearson(*self.above[pair])
+		if "Spearman" in names:
+			ranksA = getRanks(entries, 0)
+			ranksB = getRanks(entries, 1)
+			values["Spearman rho"] = pearson([(ranksA[a], ranksB[b], n) for (a, b), n in entries])
+		if "ICQ" in names:
+			values["ICQ"] = ratio(float(self.positive[pair]), self.volume) - 0.5
+		if "Overlap" in names:
+			values["Overlap"] = getOverlap(self.products[pair], self.squares[chA], self.squares[chB])
+		return values
+
+	def toDict(self):
+		### JSON friendly copy of the index, for saving and caching; the sums
+		### of the other coefficients are left out. Sums are saved at the
+		### intensity v = bin + 1.
+		def items(data, offset):
+			return [[v + offset, n] for v, n in enumerate(data) if n]
+		return {
+			"pairs": [list(pair) for pair in self.pairs],
+			"channels": self.channels,
+			"size": self.size,
+			"histograms": [[c, items(self.histograms[c], 0)] for c in self.channels],
+			"totals": [[c, self.totals[c]] for c in self.channels],
+			"conditional": [[list(pair), items(self.conditional[pair][0], 1),
+				items(self.conditional[pair][1], 1)] for pair in self.pairs]
+		}
+
+	@classmethod
+	def fromDict(cls, data):
+		index = cls(data["pairs"], data.get("channels", ()))
+		index.size = data["size"]
+		for c, histogram in data["histograms"]:
+			for v, n in histogram:
+				grow(index.histograms[c], int(v) + 1)[int(v)] += n
+		for c, total in data["totals"]:
+			index.totals[c] = total
+		for pair, sumsA, sumsB in data["conditional"]:
+			for sums, items in zip(index.conditional[tuple(pair)], [sumsA, sumsB]):
+				for v, s in items:
+					k = int(math.ceil(v)) - 1
+					if k >= 0:
+						grow(sums, k + 1)[k] += s
+		return index
+
+
+class CellMask(object):
+
+	### Run-length mask of a cell over its crop bounding box, rasterized once
+	### from the slice ROIs. Runs are (start, end) offsets into a cropped
+	### plane, row by row; slices without a ROI are not part of the cell.
+
+	def __init__(self, x, y, width, height):
+		self.x = x
+		self.y = y
+		self.width = width
+		self.height = height
+		self.slices = []
+
+	def getRoiRuns(self, pixels, x, y, width, height):
+		### pixels is the ROI mask over its bounds (x, y, width, height) in
+		### image coordinates, or None for a rectangle
+		runs = []
+		left = max(x, self.x)
+		right = min(x + width, self.x + self.width)
+		for row in range(max(y, self.y), min(y + height, self.y + self.height)):
+			offset = (row - self.y) * self.width - self.x
+			if pixels is None:
+				runs.append((offset + left, offset + right))
+				continue
+			start = None
+			for col in range(left, right):
+				if pixels[(row - y) * width + col - x]:
+					if start is None:
+						start = col
+				elif start is not None:
+					runs.append((offset + start, offset + col))
+					start = None
+			if start is not None:
+				runs.append((offset + start, offset + right))
+		return runs
+
+	def addSlice(self, z, runs):
+		self.slices.append((z, runs))
+
+	def getRuns(self, z):
+		for sz, runs in self.slices:
+			if sz == z:
+				return runs
+		return None
+
+	def getVolume(self):
+		return sum([end - start for z, runs in self.slices for start, end in runs])
+
+
+class CostesTest(object):
+
+	### Costes randomization test of one channel pair of a cell (Costes et al.
+	### 2004). The crop is tiled into blocks of the size of the PSF (in
+	### voxels); blocks entirely inside the cell mask are kept. Each
+	### randomization shuffles the blocks of channel A among themselves and
+	### recomputes, over the kept voxels, Pearson's r and the thresholded
+	### M1 and M2. The p-value of each is the fraction of randomizations
+	### (plus the observed one) that reach the observed value, so that small
+	### values mean colocalization above chance.
+	###
+	### Randomization k uses its own generator, seeded from seed and k, so
+	### the numbers do not depend on how the randomizations are split
+	### between workers (see run).
+
+	def __init__(self, planesA, planesB, width, height, slices, block, thrA = 0, thrB = 0, seed = 0):
+		### planesA[k] and planesB[k] hold the cropped plane of slices[k],
+		### (z, runs) as in CellMask.slices; block is (x, y, z) in voxels
+		self.seed = seed
+		bx, by, bz = [max(1, int(b)) for b in block]
+		inside = []
+		for z, runs in slices:
+			plane = [False] * (width * height)
+			for start, end in runs:
+				plane[start:end] = [True] * (end - start)
+			inside.append(plane)
+		self.blocksA = []
+		self.blocksB = []
+		for z0 in range(0, len(slices) - bz + 1, bz):
+			for y0 in range(0, height - by + 1, by):
+				for x0 in range(0, width - bx + 1, bx):
+					a, b, keep = [], [], True
+					for k in range(z0, z0 + bz):
+						for y in range(y0, y0 + by):
+							start = y * width + x0
+							if not all(inside[k][start:start + bx]):
+								keep = False
+								break
+							a.extend(planesA[k][start:start + bx])
+							b.extend(planesB[k][start:start + bx])
+						if not keep:
+							break
+					if keep:
+						self.blocksA.append([float(v) for v in a])
+						self.blocksB.append([float(v) for v in b])
+		self.aboveA = [[1.0 if v > thrA else 0.0 for v in a] for a in self.blocksA]
+		self.aboveB = [[1.0 if v > thrB else 0.0 for v in b] for b in self.blocksB]
+		values = [v for a in self.blocksA for v in a]
+		self.count = len(values)
+		self.sumA = sum(values)
+		self.sumAA = sum([v * v for v in values])
+		values = [v for b in self.blocksB for v in b]
+		self.sumB = sum(values)
+		self.sumBB = sum([v * v for v in values])
+		self.observed = self.getStatistics(range(len(self.blocksA)))
+
+	def isValid(self):
+		return len(self.blocksA) > 1
+
+	def getStatistics(self, order):
+		### (r, M1, M2) with block order[p] of A in place of block p
+		sumAB = m1 = m2 = 0.0
+		for p, q in enumerate(order):
+			a = self.blocksA[q]
+			b = self.blocksB[p]
+			sumAB += sum(map(mul, a, b))
+			m1 += sum(map(mul, a, self.aboveB[p]))
+			m2 += sum(map(mul, self.aboveA[q], b))
+		n = self.count
+		covariance = sumAB - self.sumA * self.sumB / n if n else 0.0
+		variance = (self.sumAA - self.sumA * self.sumA / n) * (self.sumBB - self.sumB * self.sumB / n) if n else 0.0
+		r = covariance / math.sqrt(variance) if variance > 0 else float('nan')
+		return (r, ratio(m1, self.sumA), ratio(m2, self.sumB))
+
+	def shuffle(self, k):
+		### Fisher-Yates with random(), which gives the same numbers in
+		### Jython and CPython 2 and 3
+		generator = random.Random(self.seed * 1000003 + k)
+		order = list(range(len(self.blocksA)))
+		for i in range(len(order) - 1, 0, -1):
+			j = int(generator.random() * (i + 1))
+			order[i], order[j] = order[j], order[i]
+		return order
+
+	def run(self, start, stop):
+		### Randomizations start..stop - 1: how many reach the observed r,
+		### M1 and M2
+		counts = [0, 0, 0]
+		for k in range(start, stop):
+			for i, value in enumerate(self.getStatistics(self.shuffle(k))):
+				if value >= self.observed[i]:
+					counts[i] += 1
+		return counts
+
+	def getPValues(self, counts, iterations):
+		### p-values of r, M1 and M2 from the summed counts of run; NaN if
+		### the cell has fewer than two blocks, or a value is undefined
+		if not self.isValid() or iterations < 1:
+			return (float('nan'),) * 3
+		return tuple([(1.0 + c) / (1.0 + iterations) if observed == observed else float('nan')
+			for c, observed in zip(counts, self.observed)])
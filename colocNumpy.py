@@ -0,0 +1,593 @@
+### Colocalization engines of colocCore.py on NumPy arrays
+###
+### Runs in plain CPython (e.g. on batch nodes without Fiji) and gives the same
+### numbers as mColoc3D.py: the threshold methods are ports of ImageJ's
+### AutoThresholder and the Manders coefficients are those of Coloc 2's
+### MandersColocalization. Inside Fiji there is no NumPy - the Jython scripts
+### only use runCPython, which runs this file with an external interpreter.
+###
+### Usage: python colocNumpy.py <output dir>
+###
+### Recomputes every cell saved by mColoc3D.py from its cell image and checks
+### the thresholds and Manders coefficients stored in its index file. Reading
+### the cell images needs the tifffile package.
+###
+### @license Licensed under GPLv3 and CC BY 4.0
+
+from __future__ import print_function
+
+import os
+import io
+import sys
+import json
+import math
+import argparse
+import subprocess
+import zipfile
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+from colocCore import ColocIndex, MandersResult, getAutoThreshold, ratio
+
+
+DBL_EPSILON = 2.220446049250313E-16
+DBL_MIN_VALUE = 4.9E-324
+
+
+def javaInt(x):
+	### (int) cast of a Java double: NaN is 0, out of range values saturate
+	if x != x:
+		return 0
+	if x >= 2147483647:
+		return 2147483647
+	if x <= -2147483648:
+		return -2147483648
+	return int(x)
+
+def javaRound(x):
+	return javaInt(math.floor(x + 0.5)) if -2147483648 < x < 2147483647 else javaInt(x)
+
+def seqsum(values):
+	### Sum in index order, rounded the same way as the Java loops
+	if not len(values):
+		return 0.0
+	return np.add.accumulate(values)[-1]
+
+def firstMax(values, initial):
+	### Index of the first maximum above initial, as kept by the Java loops
+	### (if (value > best) ...), or -1
+	if not len(values):
+		return -1
+	values = np.where(np.isnan(values), -np.inf, values)
+	i = int(np.argmax(values))
+	return i if values[i] > initial else -1
+
+def smooth(histogram):
+	### 3 point running mean, with zeros outside the histogram
+	padded = np.concatenate(([0.0], histogram, [0.0]))
+	return (padded[:-2] + padded[1:-1] + padded[2:]) / 3
+
+def getModes(histogram):
+	return np.nonzero((histogram[:-2] < histogram[1:-1]) & (histogram[2:] < histogram[1:-1]))[0] + 1
+
+def isBimodal(histogram):
+	return len(getModes(histogram)) == 2
+
+def getBins(data):
+	### Normalized and cumulative normalized histograms
+	norm = data / float(data.sum())
+	p1 = np.add.accumulate(norm)
+	return norm, p1, 1.0 - p1
+
+def getEntropyRange(p1, p2):
+	### First and last bins with some data below and above them
+	first = np.nonzero(np.abs(p1) >= DBL_EPSILON)[0]
+	first = int(first[0]) if len(first) else 0
+	last = np.nonzero(np.abs(p2[first:]) >= DBL_EPSILON)[0]
+	last = first + int(last[-1]) if len(last) else len(p1) - 1
+	return first, last
+
+
+def ijDefault(data):
+	### Variant of IsoData used by the ImageJ threshold widget; the end bins are ignored
+	data = data.astype(np.float64)
+	data[0] = 0
+	data[-1] = 0
+	nonzero = np.nonzero(data)[0]
+	if len(nonzero) < 2:
+		return len(data) // 2
+	low, high = int(nonzero[0]), int(nonzero[-1])
+	bins = np.arange(len(data), dtype = np.float64)
+	counts = np.add.accumulate(data[low:high + 1])
+	sums = np.add.accumulate(bins[low:high + 1] * data[low:high + 1])
+	moving = low
+	while True:
+		k = moving - low
+		result = (sums[k] / counts[k] + (sums[-1] - sums[k]) / (counts[-1] - counts[k])) / 2.0
+		moving += 1
+		if not ((moving + 1) <= result and moving < high - 1):
+			break
+	return javaRound(result)
+
+def huang(data):
+	data = data.astype(np.float64)
+	n = len(data)
+	nonzero = np.nonzero(data)[0]
+	first = int(nonzero[0]) if len(nonzero) else 0
+	last = int(nonzero[-1]) if len(nonzero) else n - 1
+	term = 1.0 / (last - first) if last != first else np.inf
+	bins = np.arange(n, dtype = np.float64)
+	mu0 = np.zeros(n)
+	mu0[first:] = np.add.accumulate(bins[first:] * data[first:]) / np.add.accumulate(data[first:])
+	mu1 = np.zeros(n)
+	if last > 0:
+		reverse = slice(last, 0, -1)
+		mu1[last - 1::-1] = np.add.accumulate(bins[reverse] * data[reverse]) / \
+			np.add.accumulate(data[reverse])
+
+	def entropy(counts, distance):
+		mu = 1.0 / (1.0 + term * np.abs(distance))
+		valid = (mu >= 1e-06) & (mu <= 0.999999)
+		mu = np.where(valid, mu, 0.5)
+		return seqsum(np.where(valid, counts * (-mu * np.log(mu) - (1.0 - mu) * np.log(1.0 - mu)), 0.0))
+
+	threshold = -1
+	best = sys.float_info.max
+	for it in range(n):
+		ent = entropy(data[:it + 1], bins[:it + 1] - mu0[it]) + \
+			entropy(data[it + 1:], bins[it + 1:] - mu1[it])
+		if ent < best:
+			best = ent
+			threshold = it
+	return threshold
+
+def intermodes(data):
+	histogram = data.astype(np.float64)
+	iterations = 0
+	while not isBimodal(histogram):
+		histogram = smooth(histogram)
+		iterations += 1
+		if iterations > 10000:
+			return -1
+	return int(math.floor(getModes(histogram).sum() / 2.0))
+
+def isoData(data):
+	### ImageJ's own variant: the mean below g is an integer, and g itself is in neither mean
+	data = data.astype(np.int64)
+	n = len(data)
+	nonzero = np.nonzero(data[1:])[0]
+	g = int(nonzero[0]) + 2 if len(nonzero) else 0
+	counts = np.concatenate(([0], np.add.accumulate(data)))
+	sums = np.concatenate(([0], np.add.accumulate(data * np.arange(n))))
+	while True:
+		totl, l = int(counts[min(g, n)]), int(sums[min(g, n)])
+		toth = float(counts[-1] - counts[min(g + 1, n)])
+		h = float(sums[-1] - sums[min(g + 1, n)])
+		if totl > 0 and toth > 0:
+			if g == javaRound((l // totl + h / toth) / 2.0):
+				return g
+		g += 1
+		if g > n - 2:
+			return -1
+
+def li(data):
+	data = data.astype(np.float64)
+	n = len(data)
+	bins = np.arange(n, dtype = np.float64)
+	counts = np.add.accumulate(data)
+	sums = np.add.accumulate(bins * data)
+	mean = seqsum(bins[1:] * data[1:]) / counts[-1]
+	newThreshold = mean
+	while True:
+		oldThreshold = newThreshold
+		threshold = min(javaInt(oldThreshold + 0.5), n - 1)
+		if threshold < 0:
+			numBack, sumBack = 0.0, 0.0
+		else:
+			numBack, sumBack = counts[threshold], sums[threshold]
+		numObj, sumObj = counts[-1] - numBack, sums[-1] - sumBack
+		meanBack = sumBack / numBack if numBack else 0.0
+		meanObj = sumObj / numObj if numObj else 0.0
+		temp = (meanBack - meanObj) / (np.log(meanBack) - np.log(meanObj))
+		if temp < -DBL_EPSILON:
+			newThreshold = float(javaInt(temp - 0.5))
+		else:
+			newThreshold = float(javaInt(temp + 0.5))
+		if not abs(newThreshold - oldThreshold) > 0.5:
+			return threshold
+
+def maxEntropy(data):
+	norm, p1, p2 = getBins(data)
+	first, last = getEntropyRange(p1, p2)
+	nonzero = data != 0
+	threshold = -1
+	best = DBL_MIN_VALUE
+	for it in range(first, last + 1):
+		back = norm[:it + 1][nonzero[:it + 1]] / p1[it]
+		obj = norm[it + 1:][nonzero[it + 1:]] / p2[it]
+		ent = -seqsum(back * np.log(back)) - seqsum(obj * np.log(obj))
+		if best < ent:
+			best = ent
+			threshold = it
+	return threshold
+
+def mean(data):
+	data = data.astype(np.float64)
+	return javaInt(math.floor(seqsum(np.arange(len(data)) * data) / seqsum(data)))
+
+def minErrorI(data):
+	data = data.astype(np.float64)
+	n = len(data)
+	bins = np.arange(n, dtype = np.float64)
+	A = np.add.accumulate(data)
+	B = np.add.accumulate(bins * data)
+	C = np.add.accumulate(bins * bins * data)
+
+	def partial(sums, j):
+		if j < 0:
+			return np.float64(0.0)
+		return sums[min(j, n - 1)]
+
+	threshold = mean(data)
+	previous = -2
+	while threshold != previous:
+		a, b, c = partial(A, threshold), partial(B, threshold), partial(C, threshold)
+		mu = b / a
+		nu = (B[-1] - b) / (A[-1] - a)
+		p = a / A[-1]
+		q = (A[-1] - a) / A[-1]
+		sigma2 = c / a - mu * mu
+		tau2 = (C[-1] - c) / (A[-1] - a) - nu * nu
+		w0 = 1.0 / sigma2 - 1.0 / tau2
+		w1 = mu / sigma2 - nu / tau2
+		w2 = (mu * mu) / sigma2 - (nu * nu) / tau2 + np.log10((sigma2 * (q * q)) / (tau2 * (p * p)))
+		sqterm = w1 * w1 - w0 * w2
+		if sqterm < 0:
+			break
+		previous = threshold
+		temp = (w1 + np.sqrt(sqterm)) / w0
+		if temp != temp:
+			threshold = previous
+		else:
+			threshold = javaInt(np.floor(temp))
+	return threshold
+
+def minimum(data):
+	if len(data) < 2:
+		return 0
+	nonzero = np.nonzero(data)[0]
+	top = int(nonzero[-1]) if len(nonzero) else -1
+	histogram = data.astype(np.float64)
+	iterations = 0
+	while not isBimodal(histogram):
+		histogram = smooth(histogram)
+		iterations += 1
+		if iterations > 10000:
+			return -1
+	for i in range(1, top):
+		if histogram[i - 1] > histogram[i] and histogram[i + 1] >= histogram[i]:
+			return i
+	return -1
+
+def moments(data):
+	histogram = data / float(data.sum())
+	bins = np.arange(len(data), dtype = np.float64)
+	m0 = 1.0
+	m1 = seqsum(bins * histogram)
+	m2 = seqsum(bins * bins * histogram)
+	m3 = seqsum(bins * bins * bins * histogram)
+	cd = m0 * m2 - m1 * m1
+	c0 = (-m2 * m2 + m1 * m3) / cd
+	c1 = (m0 * -m3 + m2 * m1) / cd
+	z0 = 0.5 * (-c1 - np.sqrt(c1 * c1 - 4.0 * c0))
+	z1 = 0.5 * (-c1 + np.sqrt(c1 * c1 - 4.0 * c0))
+	p0 = (z1 - m1) / (z1 - z0)
+	above = np.nonzero(np.add.accumulate(histogram) > p0)[0]
+	return int(above[0]) if len(above) else -1
+
+def otsu(data):
+	data = data.astype(np.float64)
+	n = len(data)
+	if n < 3:
+		return 0
+	k = np.arange(n, dtype = np.float64)
+	S = seqsum(k * data)
+	N = seqsum(data)
+	Sk = np.add.accumulate(k * data)[1:n - 1]
+	N1 = np.add.accumulate(data)[1:n - 1]
+	denom = N1 * (N - N1)
+	num = (N1 / N) * S - Sk
+	bcv = np.where(denom != 0, num * num / np.where(denom != 0, denom, 1.0), 0.0)
+	### Ties go to the highest bin (BCV >= BCVmax)
+	return n - 2 - int(np.argmax(bcv[::-1]))
+
+def percentile(data):
+	data = data.astype(np.float64)
+	fraction = np.add.accumulate(data) / data.sum()
+	return firstMax(-np.abs(fraction - 0.5), -1.0)
+
+def renyiEntropy(data):
+	norm, p1, p2 = getBins(data)
+	first, last = getEntropyRange(p1, p2)
+	nonzero = data != 0
+
+	### Maximum entropy (alpha = 1), then alpha = 0.5 and alpha = 2
+	best = [0.0, 0.0, 0.0]
+	found = [0, 0, 0]
+	for it in range(first, last + 1):
+		back = norm[:it + 1][nonzero[:it + 1]] / p1[it]
+		obj = norm[it + 1:][nonzero[it + 1:]] / p2[it]
+		ents = [-seqsum(back * np.log(back)) - seqsum(obj * np.log(obj))]
+		for alpha, back, obj in [
+				(0.5, seqsum(np.sqrt(norm[:it + 1] / p1[it])), seqsum(np.sqrt(norm[it + 1:] / p2[it]))),
+				(2.0, seqsum((norm[:it + 1] * norm[:it + 1]) / (p1[it] * p1[it])),
+					seqsum((norm[it + 1:] * norm[it + 1:]) / (p2[it] * p2[it])))]:
+			term = 1.0 / (1.0 - alpha)
+			ents.append(term * (np.log(back * obj) if back * obj > 0.0 else 0.0))
+		for i, ent in enumerate(ents):
+			if ent > best[i]:
+				best[i] = ent
+				found[i] = it
+	t2, t1, t3 = found
+	if t2 < t1:
+		t1, t2 = t2, t1
+	if t3 < t2:
+		t2, t3 = t3, t2
+	if t2 < t1:
+		t1, t2 = t2, t1
+	if abs(t1 - t2) <= 5:
+		if abs(t2 - t3) <= 5:
+			beta1, beta2, beta3 = 1, 2, 1
+		else:
+			beta1, beta2, beta3 = 0, 1, 3
+	else:
+		if abs(t2 - t3) <= 5:
+			beta1, beta2, beta3 = 3, 1, 0
+		else:
+			beta1, beta2, beta3 = 1, 2, 1
+	omega = p1[t3] - p1[t1]
+	return javaInt(t1 * (p1[t1] + 0.25 * omega * beta1) + 0.25 * t2 * omega * beta2 +
+		t3 * (p2[t3] + 0.25 * omega * beta3))
+
+def shanbhag(data):
+	norm, p1, p2 = getBins(data)
+	first, last = getEntropyRange(p1, p2)
+	threshold = -1
+	best = sys.float_info.max
+	for it in range(first, last + 1):
+		term = 0.5 / p1[it]
+		back = -seqsum(norm[1:it + 1] * np.log(1.0 - term * p1[:it])) * term
+		term = 0.5 / p2[it]
+		obj = -seqsum(norm[it + 1:] * np.log(1.0 - term * p2[it + 1:])) * term
+		ent = abs(back - obj)
+		if ent < best:
+			best = ent
+			threshold = it
+	return threshold
+
+def triangle(data):
+	data = data.astype(np.float64)
+	n = len(data)
+	nonzero = np.nonzero(data)[0]
+	low = int(nonzero[0]) if len(nonzero) else 0
+	if low > 0:
+		low -= 1
+	high = int(nonzero[-1]) if len(nonzero) and nonzero[-1] > 0 else 0
+	if high < n - 1:
+		high += 1
+	peak = int(np.argmax(data)) if data.max() > 0 else 0
+	### Draw the line to the furthest end of the histogram
+	inverted = (peak - low) < (high - peak)
+	if inverted:
+		data = data[::-1]
+		low = n - 1 - high
+		peak = n - 1 - peak
+	if low == peak:
+		return low
+	nx = data[peak]
+	ny = float(low - peak)
+	d = math.sqrt(nx * nx + ny * ny)
+	nx /= d
+	ny /= d
+	d = nx * low + ny * data[low]
+	bins = np.arange(low + 1, peak + 1, dtype = np.float64)
+	split = firstMax(nx * bins + ny * data[low + 1:peak + 1] - d, 0.0)
+	split = low if split < 0 else low + 1 + split
+	split -= 1
+	return n - 1 - split if inverted else split
+
+def yen(data):
+	norm = data / float(data.sum())
+	p1 = np.add.accumulate(norm)
+	p1sq = np.add.accumulate(norm * norm)
+	p2sq = np.zeros(len(data))
+	p2sq[-2::-1] = np.add.accumulate((norm * norm)[:0:-1])
+	terms = p1sq * p2sq
+	spread = p1 * (1.0 - p1)
+	crit = -1.0 * np.where(terms > 0.0, np.log(np.where(terms > 0.0, terms, 1.0)), 0.0) + \
+		2 * np.where(spread > 0.0, np.log(np.where(spread > 0.0, spread, 1.0)), 0.0)
+	return firstMax(crit, DBL_MIN_VALUE)
+
+thresholders = {
+	"Default": ijDefault,
+	"Huang": huang,
+	"Intermodes": intermodes,
+	"IsoData": isoData,
+	"Li": li,
+	"MaxEntropy": maxEntropy,
+	"Mean": mean,
+	"MinError(I)": minErrorI,
+	"Minimum": minimum,
+	"Moments": moments,
+	"Otsu": otsu,
+	"Percentile": percentile,
+	"RenyiEntropy": renyiEntropy,
+	"Shanbhag": shanbhag,
+	"Triangle": triangle,
+	"Yen": yen
+}
+
+
+def getThreshold(method, data):
+	### Same as AutoThresholder.getThreshold (MandersPlugin.runThresholder)
+	with np.errstate(all = "ignore"):
+		threshold = thresholders[method](np.asarray(data, dtype = np.int64))
+	return max(int(threshold), 0)
+
+def getHistogram(values, mask = None):
+	### Dense histogram of a cell; voxels outside the mask count as zeros,
+	### as in the zero-filled crops, and so do negative intensities (see
+	### ColocIndex.getHistogram)
+	values = np.maximum(np.asarray(values), 0)
+	if mask is not None:
+		values = np.where(mask, values, 0)
+	return np.bincount(values.astype(np.int64).ravel())
+
+def getCellThreshold(values, method, mask = None):
+	return getAutoThreshold(getHistogram(values, mask), method, getThreshold)
+
+def getManders(a, b, mask = None, thrA = 0, thrB = 0):
+	### Same as MandersColocalization.calculateMandersCorrelation with
+	### ThresholdMode.Above, over the voxels in the mask:
+	### M1 = sum(A | B > thrB) / sum(A),   M2 = sum(B | A > thrA) / sum(B)
+	### Negative intensities count as zeros, as in ColocIndex
+	a = np.maximum(np.asarray(a, dtype = np.float64), 0.0)
+	b = np.maximum(np.asarray(b, dtype = np.float64), 0.0)
+	if mask is not None:
+		mask = np.asarray(mask, dtype = bool)
+		a = a[mask]
+		b = b[mask]
+	return MandersResult(ratio(float(a[b > thrB].sum()), float(a.sum())),
+		ratio(float(b[a > thrA].sum()), float(b.sum())))
+
+def getPairs(methods):
+	### Channel pairs analysed for the threshold methods (see MandersPlugin.setMethods)
+	channels = [c + 1 for c, method in enumerate(methods) if method != "None"]
+	return [(x, y) for x in channels for y in channels if x < y]
+
+def analyseCell(channels, methods, mask = None):
+	### Thresholds, raw and thresholded Manders coefficients of one cell, as
+	### in MandersPlugin.getManders; channels[c] is None for "None" methods
+	thrs = []
+	for c, method in enumerate(methods):
+		thr = None
+		if method != "None":
+			thr = getCellThreshold(channels[c], method, mask)
+		thrs.append(thr)
+	raws = []
+	thrds = []
+	for chA, chB in getPairs(methods):
+		a, b = channels[chA - 1], channels[chB - 1]
+		raws.append(getManders(a, b, mask))
+		thrds.append(getManders(a, b, mask, thrs[chA - 1], thrs[chB - 1]))
+	return (thrs, raws, thrds)
+
+
+def runCPython(python, args):
+	### Bridge for the Jython scripts: runs this file with a CPython
+	### interpreter that has NumPy, returns its exit code and output
+	script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "colocNumpy.py")
+	process = subprocess.Popen([python, script] + list(args),
+		stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+	output = process.communicate()[0]
+	if not isinstance(output, str):
+		output = output.decode("utf-8", "replace")
+	return (process.returncode, output)
+
+def readCellImage(path):
+	### Cell image saved by mColoc3D.py as a (C, Z, Y, X) array
+	import tifffile
+	if path.endswith(".zip"):
+		archive = zipfile.ZipFile(path)
+		try:
+			tif = tifffile.TiffFile(io.BytesIO(archive.read(archive.namelist()[0])))
+		finally:
+			archive.close()
+	else:
+		tif = tifffile.TiffFile(path)
+	try:
+		series = tif.series[0]
+		data = series.asarray()
+		axes = series.axes
+	finally:
+		tif.close()
+	for axis in "CZ":
+		if axis not in axes:
+			data = data[np.newaxis]
+			axes = axis + axes
+	return data.transpose([axes.index(axis) for axis in "CZYX"])
+
+def isClose(value, expected, tolerance):
+	if value != value or expected != expected:
+		return value != value and expected != expected
+	return abs(value - expected) <= tolerance * max(1.0, abs(expected))
+
+def verifyCell(indexFile, imageFile, tolerance):
+	### Mismatches between a cell recomputed here and its index file
+	indexData = open(indexFile)
+	try:
+		data = json.load(indexData)
+	finally:
+		indexData.close()
+	if "methods" not in data:
+		return ["no results in the index file"]
+	methods = data["methods"]
+	index = ColocIndex.fromDict(data)
+	channels = readCellImage(imageFile)
+	errors = []
+	for c, method in enumerate(methods):
+		if method == "None":
+			continue
+		histogram = getHistogram(channels[c])
+		expected = index.getHistogram(c + 1)
+		if list(histogram) != list(expected):
+			errors.append("histogram %i differs" % (c + 1))
+		thr = getAutoThreshold(histogram, method, getThreshold)
+		if thr != data["thresholds"][c]:
+			errors.append("threshold %i (%s) is %i, expected %i" % (c + 1, method, thr, data["thresholds"][c]))
+	thrs = data["thresholds"]
+	for pair, m1raw, m2raw, m1thrd, m2thrd in data["manders"]:
+		a, b = channels[pair[0] - 1], channels[pair[1] - 1]
+		raw = getManders(a, b)
+		thrd = getManders(a, b, None, thrs[pair[0] - 1], thrs[pair[1] - 1])
+		for name, value, expected in [("M1 raw", raw.m1, m1raw), ("M2 raw", raw.m2, m2raw),
+				("M1 thrd", thrd.m1, m1thrd), ("M2 thrd", thrd.m2, m2thrd)]:
+			if not isClose(value, expected, tolerance):
+				errors.append("%i-%i %s is %r, expected %r" % (pair[0], pair[1], name, value, expected))
+	return errors
+
+def main(args):
+	parser = argparse.ArgumentParser(prog = "colocNumpy.py",
+		description = "Check the cells saved by mColoc3D.py against a NumPy recomputation.")
+	parser.add_argument("outputDir", help = "output directory of mColoc3D.py")
+	parser.add_argument("--tolerance", type = float, default = 1e-9,
+		help = "relative tolerance of the Manders coefficients")
+	options = parser.parse_args(args)
+	if np is None:
+		print("NumPy is not available")
+		return 2
+	cells = 0
+	failed = 0
+	for name in sorted(os.listdir(options.outputDir)):
+		if not name.startswith("Cell_") or not name.endswith(".json"):
+			continue
+		title = os.path.join(options.outputDir, name[:-len(".json")])
+		imageFile = [title + ext for ext in [".tif", ".zip"] if os.path.exists(title + ext)]
+		if not imageFile:
+			print("%s: no cell image" % name)
+			continue
+		cells += 1
+		errors = verifyCell(title + ".json", imageFile[0], options.tolerance)
+		if errors:
+			failed += 1
+			for error in errors:
+				print("%s: %s" % (name, error))
+	print("Checked %i cells, %i differ" % (cells, failed))
+	return 1 if failed else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -1,247 +1,897 @@
-import os, sys
+import os, sys, json, argparse, shutil
+import jarray
+from collections import OrderedDict
+from threading import Lock, Thread
+import time
 
 from javax.swing import (BoxLayout, ImageIcon, JButton, JFrame, JPanel,
         JPasswordField, JLabel, JTextArea, JTextField, JScrollPane,
-        JList, JCheckBox, DefaultListCellRenderer,
-        ListSelectionModel, SwingConstants, WindowConstants)
-from java.awt import Component, GridBagLayout, GridBagConstraints, Insets, Color
+        JList, JCheckBox, JProgressBar, DefaultListCellRenderer,
+        ListSelectionModel, SwingConstants, SwingUtilities, WindowConstants)
+from java.awt import Component, GridBagLayout, GridBagConstraints, Insets, Color, Rectangle
 from java.awt.event import WindowEvent, WindowAdapter
+from java.util import Arrays
+from java.lang import Math, Runnable
+from java.util.concurrent import (ArrayBlockingQueue, Callable, ExecutionException, Executors,
+	ThreadPoolExecutor, TimeUnit)
+from java.util.zip import ZipEntry, ZipInputStream, ZipOutputStream
+from java.io import (BufferedInputStream, BufferedOutputStream, ByteArrayOutputStream,
+	DataOutputStream, FileInputStream, FileOutputStream, IOException)
 
 from swingutils.models.list import DelegateListModel
 
-from ij import IJ, ImagePlus, ImageStack, ImageListener
-from ij.io import DirectoryChooser, FileSaver
-from ij.gui import Roi, ShapeRoi, GenericDialog
-from ij.measure import ResultsTable
-from ij.plugin import Duplicator, ChannelSplitter, RGBStackMerge, ContrastEnhancer, ZProjector
-from ij.process import StackProcessor
-from loci.plugins import BF
-from loci.formats import UnknownFormatException
-from fiji.threshold import Auto_Threshold
-from algorithms import MandersColocalization
-from gadgets import DataContainer
-from gadgets import ThresholdMode
-from net.imglib2 import TwinCursor
-from net.imglib2.img import ImagePlusAdapter
-from net.imglib2.view import Views
+from ij import IJ, CompositeImage, ImagePlus, ImageStack, ImageListener, Prefs, VirtualStack
+from ij.io import DirectoryChooser, FileSaver, RoiDecoder, RoiEncoder
+from ij.gui import Roi, ShapeRoi, GenericDialog, YesNoCancelDialog
+from ij.measure import Measurements, ResultsTable
+from ij.plugin import RGBStackMerge, ContrastEnhancer
+from ij.process import (StackProcessor, AutoThresholder, ByteProcessor, Blitter, ImageProcessor,
+	ImageStatistics)
+from loci.plugins import BF, LociPrefs
+from loci.plugins.in import ImporterOptions
+from loci.plugins.util import ImageProcessorReader
+from loci.formats import ChannelSeparator, FormatTools, ImageReader, UnknownFormatException
+
+from colocCore import (ColocIndex, CellMask, CostesTest, getAutoThreshold, getSaturationLimits,
+	coefficients, thresholdMethods)
+from colocNumpy import runCPython
+import colocBatch
 
 
 defaultChannelA = "Channel 1"
 defaultChannelB = "Channel 2"
 defaultMethodA = "Mean"
 defaultMethodB = "Otsu"
+sessionDir = ".session"
+readerProperty = "mColoc3D.PlaneReader"
+fileProperty = "mColoc3D.ImageFile"
+projectionsProperty = "mColoc3D.Projections"
+quickPreviewVoxels = 1 << 28  # Larger images first get a preview of quickPreviewSlices slices
+quickPreviewSlices = 8
+histogramsProperty = "mColoc3D.Histograms"
+stretchModes = ["Sampled", "Full stack"]
+stretchSaturated = 0.35
+stretchSamples = 1 << 22  # Voxels per channel sampled for contrast stretching
 
 
 class MandersPlugin(ImageListener, WindowAdapter):
 
 	def __init__(self):
+		self.initAnalysis()
+		self.createMainWindow()
+		ImagePlus.addImageListener(self)
+		self.selectInputDir()
+		self.selectOutputDir()
+		if not self.resumeSession():
+			### Cancelled: the session and its results are left for later
+			ImagePlus.removeImageListener(self)
+			self.closeMainWindow()
+			return
+		self.timer = colocBatch.StageTimer(os.path.join(self.outputDir, colocBatch.timingsName),
+			IJ.currentMemory)
+		if self.resultsWriter is None:
+			### The results of an earlier run are kept aside, not overwritten
+			resultsFile = os.path.join(self.outputDir, colocBatch.resultsName)
+			if os.path.exists(resultsFile):
+				print "Results of an earlier run moved to %s" % colocBatch.backupFile(resultsFile)
+			self.resultsWriter = colocBatch.ResultsWriter(resultsFile, table = self.results)
+		self.processNextFile()
+
+	def initAnalysis(self):
 		self.imp = None
 		self.preview = None
-		self.createMainWindow()
+		self.imageFile = None
+		self.series = 0
+		self.nextSeries = []
 		self.cells = None
 		self.files = []
 		self.results = ResultsTable()
-		ImagePlus.addImageListener(self)
-		self.selectInputDir()
-		self.selectOutputDir()
+		self.resultsWriter = None
+		self.finished = []
 		self.pairs = []
 		self.methods = []
-		self.processNextFile()
+		self.workers = Prefs.getThreads()
+		self.lazy = None
+		self.tiled = None
+		self.compress = False
+		self.saveThresholded = True
+		self.stretchMode = stretchModes[0]
+		self.costes = 0
+		self.costesBlock = (3, 3, 1)
+		self.seed = 0
+		self.costesPool = None
+		self.coefficients = []
+		self.lock = Lock()
+		self.useCache = True
+		self.hashContent = False
+		self.cache = None
+		self.writer = ImageWriter()
+		self.cacheSize = min(512 << 20, IJ.maxMemory() / 8)
+		self.prefetcher = ImagePrefetcher(self)
+		self.task = None
+		self.cancelled = False
+		self.progress = Progress(0)
+		self.timer = colocBatch.StageTimer(memory = IJ.currentMemory)
 
 	def selectInputDir(self):
 		inputDialog = DirectoryChooser("Please select a directory contaning your images")
-		inputDir = inputDialog.getDirectory()
-		for imageFile in os.listdir(inputDir):
-			self.files.append(inputDir + imageFile)
+		self.inputDir = inputDialog.getDirectory()
+		self.files = self.listImages(self.inputDir)
+
+	def listImages(self, inputDir):
+		files = []
+		for imageFile in sorted(os.listdir(inputDir)):
+			if not imageFile.endswith(colocBatch.cellsSuffix):
+				files.append(os.path.join(inputDir, imageFile))
+		return files
 
 	def selectOutputDir(self):
 		outputDialog = DirectoryChooser("Please select a directory to save your results")
 		self.outputDir = outputDialog.getDirectory()
-		
+
+	def getSessionFile(self, name):
+		return os.path.join(self.outputDir, sessionDir, name)
+
+	def getCellsFile(self, imageFile, series = 0):
+		return colocBatch.getCellsFile(imageFile, series)
+
+	def getPartialCellsFile(self, imageFile, series = 0):
+		return self.getSessionFile(os.path.basename(self.getCellsFile(imageFile, series)))
+
+	def resumeSession(self):
+		### A session saved in the output directory was interrupted - offer
+		### to skip its finished images and restore the cells drawn since.
+		### Returns False when cancelled, which leaves the session untouched.
+		sessionFile = self.getSessionFile("session.json")
+		if not os.path.exists(sessionFile):
+			return True
+		data = open(sessionFile)
+		try:
+			session = json.load(data)
+		finally:
+			data.close()
+		finished = session.get("finished", [])
+		dialog = YesNoCancelDialog(self.frame, "Resume session",
+			"%i images of the previous session in this output directory are finished.\n"
+			"Resume it? (No starts a new session, and keeps its results as a backup.)" % len(finished))
+		resume = None
+		if not dialog.cancelPressed():
+			resume = dialog.yesPressed()
+		if not colocBatch.settleSession(self.outputDir, os.path.join(self.outputDir, sessionDir), resume):
+			return False
+		if not resume:
+			return True
+		self.finished = finished
+		self.files = [f for f in self.files if os.path.basename(f) not in finished]
+		if session.get("methods"):
+			### Same settings as before, so that the results stay consistent
+			self.setMethods(session["methods"])
+			self.compress = session.get("compress", self.compress)
+			self.saveThresholded = session.get("thresholded", self.saveThresholded)
+			self.costes, self.costesBlock, self.seed = session.get("costes",
+				[self.costes, self.costesBlock, self.seed])
+			self.costesBlock = tuple(self.costesBlock)
+			### Sessions from before the other coefficients had none
+			self.coefficients = session.get("coefficients", [])
+		resultsFile = os.path.join(self.outputDir, colocBatch.resultsName)
+		if os.path.exists(resultsFile):
+			### Rows written after the last checkpoint belong to an unfinished
+			### image, which will be analysed again
+			rows = [row for row in colocBatch.readTable(resultsFile) if row["Image"] in finished]
+			colocBatch.writeTable(resultsFile, rows)
+			for row in rows:
+				self.results.incrementCounter()
+				n = self.results.getCounter() - 1
+				for column, value in row.items():
+					self.results.setValue(column, n, value if column == "Image" else colocBatch.parseValue(value))
+		self.resultsWriter = colocBatch.ResultsWriter(resultsFile, append = True, table = self.results)
+		print "Resuming session - %i images finished, %i to go" % (len(finished), len(self.files))
+		return True
+
+	def checkpointCells(self):
+		### Autosave of the cells drawn so far, restored when resuming
+		if self.imageFile is None or self.cells is None:
+			return
+		try:
+			cells = list(self.cells)
+			path = self.getPartialCellsFile(self.imageFile, self.series)
+			if not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			colocBatch.replaceFile(path, lambda tmp: self.saveCells(tmp, cells))
+		except (IOException, OSError), e:
+			print "Could not save cells of %s: %s" % (self.imageFile, e)
+
+	def checkpointImage(self):
+		### The image is finished: save the results so far and, after its
+		### last series, mark it as done, so that a resumed session skips it
+		self.resultsWriter.flush()
+		partial = self.getPartialCellsFile(self.imageFile, self.series)
+		if os.path.exists(partial):
+			os.remove(partial)
+		if self.nextSeries:
+			return
+		self.finished.append(os.path.basename(self.imageFile))
+		sessionFile = self.getSessionFile("session.json")
+		if not os.path.isdir(os.path.dirname(sessionFile)):
+			os.makedirs(os.path.dirname(sessionFile))
+		def write(tmp):
+			data = open(tmp, "w")
+			try:
+				json.dump({"inputDir": self.inputDir, "methods": self.methods,
+					"compress": self.compress, "thresholded": self.saveThresholded,
+					"costes": [self.costes, list(self.costesBlock), self.seed],
+					"coefficients": self.coefficients, "finished": self.finished}, data)
+			finally:
+				data.close()
+		colocBatch.replaceFile(sessionFile, write)
+
 	def closeImage(self):
 		if self.imp is not None:
+			PlaneReader.release(self.imp)
 			self.imp.close()
 			self.imp = None
 		if self.preview is not None:
 			self.preview.close()
 			self.preview = None
 
-	def openImage(self, imageFile):
+	def getImageSize(self, imageFile, series = 0):
+		### Size of a series in bytes, from the Bio-Formats metadata
+		reader = ImageReader()
+		try:
+			try:
+				reader.setId(imageFile)
+				reader.setSeries(series)
+				return reader.getSizeX() * reader.getSizeY() * reader.getImageCount() * \
+					reader.getRGBChannelCount() * FormatTools.getBytesPerPixel(reader.getPixelType())
+			except Exception:
+				return os.path.getsize(imageFile)
+		finally:
+			reader.close()
+
+	def getSeriesSize(self, imageFile, series = 0):
+		### (slices, frames) of a series
+		reader = ImageReader()
 		try:
-			images = BF.openImagePlus(imageFile)
-			self.imp = images[0]
-		except UnknownFormatException:
+			reader.setId(imageFile)
+			reader.setSeries(series)
+			return (reader.getSizeZ(), reader.getSizeT())
+		finally:
+			reader.close()
+
+	def getSeriesCount(self, imageFile):
+		reader = ImageReader()
+		try:
+			try:
+				reader.setId(imageFile)
+				return reader.getSeriesCount()
+			except Exception:
+				return 1
+		finally:
+			reader.close()
+
+	def getTitle(self, imageFile, series = 0):
+		### Base name of the output files of a series
+		name = os.path.basename(imageFile)
+		title = name[:name.rfind('.')]
+		if series > 0:
+			title += "_s%i" % (series + 1)
+		return title
+
+	def isLazy(self, imageFile, series = 0):
+		### Lazy loading by default only when the series would take more
+		### than half of the free heap
+		if self.lazy is not None:
+			return self.lazy
+		return self.getImageSize(imageFile, series) > (IJ.maxMemory() - IJ.currentMemory()) / 2
+
+	def loadImage(self, imageFile, series = 0):
+		### Only the given series is opened; the others are opened one at a
+		### time after it (see loadNextFile)
+		with self.timer.stage("open", os.path.basename(imageFile)) as stage:
+			try:
+				options = ImporterOptions()
+				options.setId(imageFile)
+				options.clearSeries()
+				options.setSeriesOn(series, True)
+				if self.isLazy(imageFile, series):
+					options.setVirtual(True)
+					images = BF.openImagePlus(options)
+					imp = images[0]
+					imp.setProperty(readerProperty, PlaneReader(imageFile, self.cacheSize, series))
+				else:
+					images = BF.openImagePlus(options)
+					imp = images[0]
+			except UnknownFormatException:
+				return None
+			stage.voxels = self.getVoxels(imp)
+		imp.setProperty(fileProperty, os.path.basename(imageFile))
+		imp.title = self.getTitle(imageFile, series)
+		return imp
+
+	def getVoxels(self, imp):
+		return imp.getWidth() * imp.getHeight() * imp.getStackSize()
+
+	def stage(self, name, imp, cell = None, voxels = 0):
+		### Timed stage of the pipeline, on the image imp was opened from
+		image = imp.getProperty(fileProperty)
+		return self.timer.stage(name, image if image is not None else imp.title, cell, voxels)
+
+	def openImage(self, imageFile, prefetched = None, series = 0):
+		### Opens an image without making it current, so the image being
+		### analysed stays open until the next one is ready
+		if prefetched is not None:
+			imp = prefetched.imp
+		else:
+			imp = self.loadImage(imageFile, series)
+		if imp is None:
 			return None
-		if self.imp.getNChannels() < 2:
+		if imp.getNChannels() < 2:
 			IJ.error("Bad image format", "Image must contain at lease 2 channels!")
+			PlaneReader.release(imp)
+			imp.close()
 			return None
 		if not self.pairs or \
 			not self.methods:
-			self.getOptionsDialog(self.imp)
-		title = self.imp.title
-		self.imp.title = title[:title.rfind('.')]
-		return self.imp
+			self.getOptionsDialog(imp)
+		return imp
 
 	def getOptionsDialog(self, imp):
-		thr_methods = ["None", "Default", "Huang", "Intermodes", "IsoData",  "Li", "MaxEntropy","Mean", "MinError(I)", "Minimum", "Moments", "Otsu", "Percentile", "RenyiEntropy", "Shanbhag" , "Triangle", "Yen"]
+		thr_methods = ["None"] + thresholdMethods
 		gd = GenericDialog("Please select channels to collocalize")
 		for i in range(1, imp.getNChannels() + 1):
 			gd.addChoice("Threshold method for channel %i" % i, thr_methods, "None")
+		gd.addNumericField("Worker threads", self.workers, 0)
+		gd.addNumericField("Costes randomizations (0 = none)", self.costes, 0)
+		gd.addNumericField("Costes block size XY (pixels)", self.costesBlock[0], 0)
+		gd.addNumericField("Costes block size Z (slices)", self.costesBlock[2], 0)
+		gd.addNumericField("Random seed", self.seed, 0)
+		gd.addCheckboxGroup(1, len(coefficients), coefficients,
+			[name in self.coefficients for name in coefficients], ["Other coefficients"])
+		gd.addCheckbox("Save thresholded images", self.saveThresholded)
+		gd.addCheckbox("Compress saved images (ZIP)", self.compress)
+		loading = ["Auto", "Lazy", "In memory"]
+		gd.addChoice("Image loading", loading, loading[[None, True, False].index(self.lazy)])
+		processing = ["Auto", "Tiled", "In memory"]
+		gd.addChoice("Cell processing", processing, processing[[None, True, False].index(self.tiled)])
+		gd.addChoice("Contrast stretching", stretchModes, self.stretchMode)
 		gd.showDialog()
 		if gd.wasCanceled():
 			self.exit()
-		channels = []
+		methods = []
 		for i in range(1, imp.getNChannels() + 1):
-			method = gd.getNextChoice()
-			self.methods.append(method)
+			methods.append(gd.getNextChoice())
+		self.setMethods(methods)
+		self.workers = max(1, int(gd.getNextNumber()))
+		self.costes = max(0, int(gd.getNextNumber()))
+		xy = max(1, int(gd.getNextNumber()))
+		self.costesBlock = (xy, xy, max(1, int(gd.getNextNumber())))
+		self.seed = int(gd.getNextNumber())
+		self.coefficients = [name for name in coefficients if gd.getNextBoolean()]
+		self.saveThresholded = gd.getNextBoolean()
+		self.compress = gd.getNextBoolean()
+		self.lazy = [None, True, False][gd.getNextChoiceIndex()]
+		self.tiled = [None, True, False][gd.getNextChoiceIndex()]
+		self.stretchMode = gd.getNextChoice()
+
+	def setMethods(self, methods):
+		self.methods = list(methods)
+		self.pairs = []
+		channels = []
+		for i, method in enumerate(self.methods):
 			if method != "None":
-				channels.append(i)
+				channels.append(i + 1)
 		for x in channels:
 			for y in channels:
 				if x < y:
 					self.pairs.append((x, y))
 
 	def processNextFile(self):
-		if self.files:
-			imageFile = self.files.pop(0)
-			return self.processFile(imageFile)
-		else:
-			return False
-			
-	def processFile(self, imageFile):
-		imp = self.openImage(imageFile)
-		if imp is not None:
-			cell = Cell(imp.NSlices, 1)
-			self.cells = DelegateListModel([])
-			self.cells.append(cell)
-			self.showMainWindow(self.cells)
-			if self.checkbox3D.isSelected():
-				self.displayImage(imp)
+		return self.showFile(self.loadNextFile(not self.checkbox3D.isSelected()))
+
+	def loadNextFile(self, preview):
+		### Opens the next image, or the next series of the current one, and
+		### prepares it for display; does not touch the user interface, so it
+		### can run off the event dispatch thread
+		while self.files or self.nextSeries:
+			if self.nextSeries:
+				imageFile, series = self.nextSeries.pop(0)
+				prefetched = None
 			else:
-				self.displayImage(imp, False)
-				self.preview = self.previewImage(imp)
-				self.displayImage(self.preview)
-			return True
+				imageFile, series = self.files.pop(0), 0
+				prefetched = self.prefetcher.take(imageFile)
+				self.nextSeries = [(imageFile, s) for s in range(1, self.getSeriesCount(imageFile))]
+			imp = self.openImage(imageFile, prefetched, series)
+			if imp is None:
+				if prefetched is not None:
+					prefetched.close()
+				continue
+			stretch = prefetched is None or not prefetched.stretched
+			image = prefetched.preview if prefetched is not None else None
+			self.displayImage(imp, False, stretch)
+			if preview and image is None:
+				image = self.previewImage(imp, self.getPreviewStep(imp))
+				self.displayImage(image, False)
+			elif image is not None:
+				self.displayImage(image, False, stretch)
+			return (imageFile, series, imp, image)
+		return None
+
+	def showFile(self, loaded):
+		if loaded is None:
+			return False
+		imageFile, series, imp, preview = loaded
+		self.imageFile = imageFile
+		self.series = series
+		self.imp = imp
+		self.preview = preview
+		self.cells = DelegateListModel([])
+		partial = self.getPartialCellsFile(imageFile, series)
+		if os.path.exists(partial):
+			for cell in self.loadCells(partial, imp.NSlices):
+				self.cells.append(cell)
+		if not len(self.cells):
+			self.cells.append(Cell(imp.NSlices, 1))
+		self.showMainWindow(self.cells)
+		if self.checkbox3D.isSelected() or preview is None:
+			imp.show()
 		else:
-			return self.processNextFile()
+			preview.show()
+			self.refreshPreview(imp, preview)
+		self.prefetcher.prefetch(self.files, True, not self.checkbox3D.isSelected())
+		return True
 	
-	def displayImage(self, imp, show = True):
+	def displayImage(self, imp, show = True, stretch = True):
 		imp.setDisplayMode(IJ.COMPOSITE)
-		enhancer = ContrastEnhancer()
-		enhancer.setUseStackHistogram(True)
-		splitter = ChannelSplitter()
-		for c in range(1, imp.getNChannels() + 1):
-			imp.c = c
-			enhancer.stretchHistogram(imp, 0.35)
+		if stretch:
+			with self.stage("stretch", imp) as stage:
+				histograms = None
+				if self.stretchMode == stretchModes[0]:
+					histograms = self.getHistograms(imp)
+				if histograms is None:
+					stage.voxels = self.getVoxels(imp)
+					enhancer = ContrastEnhancer()
+					enhancer.setUseStackHistogram(True)
+					for c in range(1, imp.getNChannels() + 1):
+						imp.c = c
+						enhancer.stretchHistogram(imp, stretchSaturated)
+				else:
+					stage.voxels = sum([sum(histogram) for histogram in histograms])
+					for c, histogram in enumerate(histograms):
+						imp.c = c + 1
+						low, high = getSaturationLimits(histogram, stretchSaturated)
+						imp.setDisplayRange(low, high)
 		if show:
 			imp.show()
 
-	def previewImage(self, imp):
-		roi = imp.getRoi()
-		splitter = ChannelSplitter()
-		channels = []
+	def getHistograms(self, imp):
+		### Intensity histogram of every channel from a sample of about
+		### stretchSamples voxels: evenly spaced whole slices, at least one.
+		### ImageJ makes the histogram of a slice in place, so slices larger
+		### than the sample are not subsampled. Kept with the image and shared
+		### with its preview, so both get the same display ranges. None for
+		### 32-bit and RGB images, stretched from the full stack instead.
+		histograms = imp.getProperty(histogramsProperty)
+		if histograms is not None or imp.getBitDepth() not in (8, 16):
+			return histograms
+		nslices = imp.getNSlices()
+		pixels = imp.getWidth() * imp.getHeight()
+		count = max(1, min(nslices, stretchSamples // pixels))
+		slices = sorted(set([1 + i * nslices // count for i in range(count)]))
+		histograms = []
 		for c in range(1, imp.getNChannels() + 1):
-			channel = ImagePlus("Channel %i" % c, splitter.getChannel(imp, c))
-			projector = ZProjector(channel)
-			projector.setMethod(ZProjector.MAX_METHOD)
-			projector.doProjection()
-			channels.append(projector.getProjection())
-		image = RGBStackMerge.mergeChannels(channels, False)
-		image.title = imp.title + " MAX Intensity"
-		image.luts = imp.luts
-		imp.setRoi(roi)
-		return image
-
-	def getCroppedChannels(self, imp, cell):
-		splitter = ChannelSplitter()
+			histogram = None
+			for z in slices:
+				counts = self.getPlane(imp, c, z).getHistogram()
+				if histogram is None:
+					histogram = list(counts)
+				else:
+					histogram = [a + b for a, b in zip(histogram, counts)]
+			histograms.append(histogram)
+		imp.setProperty(histogramsProperty, histograms)
+		return histograms
+
+	def getProjections(self, imp, step = 1):
+		### MAX projections of all channels, in one pass over the planes and
+		### without copying the channels. Channels, and blocks of slices of a
+		### channel, are projected in parallel and the blocks merged. With
+		### step, only every step-th slice is projected (quick preview of a
+		### huge stack). Full projections are kept with the image.
+		projections = imp.getProperty(projectionsProperty)
+		if projections is not None:
+			return projections
+		nchannels = imp.getNChannels()
+		slices = range(1, imp.getNSlices() + 1, step)
+		blocks = max(1, min(len(slices), self.workers // nchannels))
+		size = (len(slices) + blocks - 1) // blocks
+		tasks = []
+		for c in range(1, nchannels + 1):
+			for i in range(0, len(slices), size):
+				tasks.append(ProjectionTask(self, imp, c, slices[i:i + size]))
+		pool = None
+		if self.workers > 1 and len(tasks) > 1:
+			pool = Executors.newFixedThreadPool(min(self.workers, len(tasks)))
+		try:
+			if pool is not None:
+				results = [future.get() for future in pool.invokeAll(tasks)]
+			else:
+				results = [task.call() for task in tasks]
+		finally:
+			if pool is not None:
+				pool.shutdown()
+		projections = [None] * nchannels
+		for task, projection in zip(tasks, results):
+			if projections[task.c - 1] is None:
+				projections[task.c - 1] = projection
+			else:
+				projections[task.c - 1].copyBits(projection, 0, 0, Blitter.MAX)
+		if step == 1:
+			imp.setProperty(projectionsProperty, projections)
+		return projections
+
+	def getPreviewStep(self, imp):
+		### Slice step of the first preview of an image: huge stacks get a
+		### quick one, replaced by refreshPreview. Previews keep the image
+		### width and height, so ROIs drawn on a quick one stay valid.
+		if imp.getProperty(projectionsProperty) is not None or \
+			self.getVoxels(imp) <= quickPreviewVoxels:
+			return 1
+		return max(1, (imp.getNSlices() + quickPreviewSlices - 1) // quickPreviewSlices)
+
+	def previewImage(self, imp, step = 1):
+		with self.stage("preview", imp, voxels = self.getVoxels(imp) // step):
+			channels = []
+			for c, projection in enumerate(self.getProjections(imp, step)):
+				channels.append(ImagePlus("MAX_Channel %i" % (c + 1), projection.duplicate()))
+			image = RGBStackMerge.mergeChannels(channels, False)
+			image.title = imp.title + " MAX Intensity"
+			image.luts = imp.luts
+			image.setProperty(fileProperty, imp.getProperty(fileProperty))
+			if self.stretchMode == stretchModes[0]:
+				image.setProperty(histogramsProperty, self.getHistograms(imp))
+			return image
+
+	def refreshPreview(self, imp, preview):
+		### Replace a quick preview by the full projections, computed in the
+		### background; ROIs drawn meanwhile are kept
+		if imp.getProperty(projectionsProperty) is not None:
+			return
+		def run():
+			try:
+				with self.stage("preview", imp, voxels = self.getVoxels(imp)):
+					projections = self.getProjections(imp)
+			except Exception:
+				### The image was closed meanwhile
+				return
+			def update():
+				if self.preview is not preview:
+					return
+				stack = preview.getStack()
+				for c, projection in enumerate(projections):
+					stack.setPixels(projection.duplicate().getPixels(), c + 1)
+				self.displayImage(preview, False)
+				preview.updateAndDraw()
+			SwingUtilities.invokeLater(update)
+		Thread(target = run, name = "mColoc3D preview").start()
+
+	def getPlane(self, imp, c, z, t = 1):
+		### View of one plane of the original stack - no pixels are copied. The
+		### planes of lazy images are cached and shared between threads, and
+		### must not be modified (no ROI, interpolation or pixel changes).
+		reader = imp.getProperty(readerProperty)
+		if reader is not None:
+			return reader.getPlane(c, z, t)
+		return imp.getStack().getProcessor(imp.getStackIndex(c, z, t))
+
+	def cropPlane(self, imp, c, z, crop, t = 1):
+		### Lazy images only read the cropped region from disk
+		reader = imp.getProperty(readerProperty)
+		if reader is not None:
+			return reader.getRegion(c, z, crop, t)
+		zslice = self.getPlane(imp, c, z, t)
+		zslice.setRoi(crop)
+		return zslice.crop()
+
+	def getMaskProcessor(self, imp, mask, runs):
+		ip = ByteProcessor(mask.width, mask.height)
+		pixels = ip.getPixels()
+		for start, end in runs:
+			Arrays.fill(pixels, start, end, 1)
+		if imp.getBitDepth() == 16:
+			return ip.convertToShort(False)
+		elif imp.getBitDepth() == 32:
+			return ip.convertToFloat()
+		return ip
+
+	def isTiled(self, imp, mask):
+		### Tiled processing by default only when the crops of all channels
+		### of the cells analysed in parallel would take more than half of
+		### the free heap
+		if self.tiled is not None:
+			return self.tiled
+		crops = imp.getNChannels() * len(mask.slices) * mask.width * mask.height * \
+			max(1, imp.getBitDepth() / 8)
+		return crops * self.workers > (IJ.maxMemory() - IJ.currentMemory()) / 2
+
+	def getCroppedChannels(self, imp, cell, t = 1):
+		### Tiled cells get virtual stacks that crop one plane at a time,
+		### when it is read; the others are cropped in memory
 		imp.setRoi(None)
-		if cell.mode3D:
-			cropRoi = cell.getCropRoi()
-		else:
-			cropRoi = cell.roi
-		if cropRoi is None:
+		mask = cell.getMask(imp.getWidth(), imp.getHeight())
+		if mask is None:
 			return None
-		crop = cropRoi.getBounds()
+		crop = Rectangle(mask.x, mask.y, mask.width, mask.height)
+		tiled = self.isTiled(imp, mask)
+		masks = {}
+		if not tiled:
+			for z, runs in mask.slices:
+				if id(runs) not in masks:
+					masks[id(runs)] = self.getMaskProcessor(imp, mask, runs)
 		channels = []
 		for c in range(1, imp.getNChannels() + 1):
+			self.progress.add(bytes = len(mask.slices) * crop.width * crop.height * \
+				max(1, imp.getBitDepth() / 8))
+			if tiled:
+				channels.append(ImagePlus("Channel %i" % c, CellStack(self, imp, c, mask, t)))
+				continue
 			slices = ImageStack(crop.width, crop.height)
-			channel = splitter.getChannel(imp, c)
-			for z in range(1, channel.getSize() + 1):
-				zslice = channel.getProcessor(z)
-				zslice.setRoi(cropRoi)
-				nslice = zslice.crop()
-				if cell.mode3D:
-					oroi = cell.slices[z - 1].roi	
-				else:
-					oroi = cell.roi
-				if oroi is not None:
-					roi = oroi.clone()
-					bounds = roi.getBounds()
-					roi.setLocation(bounds.x - crop.x, bounds.y - crop.y)
-					nslice.setColor(Color.black)
-					nslice.fillOutside(roi)
-					slices.addSlice(nslice)
+			for z, runs in mask.slices:
+				nslice = self.cropPlane(imp, c, z, crop, t)
+				nslice.copyBits(masks[id(runs)], 0, 0, Blitter.MULTIPLY)
+				slices.addSlice(nslice)
 			channels.append(ImagePlus("Channel %i" % c, slices))
 		return channels
 
-	def getThreshold(self, imp, method):
-		thresholder = Auto_Threshold()
-		duplicator = Duplicator()
-		tmp = duplicator.run(imp)
-		return thresholder.exec(tmp, method, False, False, True, False, False, True)
+	def getThreshold(self, histogram, method):
+		return getAutoThreshold(histogram, method, self.runThresholder)
 
-	def getContainer(self, impA, impB):
-		imgA = ImagePlusAdapter.wrap(impA)
-		imgB = ImagePlusAdapter.wrap(impB)
-		return DataContainer(imgA, imgB, 1, 1, "imageA", "imageB")
+	def runThresholder(self, method, data):
+		thresholder = AutoThresholder()
+		method = AutoThresholder.Method.valueOf(method.replace("(I)", ""))
+		return thresholder.getThreshold(method, jarray.array(data, 'i'))
 
-	def getManders(self, imp, cell):
+	def getThresholdedImage(self, imp, threshold):
+		### Binary image of the voxels above threshold, as made by Auto_Threshold;
+		### virtual for tiled cells
+		stack = imp.getStack()
+		if stack.isVirtual():
+			return ImagePlus(imp.title, ThresholdStack(stack, threshold))
+		slices = ImageStack(imp.getWidth(), imp.getHeight())
+		for z in range(1, stack.getSize() + 1):
+			slices.addSlice(getThresholdMask(stack.getProcessor(z), threshold))
+		return ImagePlus(imp.title, slices)
+
+	def getPlaneValues(self, imp, z):
+		return imp.getStack().getProcessor(z).convertToFloat().getPixels()
+
+	def getPlanesValues(self, channels, z):
+		### Pixel values of plane z of the analysed channels, None for the others
+		planes = []
+		for c, method in enumerate(self.methods):
+			if method != "None":
+				planes.append(self.getPlaneValues(channels[c], z))
+			else:
+				planes.append(None)
+		return planes
+
+	def getPlanes(self, channels, z):
+		### Processors of plane z of the analysed channels, None for the others
+		planes = []
+		for c, method in enumerate(self.methods):
+			if method != "None":
+				planes.append(channels[c].getStack().getProcessor(z))
+			else:
+				planes.append(None)
+		return planes
+
+	def getPlaneHistograms(self, channels, z):
+		### ImageJ histograms of plane z of the analysed channels, up to the
+		### brightest voxel of the plane
+		histograms = []
+		for ip in self.getPlanes(channels, z):
+			if ip is not None:
+				top = ImageStatistics.getStatistics(ip, Measurements.MIN_MAX, None).max
+				ip = ip.getHistogram()[:int(top) + 1]
+			histograms.append(ip)
+		return histograms
+
+	def getManders(self, imp, cell, n = None, t = 1):
+		### n is the number of the cell, for the stage timings; t the frame
 	
 		### Crop channels according to cell mask
-		channels = self.getCroppedChannels(imp, cell)
-		if channels is None:
-			return None
+		with self.stage("crop", imp, n) as stage:
+			channels = self.getCroppedChannels(imp, cell, t)
+			if channels is None:
+				return None
+			stage.voxels = sum([self.getVoxels(channel) for channel in channels])
+		voxels = self.getVoxels(channels[0])
+		native = imp.getBitDepth() in (8, 16)
+
+		### Tiled cells are analysed in fixed memory, so they get no joint
+		### histograms (their Spearman's rho is NaN) and no Costes test, which
+		### shuffles the voxels of the whole cell
+		tiled = channels[0].getStack().isVirtual()
+		skipped = []
+		if tiled:
+			skipped = [name for name in self.coefficients if name == "Spearman"]
+			if self.costes > 0:
+				skipped.append("Costes test")
+			if skipped:
+				print "Cell %s of %s is tiled - no %s" % (n, imp.title, ", ".join(skipped))
 			
-		### Calculate channel thresholds
+		### Index the cell intensities. The histograms of 8 and 16-bit cells
+		### are ImageJ's, those of 32-bit cells come from the voxel index of
+		### colocCore; the pair sums are added once the thresholds are known
+		### (see below).
+		mask = cell.getMask(imp.getWidth(), imp.getHeight())
+		selected = [c + 1 for c, method in enumerate(self.methods) if method != "None"]
+		with self.stage("index", imp, n, voxels * len(selected)):
+			index = ColocIndex.forCoefficients(self.pairs, selected,
+				[name for name in self.coefficients if name not in skipped])
+			if native:
+				for k, (z, runs) in enumerate(mask.slices):
+					index.addHistograms(self.getPlaneHistograms(channels, k + 1), mask.width * mask.height,
+						sum([end - start for start, end in runs]))
+			else:
+				for k, (z, runs) in enumerate(mask.slices):
+					index.addValues(self.getPlanesValues(channels, k + 1), runs)
+
+		### Calculate channel thresholds from the cell histograms
 		thrs = []
 		thrimps = []
 		for c, method in enumerate(self.methods):
+			thr, thrimp = None, None
 			if method != "None":
-				thr, thrimp = self.getThreshold(channels[c], method)
-			else:
-				thr, thrimp = None, None
+				with self.stage("threshold", imp, n, voxels):
+					thr = self.getThreshold(index.getHistogram(c + 1), method)
+				if self.saveThresholded:
+					with self.stage("binarize", imp, n, voxels):
+						thrimp = self.getThresholdedImage(channels[c], thr)
 			thrs.append(thr)
 			thrimps.append(thrimp)
-		
-		### Calculate manders colocalization
-		manders = MandersColocalization()
+
+		### Manders coefficients of all pairs, from the index. Its pair sums
+		### take one more sweep over the planes of the cell, a single walk over
+		### the voxels that also sums what the other coefficients of all pairs
+		### need, now that the thresholds and the channel means are known.
 		raws = []
 		thrds = []
-		for chA, chB in self.pairs:
-			container = self.getContainer(channels[chA - 1], channels[chB - 1])
-			img1 = container.getSourceImage1()
-			img2 = container.getSourceImage2()
-			mask = container.getMask()
-			cursor = TwinCursor(img1.randomAccess(), img2.randomAccess(), Views.iterable(mask).localizingCursor())
-			rtype = img1.randomAccess().get().createVariable()
-			raw = manders.calculateMandersCorrelation(cursor, rtype)
-			rthr1 = rtype.copy()
-			rthr2 = rtype.copy()
-			rthr1.set(thrs[chA - 1])
-			rthr2.set(thrs[chB - 1])
-			cursor.reset()
-			thrd = manders.calculateMandersCorrelation(cursor, rthr1, rthr2, ThresholdMode.Above)
-			raws.append(raw)
-			thrds.append(thrd)
+		with self.stage("manders", imp, n, voxels * 2 * len(self.pairs)):
+			for k, (z, runs) in enumerate(mask.slices):
+				index.addSums(self.getPlanesValues(channels, k + 1), runs, thrs)
+			for chA, chB in self.pairs:
+				raws.append(index.getManders(chA, chB))
+				thrds.append(index.getManders(chA, chB, thrs[chA - 1], thrs[chB - 1]))
+
+		### Other coefficients, from the sums of the same sweep
+		others = None
+		if self.coefficients:
+			with self.stage("coefficients", imp, n, voxels * len(self.pairs)):
+				others = [index.getCoefficients(chA, chB, self.coefficients) for chA, chB in self.pairs]
+
+		### Significance of the colocalization by Costes randomization
+		costes = None
+		if self.costes > 0 and tiled:
+			costes = [(float('nan'),) * 3 for pair in self.pairs]
+		elif self.costes > 0:
+			costes = []
+			with self.stage("costes", imp, n, voxels * self.costes * len(self.pairs)):
+				for i, (chA, chB) in enumerate(self.pairs):
+					planesA = [self.getPlaneValues(channels[chA - 1], k + 1) for k in range(len(mask.slices))]
+					planesB = [self.getPlaneValues(channels[chB - 1], k + 1) for k in range(len(mask.slices))]
+					seed = ((self.seed * 1009 + (n or 0)) * 1009 + t) * 1009 + i
+					test = CostesTest(planesA, planesB, mask.width, mask.height, mask.slices,
+						self.costesBlock, thrs[chA - 1], thrs[chB - 1], seed)
+					costes.append(self.runCostes(test))
 		
-		return (channels, thrimps, thrs, raws, thrds)
+		return (channels, thrimps, thrs, raws, thrds, index, costes, others)
 
-	def saveMultichannelImage(self, title, channels, luts):
-		tmp = RGBStackMerge.mergeChannels(channels, False)
+	def getCostesPool(self):
+		self.lock.acquire()
+		try:
+			if self.costesPool is None:
+				self.costesPool = Executors.newFixedThreadPool(self.workers)
+			return self.costesPool
+		finally:
+			self.lock.release()
+
+	def runCostes(self, test):
+		### p-values of a Costes test; the randomizations are split into
+		### chunks, run in parallel
+		if not test.isValid():
+			return test.getPValues([0, 0, 0], self.costes)
+		chunks = min(self.workers, self.costes)
+		bounds = [self.costes * i // chunks for i in range(chunks + 1)]
+		tasks = [CostesTask(test, bounds[i], bounds[i + 1]) for i in range(chunks)]
+		if len(tasks) > 1:
+			results = [future.get() for future in self.getCostesPool().invokeAll(tasks)]
+		else:
+			results = [tasks[0].call()]
+		return test.getPValues([sum(counts) for counts in zip(*results)], self.costes)
+
+	def saveMultichannelImage(self, title, channels, luts, stage = None):
+		### stage times the writing of the image, done by the image writer;
+		### the planes of tiled cells are only read as they are written
+		if channels[0].getStack().isVirtual():
+			tmp = ImagePlus(title, MergedStack([channel.getStack() for channel in channels]))
+			tmp.setDimensions(len(channels), channels[0].getStackSize(), 1)
+			tmp = CompositeImage(tmp, CompositeImage.COMPOSITE)
+		else:
+			tmp = RGBStackMerge.mergeChannels(channels, False)
 		tmp.luts = luts
-		saver = FileSaver(tmp)
-		saver.saveAsTiffStack(self.outputDir + title + ".tif")
-		tmp.close()
+		if stage is not None:
+			stage.voxels = self.getVoxels(tmp)
+		self.writer.submit(SaveTask(tmp, self.outputDir + title, self.compress, stage))
+
+	def saveIndex(self, title, index, thrs, raws, thrds, others = None):
+		### The results go along with the index, so that colocNumpy.py can
+		### check them against the saved cell image
+		data = index.toDict()
+		data["methods"] = self.methods
+		data["thresholds"] = thrs
+		data["manders"] = [[list(pair), raws[i].m1, raws[i].m2, thrds[i].m1, thrds[i].m2]
+			for i, pair in enumerate(self.pairs)]
+		if others is not None:
+			data["coefficients"] = [[list(pair), others[i].items()] for i, pair in enumerate(self.pairs)]
+		indexFile = open(self.outputDir + title + ".json", "w")
+		try:
+			json.dump(data, indexFile)
+		finally:
+			indexFile.close()
+
+	def saveCells(self, cellsFile, cells):
+		### ROI sidecar readable by the ROI Manager: Cell_<n>-Slice_<z>.roi
+		### for 3D cells and Cell_<n>.roi for 2D cells
+		zos = ZipOutputStream(BufferedOutputStream(FileOutputStream(cellsFile)))
+		out = DataOutputStream(BufferedOutputStream(zos))
+		encoder = RoiEncoder(out)
+		try:
+			for cell in cells:
+				if cell.mode3D:
+					for z, aslice in enumerate(cell.slices):
+						if aslice.roi is not None:
+							zos.putNextEntry(ZipEntry("Cell_%i-Slice_%i.roi" % (cell.n, z + 1)))
+							encoder.write(aslice.roi)
+							out.flush()
+				elif cell.roi is not None:
+					zos.putNextEntry(ZipEntry("Cell_%i.roi" % cell.n))
+					encoder.write(cell.roi)
+					out.flush()
+		finally:
+			out.close()
+
+	def loadCells(self, cellsFile, nslices):
+		cells = {}
+		zis = ZipInputStream(BufferedInputStream(FileInputStream(cellsFile)))
+		try:
+			entry = zis.getNextEntry()
+			while entry is not None:
+				name = entry.getName()
+				data = ByteArrayOutputStream()
+				buf = jarray.zeros(8192, 'b')
+				size = zis.read(buf, 0, len(buf))
+				while size >= 0:
+					data.write(buf, 0, size)
+					size = zis.read(buf, 0, len(buf))
+				roi = RoiDecoder(data.toByteArray(), name).getRoi()
+				label = name[:name.rfind(".")].split("-")
+				n = int(label[0].split("_")[1])
+				if n not in cells:
+					cells[n] = Cell(nslices, n)
+				cell = cells[n]
+				if len(label) > 1:
+					z = int(label[1].split("_")[1])
+					if z <= nslices:
+						cell.mode3D = True
+						cell.name = "Cell %i (3D)" % n
+						cell.slices[z - 1].roi = roi
+				else:
+					cell.mode3D = False
+					cell.name = "Cell %i (2D)" % n
+					cell.roi = roi
+				entry = zis.getNextEntry()
+		finally:
+			zis.close()
+		return [cells[n] for n in sorted(cells)]
 
 	def createMainWindow(self):
 		self.frame = JFrame('Select cells and ROIs',
@@ -268,13 +918,16 @@ class MandersPlugin(ImageListener, WindowAdapter):
 				Insets(0, 2, 2, 0), 0, 0
 		))
 
-		self.frame.add(JButton('Add cell', actionPerformed = self.addCell),
+		self.editButtons = []
+		self.editButtons.append(JButton('Add cell', actionPerformed = self.addCell))
+		self.frame.add(self.editButtons[-1],
 			GridBagConstraints(1, 2, 1, 2, 0, .25,
 				GridBagConstraints.CENTER, GridBagConstraints.NONE,
 				Insets(0, 0, 0, 0), 0, 0
 		))
     	
-		self.frame.add(JButton('Remove cell', actionPerformed = self.removeCell),
+		self.editButtons.append(JButton('Remove cell', actionPerformed = self.removeCell))
+		self.frame.add(self.editButtons[-1],
 			GridBagConstraints(1, 4, 1, 2, 0, .25,
 				GridBagConstraints.CENTER, GridBagConstraints.NONE,
 				Insets(0, 5, 0, 5), 0, 0
@@ -298,13 +951,15 @@ class MandersPlugin(ImageListener, WindowAdapter):
 				Insets(0, 2, 2, 0), 0, 0
 		))
 
-		self.frame.add(JButton('Update ROI', actionPerformed = self.updateSlice),
+		self.editButtons.append(JButton('Update ROI', actionPerformed = self.updateSlice))
+		self.frame.add(self.editButtons[-1],
 			GridBagConstraints(1, 8, 1, 2, 0, .25,
 				GridBagConstraints.CENTER, GridBagConstraints.NONE,
 				Insets(0, 0, 0, 0), 0, 0
 		))
 
-		self.frame.add(JButton('Done', actionPerformed = self.doneSelecting),
+		self.editButtons.append(JButton('Done', actionPerformed = self.doneSelecting))
+		self.frame.add(self.editButtons[-1],
 			GridBagConstraints(1, 10, 1, 2, 0, .25,
 				GridBagConstraints.CENTER, GridBagConstraints.NONE,
 				Insets(0, 0, 0, 0), 0, 0
@@ -317,6 +972,27 @@ class MandersPlugin(ImageListener, WindowAdapter):
 				Insets(0, 0, 0, 0), 0, 0
 		))
 
+		self.progressBar = JProgressBar(0, 1, stringPainted = True)
+		self.frame.add(self.progressBar,
+			GridBagConstraints(0, 14, 2, 1, 1, 0,
+				GridBagConstraints.CENTER, GridBagConstraints.HORIZONTAL,
+				Insets(2, 2, 2, 2), 0, 0
+		))
+
+		self.statusLabel = JLabel(" ")
+		self.frame.add(self.statusLabel,
+			GridBagConstraints(0, 15, 1, 1, 1, 0,
+				GridBagConstraints.WEST, GridBagConstraints.NONE,
+				Insets(0, 2, 2, 0), 0, 0
+		))
+
+		self.cancelButton = JButton('Cancel', actionPerformed = self.cancelAnalysis, enabled = False)
+		self.frame.add(self.cancelButton,
+			GridBagConstraints(1, 15, 1, 1, 0, 0,
+				GridBagConstraints.CENTER, GridBagConstraints.NONE,
+				Insets(0, 5, 2, 5), 0, 0
+		))
+
 	def showMainWindow(self, cells = None):
 		if cells is not None:
 			self.cellList.model = cells
@@ -342,8 +1018,9 @@ class MandersPlugin(ImageListener, WindowAdapter):
 		else:
 			self.sliceList.enabled = False
 			if self.preview is None:
-				self.preview = self.previewImage(self.imp)
+				self.preview = self.previewImage(self.imp, self.getPreviewStep(self.imp))
 				self.displayImage(self.preview)
+				self.refreshPreview(self.imp, self.preview)
 			else:
 				self.preview.show()
 			if self.imp is not None:
@@ -363,6 +1040,7 @@ class MandersPlugin(ImageListener, WindowAdapter):
 			n = 1
 		self.cells.append(Cell(self.imp.NSlices, n))
 		self.cellList.selectedIndex = size
+		self.checkpointCells()
 
 	def removeCell(self, event):
 		selected = self.cellList.selectedIndex
@@ -372,6 +1050,7 @@ class MandersPlugin(ImageListener, WindowAdapter):
 				self.cellList.selectedIndex = selected - 1
 			else:
 				self.cellList.selectedIndex = 0
+			self.checkpointCells()
 
 	def selectCell(self, event):
 		selected = self.cellList.selectedIndex
@@ -404,6 +1083,7 @@ class MandersPlugin(ImageListener, WindowAdapter):
 			self.updateSlice3D(self.imp)
 		else:
 			self.updateSlice2D(self.preview)
+		self.checkpointCells()
 
 	def updateSlice3D(self, imp):
 		selectedCell = self.cellList.selectedIndex
@@ -417,6 +1097,7 @@ class MandersPlugin(ImageListener, WindowAdapter):
 				cell.mode3D = True
 				cell.name = "Cell %i (3D)" % cell.n
 				cell.slices[selectedSlice].roi = roi
+				cell.mask = None
 				if (index + 1 <= len(cell.slices)):
 					imp.z = index + 1			
 			self.cellList.repaint(self.cellList.getCellBounds(selectedCell, selectedCell))
@@ -432,6 +1113,7 @@ class MandersPlugin(ImageListener, WindowAdapter):
 				cell.mode3D = False
 				cell.name = "Cell %i (2D)" % cell.n
 				cell.roi = roi	
+				cell.mask = None
 			self.cellList.repaint(self.cellList.getCellBounds(selectedCell, selectedCell))
 	
 	def imageOpened(self, imp):
@@ -449,48 +1131,665 @@ class MandersPlugin(ImageListener, WindowAdapter):
 				self.sliceList.selectedIndex = selectedSlice
 
 	def doneSelecting(self, event):
-		oluts = self.imp.luts
+		if self.task is not None or self.imp is None:
+			return
+		self.cancelled = False
+		self.setBusy(True)
+		preview = not self.checkbox3D.isSelected()
+		self.task = Thread(target = self.finishImage, args = (preview,),
+			name = "mColoc3D analysis")
+		self.task.start()
+
+	def finishImage(self, preview):
+		### Analysis and loading of the next image run in the background, the
+		### window only shows their progress
+		analysed = False
+		try:
+			try:
+				self.saveCells(self.getCellsFile(self.imageFile, self.series), self.cells)
+			except IOException, e:
+				print "Could not save cells of %s: %s" % (self.imageFile, e)
+			if not self.analyseImage():
+				SwingUtilities.invokeLater(lambda: self.analysisDone(None, "Analysis cancelled", False))
+				return
+			self.checkpointImage()
+			analysed = True
+			### Loading cannot be cancelled; the analysed image stays current
+			### until the next one is loaded
+			SwingUtilities.invokeLater(lambda: self.cancelButton.setEnabled(False))
+			self.showStatus("Opening next image...")
+			loaded = self.loadNextFile(preview)
+		except:
+			SwingUtilities.invokeLater(lambda: self.analysisDone(None, "Analysis failed - see the log", analysed))
+			raise
+		SwingUtilities.invokeLater(lambda: self.analysisDone(loaded))
+
+	def analysisDone(self, loaded, failure = None, analysed = True):
+		### An analysed image is closed even if the next one failed to load,
+		### so it cannot be analysed twice
+		self.task = None
+		if analysed:
+			self.closeImage()
+		if failure is not None:
+			self.setBusy(False)
+			self.statusLabel.text = failure
+			return
+		self.results.show("Manders collocalization results")
+		if not self.showFile(loaded):
+			self.printTimings()
+			print "All done - happy analysis!"
+			shutil.rmtree(os.path.join(self.outputDir, sessionDir), True)
+			self.exit()
+			return
+		self.setBusy(False)
+
+	def cancelAnalysis(self, event):
+		self.cancelled = True
+		self.showStatus("Cancelling...")
+
+	def setBusy(self, busy):
+		### Cells can only be edited while an image is open and not analysed
+		editable = not busy and self.imp is not None
+		for component in self.editButtons + [self.checkbox3D, self.cellList]:
+			component.enabled = editable
+		self.sliceList.enabled = editable and self.checkbox3D.isSelected()
+		self.cancelButton.enabled = busy
+		if not busy:
+			self.progressBar.value = 0
+
+	def showStatus(self, status):
+		SwingUtilities.invokeLater(lambda: self.statusLabel.setText(status))
+
+	def reportProgress(self, progress):
+		def update():
+			self.progressBar.maximum = progress.total
+			self.progressBar.value = progress.cells
+			self.statusLabel.text = progress.getStatus()
+		SwingUtilities.invokeLater(update)
+
+	def getCache(self):
+		if not self.useCache:
+			return None
+		if self.cache is None or self.cache.cacheDir != os.path.join(self.outputDir, ".cache"):
+			self.cache = colocBatch.ResultCache(self.outputDir, self.hashContent)
+		return self.cache
+
+	def getCacheKeys(self, cells, frames = 1):
+		### Cache keys of the cells of the current series at every frame, by
+		### (cell number, frame), or None without cache
+		cache = self.getCache()
+		if cache is None:
+			return None
+		imageHash = cache.getFileHash(self.imageFile)
+		settings = {"version": colocBatch.resultsVersion, "methods": self.methods,
+			"compress": self.compress, "thresholded": self.saveThresholded}
+		if self.costes > 0:
+			settings["costes"] = [self.costes, list(self.costesBlock), self.seed]
+		if self.coefficients:
+			settings["coefficients"] = self.coefficients
+		name = os.path.basename(self.imageFile)
+		keys = {}
+		for i, cell in enumerate(cells):
+			rois = cell.getRoiData()
+			for t in range(1, frames + 1):
+				keys[(i + 1, t)] = cache.getKey(settings, imageHash, name, i + 1, rois, self.series, t)
+		return keys
+
+	def getCachedResults(self, keys):
+		### Cached results of the cells, by (cell number, frame)
+		cached = {}
+		if keys is not None:
+			for task, key in keys.items():
+				values = self.cache.get(key)
+				if values is not None:
+					cached[task] = values
+		return cached
+
+	def analyseImage(self, stream = False):
+		### Cells are independent, and so are the frames of a time-lapse -
+		### analyse every cell at every frame on a pool of workers and add
+		### their results in the order of the cell list, frame by frame.
+		### Cells with cached results are not analysed again. With stream, the
+		### row of a cell is written as soon as it and the cells before it are
+		### done; otherwise rows are added once the image is done. Returns
+		### False if the analysis was cancelled; no results are added then.
+		frames = self.imp.getNFrames()
+		keys = self.getCacheKeys(self.cells, frames)
+		cached = self.getCachedResults(keys)
+		order = [(n, t) for n in range(1, len(self.cells) + 1) for t in range(1, frames + 1)]
+		tasks = {}
+		for n, t in order:
+			if (n, t) not in cached:
+				cell = self.cells[n - 1]
+				### Rasterized once, before the frames of the cell run in parallel
+				cell.getMask(self.imp.getWidth(), self.imp.getHeight())
+				tasks[(n, t)] = CellTask(self, self.imp, cell, n, t)
+		if tasks:
+			self.imp.getStack()
+		self.progress = Progress(len(tasks))
+		self.reportProgress(self.progress)
+		pool = None
+		if self.workers > 1 and len(tasks) > 1:
+			pool = Executors.newFixedThreadPool(min(self.workers, len(tasks)))
+		rows = []
+		outputs = []
+		try:
+			futures = {}
+			if pool is not None:
+				for n in sorted(tasks):
+					futures[n] = pool.submit(tasks[n])
+			for task in order:
+				if task in cached:
+					values = cached[task]
+				else:
+					result = futures[task].get() if task in futures else tasks[task].call()
+					if result is None:
+						continue
+					values, files = result
+					outputs.append((task, values, files))
+				if stream:
+					self.addResults(task[0], values, task[1])
+				else:
+					rows.append((task, values))
+		finally:
+			if pool is not None:
+				pool.shutdown()
+		self.writer.flush()
+		if self.cancelled:
+			return False
+		for (n, t), values in rows:
+			self.addResults(n, values, t)
+		if keys is not None:
+			for task, values, files in outputs:
+				self.cache.put(keys[task], values, files)
+		return True
+
+	def analyseCell(self, imp, cell, index, frame = 1):
+		if self.cancelled:
+			return None
+		manders = self.getManders(imp, cell, index, frame)
+		self.progress.add(cells = 1)
+		self.reportProgress(self.progress)
+		if manders is None:
+			return None
+		oluts = imp.luts
 		luts = []
-		channels = []
 		for c, method in enumerate(self.methods):
 			if method != "None":
 				luts.append(oluts[c])
-				channels.append(c)
-		for cell in self.cells:
-			manders = self.getManders(self.imp, cell)
-			if manders is not None:
-				chimps, thrimps, thrs, raws, thrds = manders
-				index = self.cells.index(cell) + 1
-				title = "Cell_%i-" % index + self.imp.title
-				self.saveMultichannelImage(title, chimps, oluts)
-				title = "Cell_%i_thrd-" % index + self.imp.title
-				self.saveMultichannelImage(title, thrimps, luts)
-				self.results.incrementCounter()
-				row = self.results.getCounter() - 1
-				for i, thr in enumerate(thrs):
-					if thr is not None:
-						self.results.setValue("Threshold %i" % (i + 1), row, int(thr))
-				for i, pair in enumerate(self.pairs):
-					self.results.setValue("%i-%i M1 raw" % pair, row, float(raws[i].m1))
-					self.results.setValue("%i-%i M2 raw" % pair, row, float(raws[i].m2))
-					self.results.setValue("%i-%i M1 thrd" % pair, row, float(thrds[i].m1))
-					self.results.setValue("%i-%i M2 thrd" % pair, row, float(thrds[i].m2))
-		self.closeImage()
-		if not self.processNextFile():
-			print "All done - happy analysis!"
-			self.results.show("Manders collocalization results")
-			self.exit()
+		chimps, thrimps, thrs, raws, thrds, cindex, costes, others = manders
+		extension = ".zip" if self.compress else ".tif"
+		label = "Cell_%i" % index
+		if imp.getNFrames() > 1:
+			label += "_t%i" % frame
+		title = label + "-" + imp.title
+		self.saveMultichannelImage(title, chimps, oluts, self.stage("save", imp, index))
+		self.saveIndex(title, cindex, thrs, raws, thrds, others)
+		files = [self.outputDir + title + extension, self.outputDir + title + ".json"]
+		if self.saveThresholded:
+			title = label + "_thrd-" + imp.title
+			self.saveMultichannelImage(title, thrimps, luts, self.stage("save", imp, index))
+			files.append(self.outputDir + title + extension)
+		return (self.getResultValues(thrs, raws, thrds, costes, others), files)
+
+	def getResultValues(self, thrs, raws, thrds, costes = None, others = None):
+		values = OrderedDict()
+		for i, thr in enumerate(thrs):
+			if thr is not None:
+				values["Threshold %i" % (i + 1)] = int(thr)
+		for i, pair in enumerate(self.pairs):
+			values["%i-%i M1 raw" % pair] = float(raws[i].m1)
+			values["%i-%i M2 raw" % pair] = float(raws[i].m2)
+			values["%i-%i M1 thrd" % pair] = float(thrds[i].m1)
+			values["%i-%i M2 thrd" % pair] = float(thrds[i].m2)
+			if others is not None:
+				for name, value in others[i].items():
+					values[("%i-%i " % pair) + name] = float(value)
+			if costes is not None:
+				### p-values of Pearson's r and of the thresholded M1 and M2
+				values["%i-%i Costes P" % pair] = float(costes[i][0])
+				values["%i-%i Costes P M1" % pair] = float(costes[i][1])
+				values["%i-%i Costes P M2" % pair] = float(costes[i][2])
+		return values
+
+	def addResults(self, cell, results, frame = 1):
+		### Cell is the number in the Cell_<n>-<image> file names; series
+		### and frame are 1-based
+		values = OrderedDict()
+		values["Image"] = os.path.basename(self.imageFile)
+		values["Series"] = self.series + 1
+		values["Cell"] = cell
+		values["Frame"] = frame
+		values.update(results)
+		self.addRow(values)
+
+	def addRow(self, values):
+		self.resultsWriter.write(values)
+
+	def printTimings(self):
+		print "Stage timings (details in %s):" % colocBatch.timingsName
+		for line in self.timer.getSummary():
+			print line
 
 	def windowClosing(self, e):
 		print "Closing plugin - BYE!!!"
 		self.exit()
 
+	def shutdownCostes(self):
+		if self.costesPool is not None:
+			self.costesPool.shutdown()
+			self.costesPool = None
+
 	def exit(self):
 		ImagePlus.removeImageListener(self)
+		self.prefetcher.shutdown()
+		self.writer.shutdown()
+		self.shutdownCostes()
+		if self.resultsWriter is not None:
+			self.resultsWriter.close()
+		self.timer.close()
 		self.closeImage()
 		self.closeMainWindow()
 
 
+class Progress(object):
+
+	def __init__(self, total):
+		self.total = total
+		self.cells = 0
+		self.bytes = 0
+		self.start = time.time()
+		self.lock = Lock()
+
+	def add(self, cells = 0, bytes = 0):
+		self.lock.acquire()
+		try:
+			self.cells += cells
+			self.bytes += bytes
+		finally:
+			self.lock.release()
+
+	def getStatus(self):
+		elapsed = max(time.time() - self.start, 1e-3)
+		return "Cell %i of %i - %.2f cells/s, %.1f MB/s read" % (self.cells, self.total,
+			self.cells / elapsed, self.bytes / elapsed / (1 << 20))
+
+
+class PrefetchedImage(object):
+
+	def __init__(self, imp, preview = None, stretched = False):
+		self.imp = imp
+		self.preview = preview
+		self.stretched = stretched
+
+	def close(self):
+		if self.imp is not None:
+			PlaneReader.release(self.imp)
+			self.imp.close()
+		if self.preview is not None:
+			self.preview.close()
+
+
+class PrefetchTask(Callable):
+
+	def __init__(self, plugin, prefetcher, imageFile, stretch, preview):
+		self.plugin = plugin
+		self.prefetcher = prefetcher
+		self.imageFile = imageFile
+		self.stretch = stretch
+		self.preview = preview
+
+	def call(self):
+		### None if the image does not fit in memory now; it is then opened
+		### when its turn comes
+		if not self.prefetcher.reserve(self.imageFile):
+			return None
+		imp = self.plugin.loadImage(self.imageFile)
+		if imp is None or imp.getNChannels() < 2 or not self.stretch:
+			return PrefetchedImage(imp)
+		self.plugin.displayImage(imp, False)
+		preview = None
+		if self.preview:
+			preview = self.plugin.previewImage(imp)
+			self.plugin.displayImage(preview, False)
+		return PrefetchedImage(imp, preview, True)
+
+
+class ProjectionTask(Callable):
+
+	### MAX projection of channel c over some slices
+
+	def __init__(self, plugin, imp, c, slices):
+		self.plugin = plugin
+		self.imp = imp
+		self.c = c
+		self.slices = slices
+
+	def call(self):
+		projection = None
+		for z in self.slices:
+			plane = self.plugin.getPlane(self.imp, self.c, z)
+			if projection is None:
+				projection = plane.duplicate()
+			else:
+				projection.copyBits(plane, 0, 0, Blitter.MAX)
+		return projection
+
+
+class ImagePrefetcher(object):
+
+	### Opens the next images on a background thread, while the current one
+	### is annotated or analysed. Images are only prefetched while their
+	### estimated size fits in memoryCap of the free heap. Sizes are read
+	### from the Bio-Formats metadata on the background thread too, as
+	### prefetch is called on the event dispatch thread.
+
+	def __init__(self, plugin, depth = 1, memoryCap = 0.5):
+		self.plugin = plugin
+		self.depth = depth
+		self.memoryCap = memoryCap
+		self.executor = None
+		self.pending = {}
+		self.sizes = {}
+		self.lock = Lock()
+
+	def prefetch(self, files, stretch = False, preview = False):
+		if self.executor is None:
+			self.executor = Executors.newSingleThreadExecutor()
+		for imageFile in files[:self.depth]:
+			if imageFile in self.pending:
+				continue
+			task = PrefetchTask(self.plugin, self, imageFile, stretch, preview)
+			self.pending[imageFile] = self.executor.submit(task)
+
+	def reserve(self, imageFile):
+		### Called by the prefetching thread: whether the image fits in what
+		### is left of memoryCap, which it then takes until it is taken
+		size = self.plugin.getImageSize(imageFile)
+		if self.plugin.isLazy(imageFile):
+			size = self.plugin.cacheSize
+		self.lock.acquire()
+		try:
+			free = (IJ.maxMemory() - IJ.currentMemory()) * self.memoryCap - sum(self.sizes.values())
+			if size > free:
+				return False
+			self.sizes[imageFile] = size
+			return True
+		finally:
+			self.lock.release()
+
+	def take(self, imageFile):
+		### The prefetched image, or None if it has to be opened now
+		if imageFile not in self.pending:
+			return None
+		future = self.pending.pop(imageFile)
+		try:
+			return future.get()
+		except ExecutionException, e:
+			print "Prefetching %s failed: %s" % (imageFile, e.getCause())
+			return None
+		finally:
+			self.lock.acquire()
+			try:
+				self.sizes.pop(imageFile, None)
+			finally:
+				self.lock.release()
+
+	def shutdown(self):
+		if self.executor is not None:
+			self.executor.shutdownNow()
+			self.executor = None
+		for imageFile, future in self.pending.items():
+			if future.isDone() and not future.isCancelled():
+				try:
+					prefetched = future.get()
+					if prefetched is not None:
+						prefetched.close()
+				except ExecutionException:
+					pass
+		self.pending = {}
+		self.sizes = {}
+
+
+def getThresholdMask(ip, threshold):
+	### Binary mask (255) of the pixels of ip above threshold (v > t); the
+	### lower bound of 32-bit ip is the next float after the threshold, as
+	### fractional intensities between t and t + 1 are above it too
+	lower = threshold + 1
+	if ip.getBitDepth() == 32:
+		lower = Math.nextUp(float(threshold))
+	if lower > ip.maxValue():
+		return ByteProcessor(ip.getWidth(), ip.getHeight())
+	ip.setThreshold(lower, ip.maxValue(), ImageProcessor.NO_LUT_UPDATE)
+	return ip.createMask()
+
+
+class CellStack(VirtualStack):
+
+	### One channel of a tiled cell: plane n is the crop of slice n of the
+	### cell mask, zero outside the mask, made when it is read - the same
+	### planes MandersPlugin.getCroppedChannels keeps in memory otherwise
+
+	def __init__(self, plugin, imp, c, mask, t = 1):
+		VirtualStack.__init__(self, mask.width, mask.height, None, None)
+		self.plugin = plugin
+		self.imp = imp
+		self.c = c
+		self.mask = mask
+		self.t = t
+		self.crop = Rectangle(mask.x, mask.y, mask.width, mask.height)
+
+	def getSize(self):
+		return len(self.mask.slices)
+
+	def getProcessor(self, n):
+		z, runs = self.mask.slices[n - 1]
+		nslice = self.plugin.cropPlane(self.imp, self.c, z, self.crop, self.t)
+		nslice.copyBits(self.plugin.getMaskProcessor(self.imp, self.mask, runs), 0, 0, Blitter.MULTIPLY)
+		return nslice
+
+	def getPixels(self, n):
+		return self.getProcessor(n).getPixels()
+
+	def getSliceLabel(self, n):
+		return None
+
+
+class ThresholdStack(VirtualStack):
+
+	### Binary planes of the voxels of a virtual stack above threshold
+
+	def __init__(self, stack, threshold):
+		VirtualStack.__init__(self, stack.getWidth(), stack.getHeight(), None, None)
+		self.stack = stack
+		self.threshold = threshold
+
+	def getSize(self):
+		return self.stack.getSize()
+
+	def getProcessor(self, n):
+		return getThresholdMask(self.stack.getProcessor(n), self.threshold)
+
+	def getPixels(self, n):
+		return self.getProcessor(n).getPixels()
+
+	def getSliceLabel(self, n):
+		return None
+
+
+class MergedStack(VirtualStack):
+
+	### Channel interleaved view of one virtual stack per channel, in the
+	### order of RGBStackMerge.mergeChannels
+
+	def __init__(self, stacks):
+		VirtualStack.__init__(self, stacks[0].getWidth(), stacks[0].getHeight(), None, None)
+		self.stacks = stacks
+
+	def getSize(self):
+		return len(self.stacks) * self.stacks[0].getSize()
+
+	def getProcessor(self, n):
+		z, c = divmod(n - 1, len(self.stacks))
+		return self.stacks[c].getProcessor(z + 1)
+
+	def getPixels(self, n):
+		return self.getProcessor(n).getPixels()
+
+	def getSliceLabel(self, n):
+		return None
+
+
+class PlaneReader(object):
+
+	### Reads planes, or regions of planes, of a lazily loaded image from
+	### disk. Whole planes are kept in a least recently used cache of at most
+	### cacheSize bytes; cell crops are read as regions and not cached.
+
+	def __init__(self, imageFile, cacheSize, series = 0):
+		self.reader = ImageProcessorReader(ChannelSeparator(LociPrefs.makeImageReader()))
+		self.reader.setId(imageFile)
+		self.reader.setSeries(series)
+		self.cacheSize = cacheSize
+		self.cached = 0
+		self.cache = OrderedDict()
+		self.lock = Lock()
+
+	@staticmethod
+	def release(imp):
+		reader = imp.getProperty(readerProperty)
+		if reader is not None:
+			reader.close()
+			imp.getProperties().remove(readerProperty)
+
+	def getBytes(self, ip):
+		return ip.getPixelCount() * max(1, ip.getBitDepth() / 8)
+
+	def getPlane(self, c, z, t = 1):
+		no = self.reader.getIndex(z - 1, c - 1, t - 1)
+		self.lock.acquire()
+		try:
+			ip = self.cache.pop(no, None)
+			if ip is None:
+				ip = self.reader.openProcessors(no)[0]
+				self.cached += self.getBytes(ip)
+			self.cache[no] = ip
+			while self.cached > self.cacheSize and len(self.cache) > 1:
+				self.cached -= self.getBytes(self.cache.popitem(False)[1])
+			return ip
+		finally:
+			self.lock.release()
+
+	def getRegion(self, c, z, crop, t = 1):
+		no = self.reader.getIndex(z - 1, c - 1, t - 1)
+		self.lock.acquire()
+		try:
+			ip = self.cache.get(no)
+			if ip is not None:
+				ip.setRoi(crop)
+				region = ip.crop()
+				ip.resetRoi()
+				return region
+			return self.reader.openProcessors(no, crop.x, crop.y, crop.width, crop.height)[0]
+		finally:
+			self.lock.release()
+
+	def close(self):
+		self.lock.acquire()
+		try:
+			self.cache.clear()
+			self.cached = 0
+			self.reader.close()
+		finally:
+			self.lock.release()
+
+
+class SaveTask(Runnable):
+
+	def __init__(self, imp, path, compress, stage = None):
+		self.imp = imp
+		self.path = path
+		self.compress = compress
+		self.stage = stage
+
+	def run(self):
+		if self.stage is not None:
+			with self.stage:
+				self.save()
+		else:
+			self.save()
+
+	def save(self):
+		saver = FileSaver(self.imp)
+		if self.compress:
+			saver.saveAsZip(self.path + ".zip")
+		else:
+			saver.saveAsTiffStack(self.path + ".tif")
+		self.imp.close()
+
+
+class ImageWriter(object):
+
+	### Output stage: images are written by a background thread, so saving
+	### overlaps with the analysis of the next cells. At most capacity images
+	### wait in the queue; when it is full the caller writes the image itself.
+
+	def __init__(self, capacity = 4, threads = 1):
+		self.executor = ThreadPoolExecutor(threads, threads, 0, TimeUnit.SECONDS,
+			ArrayBlockingQueue(capacity), ThreadPoolExecutor.CallerRunsPolicy())
+		self.futures = []
+		self.lock = Lock()
+
+	def submit(self, task):
+		future = self.executor.submit(task)
+		self.lock.acquire()
+		try:
+			self.futures.append(future)
+		finally:
+			self.lock.release()
+
+	def flush(self):
+		### Wait for everything queued so far; errors of the writes surface here
+		self.lock.acquire()
+		try:
+			futures = self.futures
+			self.futures = []
+		finally:
+			self.lock.release()
+		for future in futures:
+			future.get()
+
+	def shutdown(self):
+		try:
+			self.flush()
+		finally:
+			self.executor.shutdown()
+
+
+class CostesTask(Callable):
+
+	def __init__(self, test, start, stop):
+		self.test = test
+		self.start = start
+		self.stop = stop
+
+	def call(self):
+		return self.test.run(self.start, self.stop)
+
+
+class CellTask(Callable):
+
+	def __init__(self, plugin, imp, cell, index, frame = 1):
+		self.plugin = plugin
+		self.imp = imp
+		self.cell = cell
+		self.index = index
+		self.frame = frame
+
+	def call(self):
+		return self.plugin.analyseCell(self.imp, self.cell, self.index, self.frame)
+
+
 class Cell(object):
 
 	def __init__(self, nslices, n, mode3D = True):
@@ -500,6 +1799,7 @@ class Cell(object):
 		self.initSlices(nslices)
 		self.name = "Cell %i (none)" % self.n
 		self.mode3D = mode3D
+		self.mask = None
 	
 	def initSlices(self, nslices):
 		for i in range(1, nslices + 1):
@@ -520,16 +1820,54 @@ class Cell(object):
 				return False
 		return True
 			
-	def getCropRoi(self):
-		crop = None
-		for aslice in self.slices:
-			roi = aslice.roi
-			if roi is not None:
-				if crop is None:
-					crop = roi.clone()
-				else:
-					crop.or(roi)
-		return crop
+	def getRois(self):
+		### (z, roi) of every slice of the cell
+		if self.mode3D:
+			return [(z + 1, self.slices[z].roi) for z in range(len(self.slices))
+				if self.slices[z].roi is not None]
+		elif self.roi is not None:
+			return [(z + 1, self.roi) for z in range(len(self.slices))]
+		return []
+
+	def getRoiData(self):
+		### Serialized ROIs, to tell whether the cell has changed
+		data = ByteArrayOutputStream()
+		out = DataOutputStream(data)
+		for z, roi in self.getRois():
+			roiBytes = RoiEncoder.saveAsByteArray(roi)
+			out.writeInt(z)
+			out.writeInt(len(roiBytes))
+			out.write(roiBytes)
+		out.flush()
+		return data.toByteArray().tostring()
+
+	def getMask(self, width, height):
+		### Rasterize the slice ROIs once; updating a ROI resets the mask
+		if self.mask is not None:
+			return self.mask
+		rois = self.getRois()
+		if not rois:
+			return None
+		bounds = None
+		for z, roi in rois:
+			if bounds is None:
+				bounds = roi.getBounds()
+			else:
+				bounds = bounds.union(roi.getBounds())
+		bounds = bounds.intersection(Rectangle(0, 0, width, height))
+		if bounds.isEmpty():
+			return None
+		mask = CellMask(bounds.x, bounds.y, bounds.width, bounds.height)
+		rasterized = {}
+		for z, roi in rois:
+			if id(roi) not in rasterized:
+				r = roi.getBounds()
+				ip = roi.getMask()
+				pixels = ip.getPixels() if ip is not None else None
+				rasterized[id(roi)] = mask.getRoiRuns(pixels, r.x, r.y, r.width, r.height)
+			mask.addSlice(z, rasterized[id(roi)])
+		self.mask = mask
+		return mask
 
 		
 class Slice(object):
@@ -557,4 +1895,170 @@ class MyRenderer(DefaultListCellRenderer):
 		return c
 
 
-colocalizer = MandersPlugin()
+class MandersBatch(MandersPlugin):
+
+	### Headless variant: cells come from the ROI sidecar saved next to each
+	### image (see MandersPlugin.saveCells) and no window is ever shown
+
+	def __init__(self, inputDir, outputDir, methods, workers = None, shard = (0, 1)):
+		self.initAnalysis()
+		self.inputDir = inputDir
+		self.files = self.listImages(inputDir)
+		self.outputDir = os.path.join(outputDir, "")
+		self.shard, self.shards = shard
+		self.setMethods(methods)
+		if workers is not None:
+			self.workers = max(1, workers)
+
+	def reportProgress(self, progress):
+		if progress.total and progress.cells == progress.total:
+			print progress.getStatus()
+
+	def getCachedImage(self, imageFile, series = 0):
+		### Cached results of a series whose cells are all cached at every
+		### frame, or None if some cells have to be analysed
+		if self.getCache() is None:
+			return None
+		self.imageFile = imageFile
+		self.series = series
+		try:
+			slices, frames = self.getSeriesSize(imageFile, series)
+			cells = self.loadCells(self.getCellsFile(imageFile, series), slices)
+		except Exception:
+			return None
+		keys = self.getCacheKeys(cells, frames)
+		cached = self.getCachedResults(keys)
+		if not cells or len(cached) < len(keys):
+			return None
+		return cached
+
+	def run(self):
+		files = [f for f in self.files if os.path.exists(self.getCellsFile(f))]
+		for imageFile in self.files:
+			if imageFile not in files:
+				print "Skipping %s - no cells file" % imageFile
+		if self.shards > 1:
+			files = colocBatch.loadManifest(self.outputDir, self.inputDir, files)
+			files = colocBatch.getShard(files, self.shard, self.shards)
+			print "Shard %i of %i - %i images" % (self.shard + 1, self.shards, len(files))
+		### Every series with a cells file is analysed, one at a time
+		items = []
+		for imageFile in files:
+			for series in range(self.getSeriesCount(imageFile)):
+				if os.path.exists(self.getCellsFile(imageFile, series)):
+					items.append((imageFile, series))
+		### Series with all cells cached are not opened, nor prefetched
+		cachedItems = set([item for item in items if self.getCachedImage(*item) is not None])
+		self.resultsWriter = colocBatch.ResultsWriter(
+			colocBatch.getShardFile(self.outputDir, self.shard, self.shards), partial = self.shards > 1)
+		self.timer = colocBatch.StageTimer(
+			colocBatch.getTimingsFile(self.outputDir, self.shard, self.shards), IJ.currentMemory)
+		for i, (imageFile, series) in enumerate(items):
+			name = imageFile if series == 0 else "%s (series %i)" % (imageFile, series + 1)
+			if (imageFile, series) in cachedItems:
+				print "Using cached results of " + name
+				cached = self.getCachedImage(imageFile, series)
+				for n, t in sorted(cached):
+					self.addResults(n, cached[(n, t)], t)
+				continue
+			### Only first series are prefetched
+			prefetched = self.prefetcher.take(imageFile) if series == 0 else None
+			imp = self.openImage(imageFile, prefetched, series)
+			self.prefetcher.prefetch([f for f, s in items[i + 1:] if s == 0 and (f, s) not in cachedItems])
+			if imp is None:
+				continue
+			self.imp = imp
+			if imp.getNChannels() != len(self.methods):
+				print "Skipping %s - %i channels, but %i threshold methods" % \
+					(name, imp.getNChannels(), len(self.methods))
+				self.closeImage()
+				continue
+			print "Processing " + name
+			self.imageFile = imageFile
+			self.series = series
+			self.cells = self.loadCells(self.getCellsFile(imageFile, series), imp.getNSlices())
+			self.analyseImage(True)
+			self.closeImage()
+		self.prefetcher.shutdown()
+		self.writer.shutdown()
+		self.shutdownCostes()
+		self.resultsWriter.close()
+		self.timer.close()
+		if self.shards > 1 and colocBatch.isComplete(self.outputDir, self.shards):
+			### The last shard to finish merges the results of all
+			print "Merged %i cells" % colocBatch.mergeTables(self.outputDir, self.shards)
+		self.printTimings()
+		print "All done - happy analysis!"
+
+
+def main(args):
+	args = [arg for arg in args if arg]
+	if not args:
+		return MandersPlugin()
+	parser = argparse.ArgumentParser(prog = "mColoc3D.py",
+		description = "Measure Manders colocalization of the cells saved next to each image.")
+	parser.add_argument("inputDir", help = "directory with images and their %s files" % colocBatch.cellsSuffix)
+	parser.add_argument("outputDir", help = "directory to save the results to")
+	parser.add_argument("--methods", required = True,
+		help = "threshold method for each channel, comma separated, e.g. None,Mean,Otsu")
+	parser.add_argument("--workers", type = int, default = None,
+		help = "number of cells analysed in parallel (default: ImageJ thread count)")
+	parser.add_argument("--loading", choices = ["auto", "lazy", "memory"], default = "auto",
+		help = "read planes from disk on demand (lazy) or load whole images (memory); "
+			"auto loads lazily images larger than half of the free memory")
+	parser.add_argument("--cells", choices = ["auto", "tiled", "memory"], default = "auto",
+		help = "crop cells one plane at a time as they are analysed and saved (tiled), or crop "
+			"them in memory; auto tiles cells whose crops would take more than half of the free memory")
+	parser.add_argument("--cache-mb", type = int, default = None,
+		help = "size of the plane cache of lazily loaded images")
+	parser.add_argument("--compress", action = "store_true",
+		help = "save cell images as ZIP compressed TIFFs")
+	parser.add_argument("--no-thresholded", action = "store_true",
+		help = "do not save the thresholded cell images")
+	parser.add_argument("--costes", type = int, default = 0, metavar = "N",
+		help = "test the significance of the colocalization of every cell with N Costes "
+			"randomizations (p-values of Pearson's r and the thresholded M1 and M2)")
+	parser.add_argument("--costes-block", default = "3,3,1", metavar = "X,Y,Z",
+		help = "size of the blocks shuffled by the Costes test, in voxels (about the PSF size)")
+	parser.add_argument("--seed", type = int, default = 0,
+		help = "random seed of the Costes test")
+	parser.add_argument("--coefficients", default = "none", metavar = "NAMES",
+		help = "comma separated coefficients computed besides Manders' M1 and M2, "
+			"of %s, or none" % ", ".join(coefficients))
+	parser.add_argument("--no-cache", action = "store_true",
+		help = "analyse all cells, even those with results cached in the output directory")
+	parser.add_argument("--hash-content", action = "store_true",
+		help = "find cached results by the SHA-1 of the whole image files, instead of their size, "
+			"modification time and sampled blocks")
+	parser.add_argument("--shard", type = colocBatch.parseShard, default = (0, 1),
+		help = "analyse only shard i of N of the input directory, e.g. 2/8 "
+			"(see colocBatch.py); results go to Results-i-of-N.csv")
+	parser.add_argument("--verify", metavar = "PYTHON", default = None,
+		help = "check the results with colocNumpy.py, run by this CPython interpreter")
+	options = parser.parse_args(args)
+	if options.costes > 0 and options.cells == "tiled":
+		parser.error("the Costes test shuffles whole cells and cannot run with --cells tiled")
+	batch = MandersBatch(options.inputDir, options.outputDir, options.methods.split(","),
+		options.workers, options.shard)
+	batch.lazy = {"auto": None, "lazy": True, "memory": False}[options.loading]
+	batch.tiled = {"auto": None, "tiled": True, "memory": False}[options.cells]
+	batch.compress = options.compress
+	batch.saveThresholded = not options.no_thresholded
+	batch.useCache = not options.no_cache
+	batch.hashContent = options.hash_content
+	batch.costes = max(0, options.costes)
+	batch.costesBlock = tuple([max(1, int(size)) for size in options.costes_block.split(",")])
+	batch.seed = options.seed
+	names = [name.strip().lower() for name in options.coefficients.split(",")]
+	batch.coefficients = [name for name in coefficients if name.lower() in names]
+	if options.cache_mb is not None:
+		batch.cacheSize = options.cache_mb << 20
+	batch.run()
+	if options.verify is not None:
+		status, output = runCPython(options.verify, [batch.outputDir])
+		print output
+	return batch
+
+
+if __name__ in ['__builtin__', '__main__']:
+	colocalizer = main(getattr(sys, "argv", [])[1:])
@@ -7,24 +7,31 @@
 ### @license Licensed under GPLv3 and CC BY 4.0
 
 import os
+import math
+import jarray
+from collections import OrderedDict
 
-from ij import IJ, ImagePlus, ImageStack
-from ij.io import DirectoryChooser, OpenDialog, FileSaver
+from ij import IJ, ImagePlus, ImageStack, Prefs
+from ij.io import DirectoryChooser, OpenDialog, FileSaver, RoiDecoder, RoiEncoder
 from ij.gui import WaitForUserDialog
-from ij.measure import ResultsTable
-from ij.plugin import ChannelSplitter, RGBStackMerge, ZProjector, ContrastEnhancer, CompositeConverter, Duplicator
+from ij.measure import Measurements, ResultsTable
+from ij.plugin import RGBStackMerge, ContrastEnhancer, CompositeConverter, Duplicator
 from ij.plugin.frame import RoiManager
-from ij.process import Blitter, ImageConverter
-from fiji.threshold import Auto_Threshold
+from ij.process import (AutoThresholder, Blitter, ByteProcessor, ImageConverter, ImageProcessor,
+	ImageStatistics)
 from loci.plugins import BF
-from loci.formats import UnknownFormatException
+from loci.plugins.in import ImporterOptions
+from loci.formats import FormatTools, ImageReader, UnknownFormatException
+from java.awt import Rectangle
+from java.lang import Math
+from java.io import (BufferedInputStream, BufferedOutputStream, ByteArrayOutputStream,
+	DataOutputStream, FileInputStream, FileOutputStream)
+from java.util.zip import ZipEntry, ZipInputStream, ZipOutputStream
+from java.util.concurrent import Callable, Executors
 
-from algorithms import MandersColocalization
-from net.imglib2 import TwinCursor
-from net.imglib2.img import ImagePlusAdapter
-from net.imglib2.view import Views
-from gadgets import DataContainer
-from gadgets import ThresholdMode
+from colocCore import (CellMask, ColocIndex, MandersResult, getAutoThreshold, getOverlap, getPearson,
+	ratio)
+import colocBatch
 
 
 inputDialog = DirectoryChooser("Please select a directory contaning your images")
@@ -35,120 +42,450 @@ outputDir = outputDialog.getDirectory()
 imageA = 2  # Second channel
 imageB = 3  # Third channel
 methods = ["Mean", "Otsu"]
+otherCoefficients = []  # Computed besides M1 and M2 - any of Pearson, Spearman, ICQ, Overlap
+lazyLoading = None  # Read planes from disk on demand (True), load whole images (False), or None: lazily when larger than half of the free memory
+shard = "1/1"  # Analyse only shard i/N of the input directory, e.g. "2/4" (see colocBatch.py)
+showResults = True  # Also collect the results in a ResultsTable, shown at the end
+useCache = True  # Reuse the results of unchanged cells, cached in the output directory
+hashContent = False  # Find cached results by the SHA-1 of the whole image file, not its size, time and sampled blocks
 
 
-def createContainer(roi, imgA, imgB):
-	rect = roi.getBounds()
+def getRoiMask(roi, width, height):
+	### Bounds of the ROI inside the image, and the mask (255) of the ROI
+	### over these bounds
+	bounds = roi.getBounds()
+	box = bounds.intersection(Rectangle(0, 0, width, height))
+	if box.isEmpty():
+		return Rectangle(0, 0, 1, 1), ByteProcessor(1, 1)
+	mask = ByteProcessor(box.width, box.height)
 	ipmask = roi.getMask()
-	offset = [rect.x, rect.y]
-	size = [rect.width, rect.height]
-	if (ipmask != None):
-		ipslice = ipmask.createProcessor(imgA.getWidth(), imgA.getHeight())
-		ipslice.setValue(0.0)
-		ipslice.fill()
-		ipslice.copyBits(ipmask, rect.x, rect.y, Blitter.COPY)
-		impmask = ImagePlus("Mask", ipslice)
-		ipamask = ImagePlusAdapter.wrap(impmask)
-		container = DataContainer(imgA, imgB, 1, 1, "imageA", "imageB", ipamask, offset, size)
+	if ipmask is None:
+		mask.setValue(255)
+		mask.fill()
 	else:
-		container = DataContainer(imgA, imgB, 1, 1, "imageA", "imageB", offset, size)
-
-	return container
-
-def calculateThreshold(image, roi, method):
-	if roi != None:
-		bounds = roi.getBounds()
-		stack = image.getStack()
-		newstack = ImageStack(bounds.width, bounds.height)
-		for i in xrange(1, stack.getSize() + 1):
-  			ip = stack.getProcessor(i).duplicate()
-  			ip.fillOutside(roi)
-  			ip.setRoi(roi)
-			c = ip.crop()
-			newstack.addSlice(str(i), c)
-		imp = ImagePlus("ThresholdImage", newstack)
+		mask.copyBits(ipmask, bounds.x - box.x, bounds.y - box.y, Blitter.COPY)
+	return box, mask
+
+def cropRoi(ip, box):
+	### Copy of the pixels of ip inside box; negative (32-bit) intensities
+	### count as zeros, as in ColocIndex
+	ip.setRoi(box)
+	crop = ip.crop()
+	ip.resetRoi()
+	if crop.getBitDepth() == 32:
+		crop.min(0.0)
+	return crop
+
+def getHistogram(ip, mask):
+	### ImageJ histogram of the 8 or 16-bit ip under mask, up to its
+	### brightest pixel
+	ip.setMask(mask)
+	top = ImageStatistics.getStatistics(ip, Measurements.MIN_MAX, None).max
+	histogram = ip.getHistogram()[:int(top) + 1]
+	ip.setMask(None)
+	return histogram
+
+def getThresholdMask(ip, threshold, mask):
+	### Mask (255) of the pixels of ip above threshold (v > t) inside mask;
+	### the lower bound of 32-bit ip is the next float after the threshold
+	lower = threshold + 1
+	if ip.getBitDepth() == 32:
+		lower = Math.nextUp(float(threshold))
+	above = ByteProcessor(ip.getWidth(), ip.getHeight())
+	if lower <= ip.maxValue():
+		ip.setThreshold(lower, ip.maxValue(), ImageProcessor.NO_LUT_UPDATE)
+		above = ip.createMask()
+		ip.resetThreshold()
+		above.copyBits(mask, 0, 0, Blitter.AND)
+	return above
+
+def getMeanMasks(ip, mean, mask):
+	### Masks of the pixels of ip above and below mean inside mask
+	if ip.getBitDepth() == 32:
+		high = getThresholdMask(ip, mean, mask)
+		low = getThresholdMask(ip, Math.nextDown(mean), mask)
 	else:
-		imp = image
-	thresholder = Auto_Threshold()
-	result = thresholder.exec(imp, method, False, False, True, False, False, True)
+		high = getThresholdMask(ip, int(math.floor(mean)), mask)
+		low = getThresholdMask(ip, int(math.ceil(mean)) - 1, mask)
+	low.invert()
+	low.copyBits(mask, 0, 0, Blitter.AND)
+	return high, low
+
+def getMoments(ip, mask):
+	### Count, sum and sum of squares of the pixels of ip under mask, from
+	### ImageJ's statistics; those of 8 and 16-bit ip are made from the
+	### histogram in double, so the integer sums come back exactly
+	ip.setMask(mask)
+	stats = ImageStatistics.getStatistics(ip, Measurements.MEAN | Measurements.STD_DEV, None)
+	ip.setMask(None)
+	n = stats.pixelCount
+	if not n:
+		return (0, 0.0, 0.0)
+	total = stats.mean * n
+	squares = stats.stdDev * stats.stdDev * (n - 1) + total * total / n
+	if ip.getBitDepth() != 32:
+		total, squares = round(total), round(squares)
+	return (n, float(total), float(squares))
+
+def indexRois(image, channel1, channel2, rois, frame = 1):
+	### One sweep over the planes of two channels of one frame collects the
+	### histograms of every ROI, for the thresholds. Planes are read once,
+	### from the stack itself, so channels are not copied. The histograms
+	### of 8 and 16-bit images are ImageJ's, over the ROI masks; 32-bit
+	### pixels go through the voxel index of colocCore.
+	width, height = image.getWidth(), image.getHeight()
+	masks = [getRoiMask(roi, width, height) for roi in rois]
+	indexes = [ColocIndex([], (1, 2)) for roi in rois]
+	volumes = [mask.getHistogram()[255] for box, mask in masks]
+	stack = image.getStack()
+	for z in xrange(1, image.getNSlices() + 1):
+		planes = [stack.getProcessor(image.getStackIndex(c, z, frame)) for c in (channel1, channel2)]
+		for (box, mask), index, volume in zip(masks, indexes, volumes):
+			crops = [cropRoi(ip, box) for ip in planes]
+			### The rest of the bounding box counts as zeros, as in the
+			### zero-filled crops the thresholds used to be computed on
+			if crops[0].getBitDepth() == 32:
+				runs = CellMask(0, 0, box.width, box.height).getRoiRuns(mask.getPixels(),
+					0, 0, box.width, box.height)
+				index.addValues([crop.getPixels() for crop in crops], runs)
+			else:
+				index.addHistograms([getHistogram(crop, mask) for crop in crops],
+					box.width * box.height, volume)
+	return indexes
+
+def measureRois(image, channel1, channel2, rois, indexes, thresholds, frame = 1):
+	### One more sweep over the planes of the frame, once the thresholds
+	### (thr1, thr2) of every ROI are known, serves all ROIs: the Manders
+	### sums of each are measured by ImageJ over threshold masks, which also
+	### make the binary crops of both channels, and so are the sums of the
+	### other coefficients (see RoiSums). Returns, per ROI, the sums
+	### sum(A | B > 0), sum(B | A > 0), sum(A | B > thr2), sum(B | A > thr1),
+	### the RoiSums (None without otherCoefficients) and the binary crops.
+	width, height = image.getWidth(), image.getHeight()
+	masks = [getRoiMask(roi, width, height) for roi in rois]
+	sums = [[0.0] * 4 for roi in rois]
+	others = [RoiSums(index, mask, otherCoefficients) if otherCoefficients else None
+		for index, (box, mask) in zip(indexes, masks)]
+	binaries = [(ImageStack(box.width, box.height), ImageStack(box.width, box.height))
+		for box, mask in masks]
+	stack = image.getStack()
+	for z in xrange(1, image.getNSlices() + 1):
+		planes = [stack.getProcessor(image.getStackIndex(c, z, frame)) for c in (channel1, channel2)]
+		for i, (box, mask) in enumerate(masks):
+			ip1, ip2 = [cropRoi(ip, box) for ip in planes]
+			thr1, thr2 = thresholds[i]
+			above1 = getThresholdMask(ip1, thr1, mask)
+			above2 = getThresholdMask(ip2, thr2, mask)
+			values = [getThresholdMask(ip2, 0, mask), getThresholdMask(ip1, 0, mask), above2, above1]
+			for k, (ip, over) in enumerate(zip([ip1, ip2, ip1, ip2], values)):
+				sums[i][k] += getMoments(ip, over)[1]
+			if others[i] is not None:
+				others[i].add(ip1, ip2, mask, above1, above2)
+			binaries[i][0].addSlice(str(z), above1)
+			binaries[i][1].addSlice(str(z), above2)
+	return [(sums[i], others[i], [ImagePlus("ThresholdImage", binary) for binary in binaries[i]])
+		for i in range(len(rois))]
+
+
+class RoiSums(object):
+
+	### The sums behind the other coefficients of one ROI, measured a plane
+	### at a time over masks, in the sweep of measureRois. The histograms of
+	### the ROI (index) come first, for the channel means of the ICQ.
+	### Products are not summed directly but as
+	### sum(AB) = (sum(A^2) + sum(B^2) - sum((A - B)^2)) / 2, which keeps
+	### the sums of 8 and 16-bit ROIs in integers. Spearman's rho needs the
+	### joint histogram of the ROI, collected voxel by voxel.
+
+	def __init__(self, index, mask, names):
+		self.names = names
+		self.volume = index.volume
+		self.means = [ratio(index.totals[c], index.volume) for c in (1, 2)]
+		### Count, sum(A), sum(A^2), sum(B), sum(B^2) and sum((A - B)^2), over
+		### the ROI and above both thresholds; number of voxels on the same
+		### side of the means in both channels
+		self.moments = [0.0] * 6
+		self.above = [0.0] * 6
+		self.positive = 0
+		self.joint = None
+		if "Spearman" in names:
+			self.joint = ColocIndex([(1, 2)], joint = True)
+			self.runs = CellMask(0, 0, mask.getWidth(), mask.getHeight()).getRoiRuns(mask.getPixels(),
+				0, 0, mask.getWidth(), mask.getHeight())
+
+	def addMoments(self, sums, ip1, ip2, difference, mask):
+		n, sum1, squares1 = getMoments(ip1, mask)
+		n, sum2, squares2 = getMoments(ip2, mask)
+		for k, value in enumerate([n, sum1, squares1, sum2, squares2, getMoments(difference, mask)[2]]):
+			sums[k] += value
+
+	def add(self, ip1, ip2, mask, above1, above2):
+		### ip1 and ip2 are the crops of one plane, above1 and above2 their
+		### masks above the thresholds
+		if "Pearson" in self.names or "Overlap" in self.names:
+			difference = ip1.duplicate()
+			difference.copyBits(ip2, 0, 0, Blitter.DIFFERENCE)
+			self.addMoments(self.moments, ip1, ip2, difference, mask)
+			if "Pearson" in self.names:
+				both = above1.duplicate()
+				both.copyBits(above2, 0, 0, Blitter.AND)
+				self.addMoments(self.above, ip1, ip2, difference, both)
+		if "ICQ" in self.names and self.volume:
+			high1, low1 = getMeanMasks(ip1, self.means[0], mask)
+			high2, low2 = getMeanMasks(ip2, self.means[1], mask)
+			high1.copyBits(high2, 0, 0, Blitter.AND)
+			low1.copyBits(low2, 0, 0, Blitter.AND)
+			high1.copyBits(low1, 0, 0, Blitter.OR)
+			self.positive += high1.getHistogram()[255]
+		if self.joint is not None:
+			self.joint.addJoint([ip1.convertToFloat().getPixels(), ip2.convertToFloat().getPixels()], self.runs)
+
+	def getCoefficients(self):
+		### Same values as ColocIndex.getCoefficients
+		values = OrderedDict()
+		count, sumA, sumAA, sumB, sumBB, sumDD = self.moments
+		sumAB = (sumAA + sumBB - sumDD) / 2
+		if "Pearson" in self.names:
+			values["Pearson r"] = getPearson(count, sumA, sumB, sumAA, sumBB, sumAB)
+			count, sumA, sumAAT, sumB, sumBBT, sumDD = self.above
+			values["Pearson r thrd"] = getPearson(count, sumA, sumB, sumAAT, sumBBT,
+				(sumAAT + sumBBT - sumDD) / 2)
+		if "Spearman" in self.names:
+			values["Spearman rho"] = self.joint.getCoefficients(1, 2, ["Spearman"])["Spearman rho"]
+		if "ICQ" in self.names:
+			values["ICQ"] = ratio(float(self.positive), self.volume) - 0.5
+		if "Overlap" in self.names:
+			values["Overlap"] = getOverlap(sumAB, sumAA, sumBB)
+		return values
+
+
+def runThresholder(method, data):
+	thresholder = AutoThresholder()
+	method = AutoThresholder.Method.valueOf(method.replace("(I)", ""))
+	return thresholder.getThreshold(method, jarray.array(data, 'i'))
+
+class ProjectionTask(Callable):
+
+	### MAX projection of one channel, plane by plane - the channel is not copied
 
-	return result
+	def __init__(self, image, channel):
+		self.image = image
+		self.channel = channel
+
+	def call(self):
+		stack = self.image.getStack()
+		projection = None
+		for z in range(1, self.image.getNSlices() + 1):
+			plane = stack.getProcessor(self.image.getStackIndex(self.channel, z, 1))
+			if projection is None:
+				projection = plane.duplicate()
+			else:
+				projection.copyBits(plane, 0, 0, Blitter.MAX)
+		return projection
+
+def getSeriesCount(imageFile):
+	reader = ImageReader()
+	try:
+		try:
+			reader.setId(imageFile)
+			return reader.getSeriesCount()
+		except Exception:
+			return 1
+	finally:
+		reader.close()
+
+def isLazy(imageFile, series):
+	### Lazy loading by default only when the series would take more than
+	### half of the free heap (see MandersPlugin.isLazy)
+	if lazyLoading is not None:
+		return lazyLoading
+	reader = ImageReader()
+	try:
+		try:
+			reader.setId(imageFile)
+			reader.setSeries(series)
+			size = reader.getSizeX() * reader.getSizeY() * reader.getImageCount() * \
+				reader.getRGBChannelCount() * FormatTools.getBytesPerPixel(reader.getPixelType())
+		except Exception:
+			size = os.path.getsize(imageFile)
+	finally:
+		reader.close()
+	return size > (IJ.maxMemory() - IJ.currentMemory()) / 2
+
+def saveRois(cellsFile, rois):
+	### Cell_<n>.roi entries, the 2D cells of mColoc3D.py - ROIs drawn here
+	### are restored on the next run, and keep the cached results of their cells
+	zos = ZipOutputStream(BufferedOutputStream(FileOutputStream(cellsFile)))
+	out = DataOutputStream(BufferedOutputStream(zos))
+	encoder = RoiEncoder(out)
+	try:
+		for n, roi in enumerate(rois):
+			zos.putNextEntry(ZipEntry("Cell_%i.roi" % (n + 1)))
+			encoder.write(roi)
+			out.flush()
+	finally:
+		out.close()
+
+def loadRois(cellsFile):
+	### ROIs of the 2D cells in a cells file, in the order of their numbers;
+	### 3D cells of mColoc3D.py (Cell_<n>-Slice_<z>.roi) are skipped
+	rois = {}
+	zis = ZipInputStream(BufferedInputStream(FileInputStream(cellsFile)))
+	try:
+		entry = zis.getNextEntry()
+		while entry is not None:
+			name = entry.getName()
+			data = ByteArrayOutputStream()
+			buf = jarray.zeros(8192, 'b')
+			size = zis.read(buf, 0, len(buf))
+			while size >= 0:
+				data.write(buf, 0, size)
+				size = zis.read(buf, 0, len(buf))
+			label = name[:name.rfind(".")].split("-")
+			if len(label) == 1 and label[0].startswith("Cell_"):
+				rois[int(label[0].split("_")[1])] = RoiDecoder(data.toByteArray(), name).getRoi()
+			entry = zis.getNextEntry()
+	finally:
+		zis.close()
+	return [rois[n] for n in sorted(rois)]
 
 def getPreview(image):
+	### Channels are projected in parallel, unless planes are read from disk
+	### (lazyLoading), where each plane is read once, in order
 	enhancer = ContrastEnhancer()
-	projector = ZProjector()
-	splitter = ChannelSplitter()
-	imp1 = ImagePlus("CH1", )
-	width, height, channels, slices, frames = image.getDimensions()
+	tasks = [ProjectionTask(image, ch) for ch in range(1, image.getNChannels() + 1)]
+	if image.getStack().isVirtual():
+		projections = [task.call() for task in tasks]
+	else:
+		pool = Executors.newFixedThreadPool(max(1, min(len(tasks), Prefs.getThreads())))
+		try:
+			projections = [future.get() for future in pool.invokeAll(tasks)]
+		finally:
+			pool.shutdown()
 	chimps = []
-	for ch in range(1, channels + 1):
-		projector = ZProjector(ImagePlus("C%i" % ch, splitter.getChannel(image, ch)))
-		projector.setMethod(ZProjector.MAX_METHOD)
-		projector.doProjection()
-		proj = projector.getProjection()
+	for ch, projection in enumerate(projections):
+		proj = ImagePlus("MAX_C%i" % (ch + 1), projection)
 		enhancer.equalize(proj)
 		chimps.append(proj)
 		
 	return RGBStackMerge.mergeChannels(chimps, False)
 
-manders = MandersColocalization()
+shard, shards = colocBatch.parseShard(shard)
+files = [os.path.join(inputDir, imageFile) for imageFile in sorted(os.listdir(inputDir))
+	if not imageFile.endswith(colocBatch.cellsSuffix)]
+if shards > 1:
+	files = colocBatch.getShard(colocBatch.loadManifest(outputDir, inputDir, files), shard, shards)
 results = ResultsTable()
-for imageFile in os.listdir(inputDir):
-	print "Opening " + imageFile
+### Rows are written as they come, see colocBatch.ResultsWriter
+writer = colocBatch.ResultsWriter(colocBatch.getShardFile(outputDir, shard, shards),
+	partial = shards > 1, table = results if showResults else None)
+for imageFile, series in ((f, s) for f in files for s in xrange(getSeriesCount(f))):
+	### Series are opened one at a time; cells are drawn on each
+	print "Opening %s (series %i)" % (imageFile, series + 1)
 	try:
-		images = BF.openImagePlus(inputDir + imageFile)
+		options = ImporterOptions()
+		options.setId(imageFile)
+		options.clearSeries()
+		options.setSeriesOn(series, True)
+		options.setVirtual(isLazy(imageFile, series))
+		images = BF.openImagePlus(options)
 		image = images[0]
 	except UnknownFormatException:
 		continue
 	preview = getPreview(image)
 	preview.show()
+	### Cells drawn on a previous run are shown again, to be kept or edited
+	cellsFile = colocBatch.getCellsFile(imageFile, series)
 	rm = RoiManager()
+	if os.path.exists(cellsFile):
+		for roi in loadRois(cellsFile):
+			rm.addRoi(roi)
 	dialog = WaitForUserDialog("Action required", "Please select regions of interest in this image. Click OK when done.")
 	dialog.show()
 	rm.close()
-	splitter = ChannelSplitter()
-	imp1 = ImagePlus("CH1", splitter.getChannel(image, imageA))
-	imp2 = ImagePlus("CH2", splitter.getChannel(image, imageB))
-	title = image.getTitle()
+	title = os.path.basename(imageFile)
 	title = title[:title.rfind('.')]
-	image.close()
+	if series > 0:
+		title += "_s%i" % (series + 1)
+	rois = rm.getRoisAsArray()
+	if len(rois):
+		saveRois(cellsFile, rois)
+	elif os.path.exists(cellsFile):
+		os.remove(cellsFile)
+	nframes = image.getNFrames()
+	tasks = [(cell, frame) for cell in range(len(rois)) for frame in xrange(1, nframes + 1)]
+
+	### Cells whose image, ROI and settings did not change are not analysed again
+	keys = {}
+	cached = {}
+	if useCache:
+		cache = colocBatch.ResultCache(outputDir, hashContent)
+		imageHash = cache.getFileHash(imageFile)
+		settings = {"version": colocBatch.resultsVersion, "channels": [imageA, imageB], "methods": methods}
+		if otherCoefficients:
+			settings["coefficients"] = otherCoefficients
+		for cell, frame in tasks:
+			keys[(cell, frame)] = cache.getKey(settings, imageHash, os.path.basename(imageFile), cell + 1,
+				RoiEncoder.saveAsByteArray(rois[cell]).tostring(), series, frame)
+			values = cache.get(keys[(cell, frame)])
+			if values is not None:
+				cached[(cell, frame)] = values
+	pending = [task for task in tasks if task not in cached]
+	### Frames are analysed one at a time: the histograms of all their
+	### ROIs, then the thresholds, then one sweep that measures every ROI
+	measured = {}
+	for frame in xrange(1, nframes + 1):
+		cells = [cell for cell, t in pending if t == frame]
+		if not cells:
+			continue
+		indexes = indexRois(image, imageA, imageB, [rois[cell] for cell in cells], frame)
+		thresholds = [(getAutoThreshold(index.getHistogram(1), methods[0], runThresholder),
+			getAutoThreshold(index.getHistogram(2), methods[1], runThresholder)) for index in indexes]
+		for cell, index, (thr1, thr2), (sums, others, binaries) in zip(cells, indexes, thresholds,
+				measureRois(image, imageA, imageB, [rois[cell] for cell in cells], indexes, thresholds, frame)):
+			raw = MandersResult(ratio(sums[0], index.totals[1]), ratio(sums[1], index.totals[2]))
+			thrd = MandersResult(ratio(sums[2], index.totals[1]), ratio(sums[3], index.totals[2]))
+			print "Results are: %f %f %f %f" % (raw.m1, raw.m2, thrd.m1, thrd.m2)
+			### Measured values are cached apart from the columns naming the cell
+			values = OrderedDict()
+			values["Threshold 1"] = int(thr1)
+			values["Threshold 2"] = int(thr2)
+			values["M1 raw"] = float(raw.m1)
+			values["M2 raw"] = float(raw.m2)
+			values["M1 thrd"] = float(thrd.m1)
+			values["M2 thrd"] = float(thrd.m2)
+			if others is not None:
+				for name, value in others.getCoefficients().items():
+					values[name] = float(value)
+			measured[(cell, frame)] = values
+
+			thrimp = RGBStackMerge.mergeChannels(binaries, False)
+			saver = FileSaver(thrimp)
+			label = "Cell_%i" % (cell + 1)
+			if nframes > 1:
+				label += "_t%i" % frame
+			path = outputDir + label + "-" + title + ".tif"
+			saver.saveAsTiffStack(path)
+			thrimp.close()
+			if (cell, frame) in keys:
+				cache.put(keys[(cell, frame)], values, [path])
 	preview.close()
-	ch1 = ImagePlusAdapter.wrap(imp1)
-	ch2 = ImagePlusAdapter.wrap(imp2)
-
-	for roi in rm.getRoisAsArray():
-		container = createContainer(roi, ch1, ch2)
-		img1 = container.getSourceImage1()
-		img2 = container.getSourceImage2()
-		mask = container.getMask()
-		
-		thr1, thrimp1 = calculateThreshold(imp1, roi, methods[0])
-		thr2, thrimp2 = calculateThreshold(imp2, roi, methods[1])
-		
-		cursor = TwinCursor(img1.randomAccess(), img2.randomAccess(), Views.iterable(mask).localizingCursor())
-		rtype = img1.randomAccess().get().createVariable()
-		raw = manders.calculateMandersCorrelation(cursor, rtype)
-		rthr1 = rtype.copy()
-		rthr2 = rtype.copy()
-		rthr1.set(thr1)
-		rthr2.set(thr2)
-		cursor.reset()
-		thrd = manders.calculateMandersCorrelation(cursor, rthr1, rthr2, ThresholdMode.Above)
-		print "Results are: %f %f %f %f" % (raw.m1, raw.m2, thrd.m1, thrd.m2)
-
-		results.incrementCounter()
-		rowno = results.getCounter() - 1
-		results.setValue("Cell", rowno, int(rowno))
-		results.setValue("Threshold 1", rowno, int(thr1))
-		results.setValue("Threshold 2", rowno, int(thr2))
-		results.setValue("M1 raw", rowno, float(raw.m1))
-		results.setValue("M2 raw", rowno, float(raw.m2))
-		results.setValue("M1 thrd", rowno, float(thrd.m1))
-		results.setValue("M2 thrd", rowno, float(thrd.m2))
-		
-		thrimp = RGBStackMerge.mergeChannels([thrimp1, thrimp2], False)
-		saver = FileSaver(thrimp)
-		saver.saveAsTiffStack(outputDir + "Cell_%i-" % results.getCounter() + title + ".tif")
-		thrimp.close()
 
-results.show("Colocalization results")
+	for cell, frame in tasks:
+		values = OrderedDict()
+		values["Image"] = os.path.basename(imageFile)
+		values["Series"] = series + 1
+		values["Cell"] = cell + 1
+		values["Frame"] = frame
+		if (cell, frame) in cached:
+			values.update(cached[(cell, frame)])
+		else:
+			values.update(measured[(cell, frame)])
+		writer.write(values)
+	image.close()
+
+writer.close()
+if shards > 1 and colocBatch.isComplete(outputDir, shards):
+	print "Merged %i cells" % colocBatch.mergeTables(outputDir, shards)
+if showResults:
+	results.show("Colocalization results")
@@ -0,0 +1,74 @@
+### Checks of the session checkpoints of colocBatch.py, in plain CPython:
+###
+###     python -m unittest discover tests
+###
+### @license Licensed under GPLv3 and CC BY 4.0
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import colocBatch
+
+
+class SettleSessionTest(unittest.TestCase):
+
+	### An interrupted session leaves its checkpoint and results table in the
+	### output directory; both must survive until a new session is chosen
+
+	def setUp(self):
+		self.outputDir = tempfile.mkdtemp()
+		self.sessionPath = os.path.join(self.outputDir, ".session")
+		os.makedirs(self.sessionPath)
+		self.write(os.path.join(self.sessionPath, "session.json"), '{"finished": ["a.tif"]}')
+		self.resultsFile = os.path.join(self.outputDir, colocBatch.resultsName)
+		self.write(self.resultsFile, "Image,Cell\na.tif,1\n")
+
+	def tearDown(self):
+		shutil.rmtree(self.outputDir, True)
+
+	def write(self, path, text):
+		data = open(path, "w")
+		try:
+			data.write(text)
+		finally:
+			data.close()
+
+	def read(self, path):
+		data = open(path)
+		try:
+			return data.read()
+		finally:
+			data.close()
+
+	def testCancelKeepsSessionAndResults(self):
+		self.assertFalse(colocBatch.settleSession(self.outputDir, self.sessionPath, None))
+		self.assertTrue(os.path.exists(os.path.join(self.sessionPath, "session.json")))
+		self.assertEqual(self.read(self.resultsFile), "Image,Cell\na.tif,1\n")
+		self.assertEqual(sorted(os.listdir(self.outputDir)), [".session", colocBatch.resultsName])
+
+	def testResumeKeepsSessionAndResults(self):
+		self.assertTrue(colocBatch.settleSession(self.outputDir, self.sessionPath, True))
+		self.assertTrue(os.path.exists(os.path.join(self.sessionPath, "session.json")))
+		self.assertEqual(self.read(self.resultsFile), "Image,Cell\na.tif,1\n")
+
+	def testNewSessionBacksUpResults(self):
+		self.assertTrue(colocBatch.settleSession(self.outputDir, self.sessionPath, False))
+		self.assertFalse(os.path.exists(self.sessionPath))
+		self.assertFalse(os.path.exists(self.resultsFile))
+		self.assertEqual(self.read(self.resultsFile + ".1.bak"), "Image,Cell\na.tif,1\n")
+
+	def testBackupsAreNotOverwritten(self):
+		colocBatch.backupFile(self.resultsFile)
+		self.write(self.resultsFile, "Image,Cell\nb.tif,1\n")
+		self.assertEqual(colocBatch.backupFile(self.resultsFile), self.resultsFile + ".2.bak")
+		self.assertEqual(self.read(self.resultsFile + ".1.bak"), "Image,Cell\na.tif,1\n")
+		self.assertEqual(self.read(self.resultsFile + ".2.bak"), "Image,Cell\nb.tif,1\n")
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,87 @@
+### Checks of colocNumpy.py against ImageJ and colocCore.py, in plain CPython:
+###
+###     python -m unittest discover tests
+###
+### thresholds.json holds histograms with the thresholds of ij.process.AutoThresholder
+### for each of its methods. The histograms have 256 bins with the first and last
+### ones not empty, so ImageJ sees the same data as getAutoThreshold passes on.
+###
+### @license Licensed under GPLv3 and CC BY 4.0
+
+import os
+import sys
+import json
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+	import numpy as np
+	import colocNumpy
+except ImportError:
+	np = None
+
+from colocCore import ColocIndex, getAutoThreshold, thresholdMethods
+
+
+def loadFixtures():
+	data = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "thresholds.json"))
+	try:
+		return json.load(data)
+	finally:
+		data.close()
+
+
+@unittest.skipIf(np is None, "needs NumPy")
+class ThresholdTest(unittest.TestCase):
+
+	def setUp(self):
+		self.fixtures = loadFixtures()
+
+	def testMethodsAreCovered(self):
+		for fixture in self.fixtures:
+			self.assertEqual(sorted(fixture["thresholds"]), sorted(thresholdMethods))
+
+	def testImageJThresholds(self):
+		for fixture in self.fixtures:
+			for method, expected in sorted(fixture["thresholds"].items()):
+				self.assertEqual(colocNumpy.getThreshold(method, fixture["histogram"]), max(expected, 0),
+					"%s of %s" % (method, fixture["name"]))
+
+	def testBracketedThresholds(self):
+		### The empty bins below the data only shift the threshold
+		for fixture in self.fixtures:
+			histogram = [0] * 17 + fixture["histogram"] + [0] * 5
+			for method, expected in sorted(fixture["thresholds"].items()):
+				self.assertEqual(getAutoThreshold(histogram, method, colocNumpy.getThreshold), max(expected, 0) + 17,
+					"%s of %s" % (method, fixture["name"]))
+
+
+@unittest.skipIf(np is None, "needs NumPy")
+class NegativeValuesTest(unittest.TestCase):
+
+	### 32-bit cells can have negative intensities (e.g. after background
+	### subtraction); ColocIndex counts them as zeros
+
+	def setUp(self):
+		generator = random.Random(7)
+		self.a = [generator.uniform(-60.0, 200.0) for i in range(500)]
+		self.b = [generator.uniform(-60.0, 200.0) for i in range(500)]
+		self.index = ColocIndex([(1, 2)])
+		self.index.add([self.a, self.b])
+
+	def testHistogram(self):
+		self.assertEqual(list(colocNumpy.getHistogram([-3.5, -1.0, 0.0, 0.5, 2.7])), [4, 0, 1])
+		self.assertEqual(list(colocNumpy.getHistogram(self.a)), self.index.getHistogram(1))
+
+	def testManders(self):
+		for thrA, thrB in [(0, 0), (40, 75), (120, 10)]:
+			expected = self.index.getManders(1, 2, thrA, thrB)
+			result = colocNumpy.getManders(self.a, self.b, None, thrA, thrB)
+			self.assertAlmostEqual(result.m1, expected.m1)
+			self.assertAlmostEqual(result.m2, expected.m2)
+
+
+if __name__ == "__main__":
+	unittest.main()